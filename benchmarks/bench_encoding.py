@@ -0,0 +1,50 @@
+"""
+Measures encoding and decoding throughput for batches of signals in the binary wire format, along with the encoded
+size per signal.
+
+Usage:
+    python -m benchmarks.bench_encoding
+"""
+
+import datetime
+import time
+
+from chatty.signals.encoding import SignalBatchView, decode_signals, encode_signals
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+
+
+BATCH_SIZE = 1000
+REPETITIONS = 10
+MEMBER_COUNTS = (2, 20, 200)
+
+
+def make_signals(member_count: int):
+    members = ['user%d' % index for index in range(member_count)]
+    now = datetime.datetime.now()
+    return [Message(SignalMetaData(identifier='general/alice/%d' % index, origin=members[0], visible_to=members,
+                                   sent_at=now, received_at=now, room='general'),
+                    'This is message number %d.' % index)
+            for index in range(BATCH_SIZE)]
+
+
+def rate(function, argument) -> float:
+    start = time.perf_counter()
+    for _ in range(REPETITIONS):
+        function(argument)
+    return BATCH_SIZE * REPETITIONS / (time.perf_counter() - start)
+
+
+def main():
+    print("%8s %14s %16s %16s %16s" % ('members', 'bytes/signal', 'encode (sig/s)', 'decode (sig/s)',
+                                       'index (sig/s)'))
+    for member_count in MEMBER_COUNTS:
+        signals = make_signals(member_count)
+        encoded = encode_signals(signals)
+        print("%8d %14.1f %16.0f %16.0f %16.0f" % (member_count, len(encoded) / BATCH_SIZE,
+                                                   rate(encode_signals, signals), rate(decode_signals, encoded),
+                                                   rate(SignalBatchView, encoded)))
+
+
+if __name__ == '__main__':
+    main()
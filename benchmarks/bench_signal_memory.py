@@ -0,0 +1,90 @@
+"""
+Measures the memory held by queued signals, comparing the current slotted, interned representation against an
+equivalent dict-backed one without interning (as signals were originally implemented). Each simulated message comes
+from one of a handful of busy channels and carries the channel's member list in visible_to, with handle strings
+freshly decoded for every message, as they would be when read off the network. Results are scaled to a million
+queued signals.
+
+Usage:
+    python -m benchmarks.bench_signal_memory
+"""
+
+import datetime
+import gc
+import json
+import tracemalloc
+
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+
+
+SIGNAL_COUNT = 20000
+CHANNEL_COUNT = 10
+MEMBERS_PER_CHANNEL = 200
+SCALE = 1000000 / SIGNAL_COUNT
+
+
+class DictMetaData:
+    """The original, dict-backed metadata layout."""
+
+    def __init__(self, *, identifier=None, origin=None, addressees=None, visible_to=None, response_to=None,
+                 sent_at=None, received_at=None, room=None):
+        self._identifier = identifier
+        self._origin = origin
+        self._addressees = tuple(addressees or ())
+        self._visible_to = tuple(visible_to or ())
+        self._response_to = response_to
+        self._sent_at = sent_at
+        self._received_at = received_at
+        self._room = room
+
+
+class DictMessage:
+    """The original, dict-backed signal layout."""
+
+    def __init__(self, meta_data, content):
+        self._meta_data = meta_data
+        self._content = content
+
+
+def make_events():
+    # Encoded events, standing in for what arrives on the wire.
+    channels = []
+    for channel in range(CHANNEL_COUNT):
+        members = ['user%d.%d' % (channel, member) for member in range(MEMBERS_PER_CHANNEL)]
+        channels.append(json.dumps({'channel': 'channel%d' % channel, 'members': members}))
+    return channels
+
+
+def measure(meta_data_type, signal_type, events):
+    gc.collect()
+    tracemalloc.start()
+    signals = []
+    now = datetime.datetime.now()
+    for index in range(SIGNAL_COUNT):
+        event = json.loads(events[index % len(events)])
+        members = event['members']
+        meta_data = meta_data_type(identifier='%s/%d' % (event['channel'], index), origin=members[0],
+                                   visible_to=members, sent_at=now, received_at=now, room=event['channel'])
+        signals.append(signal_type(meta_data, 'message #%d' % index))
+    del event, members, meta_data
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del signals
+    return size
+
+
+def main():
+    events = make_events()
+    baseline = measure(DictMetaData, DictMessage, events)
+    current = measure(SignalMetaData, Message, events)
+    print("%d channels x %d members, scaled to 1,000,000 queued signals:" % (CHANNEL_COUNT, MEMBERS_PER_CHANNEL))
+    print("%20s %12.1f MiB" % ('dict-backed', baseline * SCALE / 2 ** 20))
+    print("%20s %12.1f MiB" % ('slotted + interned', current * SCALE / 2 ** 20))
+    print("%20s %12.1f MiB (%.1f%%)" % ('savings', (baseline - current) * SCALE / 2 ** 20,
+                                        100 * (baseline - current) / baseline))
+
+
+if __name__ == '__main__':
+    main()
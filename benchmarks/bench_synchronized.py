@@ -0,0 +1,61 @@
+"""
+Measures how long SynchronizedBot.receive() blocks the calling (session) thread as the cost of the wrapped bot's
+handler grows. With the handler running outside the queue lock, producer latency should stay flat regardless of how
+slow the handler is.
+
+Usage:
+    python -m benchmarks.bench_synchronized
+"""
+
+import statistics
+import time
+
+from chatty.bots.interface import Bot
+from chatty.bots.synchronized import SynchronizedBot
+from chatty.sessions.echo import EchoSession
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.types import Handle
+
+
+SIGNAL_COUNT = 200
+HANDLER_COSTS = (0, .0001, .001, .01)
+
+
+class SlowBot(Bot):
+
+    def __init__(self, cost: float):
+        super().__init__()
+        self.cost = cost
+
+    def receive(self, session, signal):
+        if self.cost:
+            time.sleep(self.cost)
+
+
+def measure(cost: float):
+    session = EchoSession()
+    bot = SynchronizedBot(SlowBot(cost))
+    signal = Message(SignalMetaData(origin=Handle('benchmark'), room=Handle('room')), 'content')
+    latencies = []
+    for _ in range(SIGNAL_COUNT):
+        start = time.perf_counter()
+        bot.receive(session, signal)
+        latencies.append(time.perf_counter() - start)
+        # Pace the producer at roughly the handler's own rate, so the worker is always busy when a signal arrives.
+        time.sleep(cost / 2)
+    bot.close()
+    session.close()
+    latencies.sort()
+    return statistics.mean(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * .99)]
+
+
+def main():
+    print("%12s %14s %14s %14s" % ('handler (s)', 'mean (us)', 'median (us)', 'p99 (us)'))
+    for cost in HANDLER_COSTS:
+        mean, median, p99 = measure(cost)
+        print("%12s %14.1f %14.1f %14.1f" % (cost, mean * 1e6, median * 1e6, p99 * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import Executor, ThreadPoolExecutor
+import asyncio
+
+from chatty.bots.interface import Bot
+import chatty.sessions.asynchronous
+from chatty.sessions.interface import Session
+from chatty.signals.interface import Signal
+
+
+class AsyncBot(metaclass=ABCMeta):
+    """Abstract interface for bots which run on an asyncio event loop."""
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def receive(self, session: 'chatty.sessions.asynchronous.AsyncSession', signal: Signal) -> None:
+        raise NotImplementedError()
+
+
+class AsyncBotAdapter(AsyncBot):
+    """
+    Presents an ordinary Bot as an AsyncBot, so existing bots can be added to an AsyncSession. The wrapped bot is
+    run in an executor, so it doesn't stall the event loop, and is handed a SyncSessionAdapter in place of the
+    asynchronous session.
+
+    While the bot sends a reply, its thread waits for the session to finish with it. If the session hands the reply
+    straight back to a bot behind an adapter, as an echo session does, that takes a second thread, and so on, so
+    replies nested more deeply than the executor has threads deadlock. Unless an executor is given, the adapter
+    creates one of its own, with max_workers threads, rather than competing for the loop's default executor, and
+    shuts it down on close.
+    """
+
+    def __init__(self, bot: Bot, executor: Executor = None, max_workers: int = None):
+        self._bot = bot
+        self._owns_executor = executor is None
+        self._executor = ThreadPoolExecutor(max_workers) if executor is None else executor
+
+    @property
+    def bot(self) -> Bot:
+        return self._bot
+
+    async def close(self) -> None:
+        self._bot.close()
+        if self._owns_executor:
+            self._executor.shutdown(wait=False)
+
+    async def receive(self, session: 'chatty.sessions.asynchronous.AsyncSession', signal: Signal) -> None:
+        loop = asyncio.get_running_loop()
+        adapter = chatty.sessions.asynchronous.SyncSessionAdapter(session, loop)
+        await loop.run_in_executor(self._executor, self._bot.receive, adapter, signal)
+
+
+class SyncBotAdapter(Bot):
+    """Presents an AsyncBot as an ordinary Bot, so asynchronous bots can be added to existing sessions. Each signal
+    is handed to the wrapped bot on the given event loop, and receive() blocks until the bot has finished with it,
+    just as it would for a synchronous bot. (Wrap the adapter in a SynchronizedBot to decouple it from the session's
+    thread.) The adapter must not be called from the event loop's own thread.
+
+    The wrapped bot's calls into the session run in an executor, with the same limit on nested replies as for
+    AsyncBotAdapter. Unless an executor is given, the adapter creates one of its own, with max_workers threads,
+    and shuts it down on close."""
+
+    def __init__(self, bot: AsyncBot, loop: asyncio.AbstractEventLoop, executor: Executor = None,
+                 max_workers: int = None):
+        super().__init__()
+        self._bot = bot
+        self._loop = loop
+        self._owns_executor = executor is None
+        self._executor = ThreadPoolExecutor(max_workers) if executor is None else executor
+
+    @property
+    def bot(self) -> AsyncBot:
+        return self._bot
+
+    def close(self) -> None:
+        if self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._bot.close(), self._loop)
+        if self._owns_executor:
+            self._executor.shutdown(wait=False)
+
+    def receive(self, session: Session, signal: Signal) -> None:
+        adapter = chatty.sessions.asynchronous.AsyncSessionAdapter(session, self._executor)
+        asyncio.run_coroutine_threadsafe(self._bot.receive(adapter, signal), self._loop).result()
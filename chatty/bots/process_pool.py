@@ -0,0 +1,168 @@
+from threading import Lock, Thread
+from typing import Callable, Dict, Hashable, List
+import itertools
+import logging
+import multiprocessing
+import os
+import weakref
+
+from chatty.bots.interface import Bot
+from chatty.bots.synchronized import get_conversation_key
+from chatty.sessions.interface import Session
+from chatty.signals.encoding import decode_signals, encode_signal, encode_signals
+from chatty.signals.interface import Signal
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _WorkerSession(Session):
+    """Stands in for the real session inside a worker process. Signals sent through it are passed back to the
+    parent process, which forwards them to the real session."""
+
+    def __init__(self, session_id: int, replies: multiprocessing.Queue):
+        super().__init__()
+        self._session_id = session_id
+        self._replies = replies
+
+    def join(self, timeout=None) -> None:
+        pass
+
+    def send(self, signal: Signal) -> None:
+        self._replies.put((self._session_id, encode_signal(signal)))
+
+    def send_batch(self, signals) -> None:
+        self._replies.put((self._session_id, encode_signals(signals)))
+
+
+def _worker_main(bot_factory: Callable[[], Bot], requests: multiprocessing.Queue,
+                 replies: multiprocessing.Queue) -> None:
+    bot = bot_factory()
+    sessions = {}  # type: Dict[int, _WorkerSession]
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            session_id, payload = request
+            session = sessions.get(session_id)
+            if session is None:
+                session = sessions[session_id] = _WorkerSession(session_id, replies)
+            for signal in decode_signals(payload):
+                # noinspection PyBroadException
+                try:
+                    bot.receive(session, signal)
+                except Exception:
+                    LOGGER.exception("Error in Bot.receive() in worker process %s." % os.getpid())
+    finally:
+        bot.close()
+
+
+class ProcessPoolBot(Bot):
+    """
+    A bot wrapper which hands incoming signals to a pool of worker processes, so that CPU-heavy bots can make use of
+    more than one core. Each worker process calls bot_factory once to construct its own copy of the bot, so the
+    factory must be picklable (a module-level function or a Bot subclass, for example). Signals are assigned to
+    workers by conversation key, as in SynchronizedBot, so each conversation is always handled by the same worker,
+    in order. Signals the bot sends from inside a worker are passed back to the parent process and sent through the
+    original session.
+
+    Signals are carried between processes in the binary wire format (see chatty.signals.encoding), so only the
+    standard signal types can be used. Replies for a session which has been garbage collected in the meantime are
+    dropped. On close, each worker is given close_timeout seconds to finish the signals already handed to it, and
+    is terminated if it hasn't by then.
+    """
+
+    def __init__(self, bot_factory: Callable[[], Bot], workers: int = None,
+                 conversation_key: Callable[[Signal], Hashable] = get_conversation_key,
+                 context: multiprocessing.context.BaseContext = None, close_timeout: float = 30):
+        super().__init__()
+        self._alive = False
+        self._processes = []  # type: List[multiprocessing.Process]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError(workers)
+        if context is None:
+            context = multiprocessing.get_context()
+        self._conversation_key = conversation_key
+        self._close_timeout = close_timeout
+        # Sessions are only referenced weakly, so the pool doesn't keep every session it has ever seen alive. Each
+        # session is given a number which is never reused, unlike id(), so a late reply for a session which has
+        # been collected can't reach a new session that happens to share its address.
+        self._session_numbers = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+        self._sessions = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary
+        self._session_counter = itertools.count()
+        self._sessions_lock = Lock()
+        self._replies = context.Queue()
+        self._requests = [context.Queue() for _ in range(workers)]
+        for requests in self._requests:
+            process = context.Process(target=_worker_main, args=(bot_factory, requests, self._replies), daemon=True)
+            process.start()
+            self._processes.append(process)
+        self._reply_thread = Thread(target=self._process_replies, daemon=True)
+        self._reply_thread.start()
+        self._alive = True
+
+    @property
+    def workers(self) -> int:
+        return len(self._processes)
+
+    @property
+    def session_count(self) -> int:
+        """The number of sessions whose replies can still be routed, i.e. which haven't been garbage collected."""
+        with self._sessions_lock:
+            return len(self._sessions)
+
+    def close(self) -> None:
+        if not self._alive:
+            return
+        self._alive = False
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join(self._close_timeout)
+            if process.is_alive():
+                LOGGER.warning("Terminating worker process %s, which didn't exit in time." % process.pid)
+                process.terminate()
+                process.join()
+        self._replies.put(None)
+        self._reply_thread.join()
+
+    def receive(self, session: Session, signal: Signal) -> None:
+        if not self._alive:
+            return
+        with self._sessions_lock:
+            session_id = self._session_numbers.get(session)
+            if session_id is None:
+                session_id = self._session_numbers[session] = next(self._session_counter)
+                self._sessions[session_id] = session
+        if len(self._requests) == 1:
+            requests = self._requests[0]
+        else:
+            requests = self._requests[hash(self._conversation_key(signal)) % len(self._requests)]
+        requests.put((session_id, encode_signal(signal)))
+
+    def _process_replies(self) -> None:
+        while True:
+            reply = self._replies.get()
+            if reply is None:
+                break
+            self._send_reply(*reply)
+
+    def _send_reply(self, session_id: int, payload: bytes) -> None:
+        # Kept separate from the loop above, so the session isn't held on to while waiting for the next reply.
+        with self._sessions_lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            LOGGER.warning("Dropping reply for unknown session.")
+            return
+        # noinspection PyBroadException
+        try:
+            signals = decode_signals(payload)
+            if len(signals) == 1:
+                session.send(signals[0])
+            else:
+                session.send_batch(signals)
+        except Exception:
+            LOGGER.exception("Error while sending reply from worker process.")
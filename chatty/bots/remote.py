@@ -0,0 +1,195 @@
+from collections import deque
+from threading import Condition, Lock, Thread
+from typing import Dict, List, Optional, Tuple
+import logging
+import random
+import socket
+
+from chatty.bots.interface import Bot
+from chatty.sessions.interface import Session
+from chatty.sessions.remote import DEFAULT_CHANNEL, Address, encode_record_frames, make_socket, read_frame
+from chatty.signals.encoding import encode_record
+from chatty.signals.interface import Signal
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RemoteBot(Bot):
+    """
+    A bot which forwards the signals it receives to a RemoteSession on another process or machine, where the real
+    bots run, and passes the signals those bots send back to the originating session. One RemoteBot can be added to
+    any number of sessions; their signals are multiplexed over a single connection. Pending signals are written in
+    batches, one frame per session per batch.
+
+    If the connection drops, the bot reconnects automatically, with jittered exponential backoff between attempts,
+    and resends anything still pending, in order. Signals that were in flight when the connection dropped may be
+    delivered twice. At most max_pending signals are held while disconnected; beyond that, the oldest are dropped
+    and counted in dropped_signals. Signals sent by the remote bots on the default channel, rather than in reply to
+    a particular session, go to default_session, if one is given.
+    """
+
+    def __init__(self, address: Address, default_session: Session = None, max_pending: int = 10000,
+                 reconnect_delay: float = .1, max_reconnect_delay: float = 30, batch_size: int = 1000):
+        super().__init__()
+        self._address = address
+        self._max_pending = max_pending
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._batch_size = batch_size
+        self._sessions = {}  # type: Dict[int, Session]
+        self._channels = {}  # type: Dict[int, int]
+        self._channels_lock = Lock()
+        if default_session is not None:
+            self._sessions[DEFAULT_CHANNEL] = default_session
+        self._pending = deque()  # type: deque
+        self._condition = Condition()
+        self._connection = None  # type: Optional[socket.socket]
+        self._connected = False
+        self._dropped = 0
+        self._alive = True
+        self._writer_thread = Thread(target=self._write_frames, daemon=True)
+        self._writer_thread.start()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    @property
+    def dropped_signals(self) -> int:
+        return self._dropped
+
+    @property
+    def pending_signals(self) -> int:
+        return len(self._pending)
+
+    def close(self) -> None:
+        with self._condition:
+            if not self._alive:
+                return
+            self._alive = False
+            self._condition.notify_all()
+        self._disconnect()
+        self._writer_thread.join()
+
+    def receive(self, session: Session, signal: Signal) -> None:
+        if not self._alive:
+            return
+        # Encode the signal here, rather than on the writer thread, so that any problem with it is reported to the
+        # caller.
+        record = encode_record(signal)
+        channel = self._get_channel(session)
+        with self._condition:
+            if len(self._pending) >= self._max_pending:
+                self._pending.popleft()
+                self._dropped += 1
+            self._pending.append((channel, record))
+            self._condition.notify()
+
+    def _get_channel(self, session: Session) -> int:
+        with self._channels_lock:
+            channel = self._channels.get(id(session))
+            if channel is None:
+                channel = self._channels[id(session)] = len(self._channels) + 1
+                self._sessions[channel] = session
+            return channel
+
+    def _connect(self) -> bool:
+        delay = self._reconnect_delay
+        while self._alive:
+            connection = make_socket(self._address)
+            try:
+                connection.connect(self._address)
+            except OSError as exc:
+                connection.close()
+                LOGGER.warning("Unable to connect to remote session at %s: %s" % (self._address, exc))
+                with self._condition:
+                    # Full jitter keeps a fleet of reconnecting bots from hammering the server in lockstep.
+                    self._condition.wait_for(lambda: not self._alive, random.uniform(0, delay))
+                delay = min(delay * 2, self._max_reconnect_delay)
+                continue
+            if not isinstance(self._address, str):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._condition:
+                self._connection = connection
+                self._connected = True
+            Thread(target=self._read_frames, args=(connection,), daemon=True).start()
+            LOGGER.info("Connected to remote session at %s." % (self._address,))
+            return True
+        return False
+
+    def _disconnect(self, connection: socket.socket = None) -> None:
+        with self._condition:
+            if connection is None:
+                connection = self._connection
+            elif connection is not self._connection:
+                return  # Already replaced.
+            self._connection = None
+            self._connected = False
+            self._condition.notify_all()
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+    def _next_batch(self) -> List[Tuple[int, bytes]]:
+        with self._condition:
+            self._condition.wait_for(lambda: not self._alive or not self._connected or bool(self._pending))
+            if not self._alive or not self._connected:
+                return []
+            batch = []
+            while self._pending and len(batch) < self._batch_size:
+                batch.append(self._pending.popleft())
+            return batch
+
+    def _write_frames(self) -> None:
+        while self._alive:
+            if not self._connected and not self._connect():
+                break
+            batch = self._next_batch()
+            if not batch:
+                continue
+            connection = self._connection
+            try:
+                if connection is None:
+                    raise OSError("Not connected.")
+                connection.sendall(encode_record_frames(batch))
+            except OSError:
+                LOGGER.warning("Lost connection to remote session at %s; reconnecting." % (self._address,))
+                with self._condition:
+                    # Put the batch back at the front of the queue, so it goes out first, in order, on reconnect.
+                    self._pending.extendleft(reversed(batch))
+                    while len(self._pending) > self._max_pending:
+                        self._pending.popleft()
+                        self._dropped += 1
+                self._disconnect(connection)
+
+    def _read_frames(self, connection: socket.socket) -> None:
+        try:
+            while True:
+                frame = read_frame(connection)
+                if frame is None:
+                    break
+                channel, signals = frame
+                with self._channels_lock:
+                    session = self._sessions.get(channel)
+                if session is None:
+                    LOGGER.warning("Dropping %s signal(s) for unknown remote channel %s." % (len(signals), channel))
+                    continue
+                # noinspection PyBroadException
+                try:
+                    if len(signals) == 1:
+                        session.send(signals[0])
+                    else:
+                        session.send_batch(signals)
+                except Exception:
+                    LOGGER.exception("Error sending signal from remote session.")
+        except OSError:
+            pass
+        except Exception:
+            LOGGER.exception("Error while reading from remote session.")
+        if self._alive:
+            LOGGER.warning("Connection to remote session at %s closed; reconnecting." % (self._address,))
+        self._disconnect(connection)
@@ -1,45 +1,37 @@
 import logging
-from itertools import chain
-from typing import Dict, Set
 
 from chatty.bots.interface import Bot
+from chatty.routing import RoutingTable
 from chatty.sessions.interface import Session
 from chatty.signals.interface import Signal
-from chatty.types import Handle
+from chatty.types import Handle, RouteType, RouteTypes
 
 
 LOGGER = logging.getLogger(__name__)
 
 
 class RouterBot(Bot):
-    """A bot router which directs each incoming signal to the correct bot(s) based on its metadata."""
+    """A bot router which directs each incoming signal to the correct bot(s) based on its metadata. Bots can be
+    registered by addressee/visible_to handle (the default), handle pattern, room, or origin; see
+    chatty.types.RouteTypes. Each matching bot receives a signal once, no matter how many of its routes match."""
 
-    def __init__(self):
+    def __init__(self, cache_size: int = 4096):
         super().__init__()
-        self._bot_map = {}  # type: Dict[Handle, Set[Bot]]
+        self._routes = RoutingTable(cache_size)
 
-    def register_bot(self, handle: Handle, bot: Bot):
-        if handle in self._bot_map:
-            self._bot_map[handle].add(bot)
-        else:
-            self._bot_map[handle] = {bot}
+    def register_bot(self, handle: Handle, bot: Bot, route_type: RouteType = RouteTypes.HANDLE):
+        self._routes.add(route_type, handle, bot)
 
-    def unregister_bot(self, handle: Handle, bot: Bot):
-        if handle in self._bot_map:
-            self._bot_map[handle].discard(bot)
-            if not self._bot_map[handle]:
-                del self._bot_map[handle]
+    def unregister_bot(self, handle: Handle, bot: Bot, route_type: RouteType = RouteTypes.HANDLE):
+        self._routes.remove(route_type, handle, bot)
 
     def receive(self, session: Session, signal: Signal):
-        mapped = False
-        for handle in chain(signal.meta_data.addressees, signal.meta_data.visible_to):
-            if handle in self._bot_map:
-                for bot in self._bot_map[handle]:
-                    # noinspection PyBroadException
-                    try:
-                        bot.receive(session, signal)
-                    except Exception:
-                        LOGGER.exception("Exception in bot router for handle %s" % handle)
-                    mapped = True
-        if not mapped:
+        bots = self._routes.resolve(signal.meta_data)
+        for bot in bots:
+            # noinspection PyBroadException
+            try:
+                bot.receive(session, signal)
+            except Exception:
+                LOGGER.exception("Exception in bot router for bot %s" % bot)
+        if not bots:
             LOGGER.warning("Unhandled signal in bot router:\n%s" % signal)
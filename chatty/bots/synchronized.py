@@ -1,48 +1,180 @@
 from collections import deque
-from threading import Thread, Condition
+import logging
+from threading import Thread, Condition, Lock
+from typing import Callable, Hashable, List
 
 from chatty.bots.interface import Bot
 from chatty.sessions.interface import Session
 from chatty.signals.interface import Signal
+from chatty.signals.status_change import StatusChange
+from chatty.types import OverflowPolicy, OverflowPolicies
+
+
+LOGGER = logging.getLogger(__name__)
+
+_OVERFLOW_POLICIES = frozenset([
+    OverflowPolicies.BLOCK,
+    OverflowPolicies.DROP_OLDEST,
+    OverflowPolicies.DROP_NEWEST,
+    OverflowPolicies.DROP_STATUS_CHANGES,
+])
+
+
+def get_conversation_key(signal: Signal) -> Hashable:
+    """Return the key identifying the conversation a signal belongs to: its room if it has one, otherwise its
+    origin."""
+    meta_data = signal.meta_data
+    return meta_data.room or meta_data.origin
+
+
+class _SignalQueue:
+    """A single signal queue, serviced by its own daemon thread, which passes each queued signal on to the wrapped
+    bot in the order it was queued. The lock is only held long enough to swap out the pending signals, never while
+    the wrapped bot is running, so producers are not held up by slow handlers. If a capacity is given, at most that
+    many signals will be pending at once, besides the one being handled, and the overflow policy decides what
+    happens to the excess. To keep to that bound, a bounded queue hands over its signals one at a time rather than
+    all at once."""
+
+    def __init__(self, wrapped: Bot, capacity: int = None, overflow_policy: OverflowPolicy = OverflowPolicies.BLOCK):
+        self._wrapped = wrapped
+        self._capacity = capacity
+        self._overflow_policy = overflow_policy
+        self._queue = deque()  # type: deque
+        self._lock = Lock()
+        self._signal_queued = Condition(self._lock)
+        self._space_available = Condition(self._lock)
+        self._dropped = 0
+        self._alive = True
+        self._thread = Thread(target=self._process_signals, daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self) -> bool:
+        return self._alive
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    def close(self) -> None:
+        with self._lock:
+            self._alive = False
+            self._signal_queued.notify()
+            self._space_available.notify_all()
+
+    def join(self, timeout: float = None) -> None:
+        self._thread.join(timeout)
+
+    def put(self, session: Session, signal: Signal) -> None:
+        with self._lock:
+            if self._capacity is not None and len(self._queue) >= self._capacity and not self._make_room(signal):
+                return
+            if self._alive:
+                self._queue.append((session, signal))
+                self._signal_queued.notify()
+
+    def _make_room(self, signal: Signal) -> bool:
+        # Must be called with the lock held. Returns whether the signal should still be queued.
+        if self._overflow_policy == OverflowPolicies.DROP_NEWEST:
+            self._dropped += 1
+            return False
+        if self._overflow_policy == OverflowPolicies.DROP_OLDEST:
+            self._queue.popleft()
+            self._dropped += 1
+            return True
+        if self._overflow_policy == OverflowPolicies.DROP_STATUS_CHANGES:
+            for index, (_, queued) in enumerate(self._queue):
+                if isinstance(queued, StatusChange):
+                    del self._queue[index]
+                    self._dropped += 1
+                    return True
+            if isinstance(signal, StatusChange):
+                self._dropped += 1
+                return False
+        self._space_available.wait_for(lambda: not self._alive or len(self._queue) < self._capacity)
+        return self._alive
+
+    def _process_signals(self):
+        while self._alive:
+            with self._lock:
+                self._signal_queued.wait_for(lambda: not self._alive or bool(self._queue))
+                if self._capacity is None:
+                    batch, self._queue = self._queue, deque()
+                else:
+                    # Signals taken out of the queue no longer count against the capacity, so only take one.
+                    batch = [self._queue.popleft()] if self._queue else []
+                self._space_available.notify_all()
+            for session, signal in batch:
+                if not self._alive:
+                    break
+                # noinspection PyBroadException
+                try:
+                    self._wrapped.receive(session, signal)
+                except Exception:
+                    LOGGER.exception("Error in Bot.receive().")
 
 
 class SynchronizedBot(Bot):
+    """
+    A bot wrapper which queues incoming signals and passes them to the wrapped bot from dedicated worker threads,
+    so sessions never call into the wrapped bot directly. By default, a single worker handles every signal. If more
+    than one worker is requested, each signal is assigned to a worker according to its conversation key (see
+    get_conversation_key()), so signals belonging to the same conversation are always handled in the order they were
+    received, while separate conversations are handled in parallel. Note that with more than one worker, the wrapped
+    bot must itself be safe to call from multiple threads at once.
+
+    By default, each worker's queue is unbounded. If a capacity is given, each worker holds at most that many
+    pending signals, plus the one it is handling, and the overflow policy (see chatty.types.OverflowPolicies)
+    determines whether the producer is blocked or a signal is dropped when a queue is full. Dropped signals are
+    counted in dropped_signals.
+    """
 
-    def __init__(self, wrapped: Bot):
+    def __init__(self, wrapped: Bot, workers: int = 1,
+                 conversation_key: Callable[[Signal], Hashable] = get_conversation_key, capacity: int = None,
+                 overflow_policy: OverflowPolicy = OverflowPolicies.BLOCK):
         super().__init__()
         self._wrapped = wrapped
-        self._queue = deque()
-        self._queue_thread = Thread(target=self._process_signals, daemon=True)
-        self._signal_queued = Condition()
+        self._conversation_key = conversation_key
+        self._queues = []  # type: List[_SignalQueue]
+        self._alive = False
+        if workers < 1:
+            raise ValueError(workers)
+        if capacity is not None and capacity < 1:
+            raise ValueError(capacity)
+        if overflow_policy not in _OVERFLOW_POLICIES:
+            raise ValueError(overflow_policy)
+        self._queues.extend(_SignalQueue(wrapped, capacity, overflow_policy) for _ in range(workers))
         self._alive = True
-        self._queue_thread.start()
 
     def __del__(self):
-        with self._signal_queued:
-            self._alive = False
-            self._signal_queued.notify()
-        self._queue_thread.join()
+        self.close()
+        for queue in self._queues:
+            queue.join()
 
     @property
     def wrapped(self) -> Bot:
         return self._wrapped
 
+    @property
+    def workers(self) -> int:
+        return len(self._queues)
+
+    @property
+    def dropped_signals(self) -> int:
+        """The total number of signals dropped so far due to queue overflow."""
+        return sum(queue.dropped for queue in self._queues)
+
     def close(self) -> None:
-        with self._signal_queued:
-            self._alive = False
-            self._signal_queued.notify()
+        self._alive = False
+        for queue in self._queues:
+            queue.close()
 
     def receive(self, session: Session, signal: Signal) -> None:
         if not self._alive:
             return
-        with self._signal_queued:
-            self._queue.append((session, signal))
-            self._signal_queued.notify()
+        self._select_queue(signal).put(session, signal)
 
-    def _process_signals(self):
-        with self._signal_queued:
-            while self._alive:
-                self._signal_queued.wait_for(lambda: not self._alive or bool(self._queue))
-                if self._alive and self._queue:
-                    session, signal = self._queue.popleft()
-                    self._wrapped.receive(session, signal)
+    def _select_queue(self, signal: Signal) -> _SignalQueue:
+        if len(self._queues) == 1:
+            return self._queues[0]
+        return self._queues[hash(self._conversation_key(signal)) % len(self._queues)]
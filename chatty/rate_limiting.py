@@ -0,0 +1,184 @@
+from collections import OrderedDict
+from threading import Event, Lock
+from typing import Hashable, Optional
+import time
+
+
+_EPSILON = 1e-9
+
+# When looking for buckets to discard, how many busy ones to skip over before giving up.
+_BUSY_BUCKETS_CHECKED = 2
+
+
+class TokenBucket:
+    """
+    A token bucket: tokens accumulate at the given rate (per second), up to burst tokens, and each operation spends
+    one. A full bucket allows a burst of operations back to back, after which they are paced at the rate. The bucket
+    can also be blocked outright until a given time, e.g. when a server says to retry after a delay. A rate of None
+    means no limit other than such blocks. Token buckets aren't thread-safe on their own; RateLimiter does the
+    locking.
+    """
+
+    def __init__(self, rate: Optional[float], burst: float = 1):
+        if rate is not None and rate <= 0:
+            raise ValueError(rate)
+        if burst < 1:
+            raise ValueError(burst)
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    @property
+    def burst(self) -> float:
+        return self._burst
+
+    def _refill(self, now: float) -> None:
+        if self._rate is None:
+            self._tokens = self._burst
+        elif now > self._updated:
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+    def is_idle(self, now: float) -> bool:
+        """Whether the bucket is full and unblocked, i.e. indistinguishable from a new one."""
+        self._refill(now)
+        return self._tokens >= self._burst and now >= self._blocked_until
+
+    def delay(self, now: float) -> float:
+        """Return how long until a token is available (zero if one is available now)."""
+        self._refill(now)
+        if self._rate is None:
+            return max(self._blocked_until - now, 0)
+        missing = 1 - self._tokens
+        if missing < _EPSILON:  # Don't make callers wait out floating point rounding errors.
+            missing = 0
+        return max(self._blocked_until - now, missing / self._rate, 0)
+
+    def spend(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+    def block(self, until: float) -> None:
+        """Allow no operations before the given (monotonic) time, and restart from an empty bucket after it."""
+        self._blocked_until = max(self._blocked_until, until)
+        self._tokens = 0
+        self._updated = max(self._updated, self._blocked_until)
+
+
+class RateLimiter:
+    """
+    Paces operations against both a global budget and a budget per destination (a channel, recipient, host, or
+    any other hashable key), each enforced by its own token bucket. An operation must wait until both its
+    destination's bucket and the global bucket have a token to spare. Either budget can be left out by passing None
+    for its rate. When the remote side reports that it is rate limiting us, call retry_after() to hold back
+    operations, for one destination or for all of them, for the time it asks.
+
+    Destination buckets are created as needed; ones which have refilled completely are discarded once there are
+    more than max_destinations of them, so the limiter's size tracks the number of recently active destinations.
+    Buckets are kept in order of last use, and only the least recently used few are checked each time, so this
+    costs the same however many destinations are busy.
+    """
+
+    def __init__(self, rate: float = None, burst: float = 1, destination_rate: float = None,
+                 destination_burst: float = 1, max_destinations: int = 1024):
+        self._lock = Lock()
+        self._global = None if rate is None else TokenBucket(rate, burst)
+        self._destination_rate = destination_rate
+        self._destination_burst = destination_burst
+        self._max_destinations = max_destinations
+        self._destinations = OrderedDict()  # type: OrderedDict[Hashable, TokenBucket]
+
+    @property
+    def destination_count(self) -> int:
+        """The number of destinations currently being tracked."""
+        return len(self._destinations)
+
+    def _discard_idle_buckets(self, now: float) -> None:
+        # Must be called with the lock held. Each bucket is only discarded once, and only a few busy ones are looked
+        # at, so the cost per call is constant on average. Busy buckets go to the back, so the next call looks at
+        # others.
+        if len(self._destinations) < self._max_destinations:
+            return
+        busy = 0
+        while self._destinations and busy < _BUSY_BUCKETS_CHECKED:
+            destination, bucket = next(iter(self._destinations.items()))
+            if bucket.is_idle(now):
+                del self._destinations[destination]
+            else:
+                self._destinations.move_to_end(destination)
+                busy += 1
+
+    def _get_bucket(self, destination: Hashable, now: float) -> Optional[TokenBucket]:
+        # Must be called with the lock held.
+        if destination is None:
+            return None
+        bucket = self._destinations.get(destination)
+        if bucket is not None:
+            self._destinations.move_to_end(destination)
+        if bucket is None and self._destination_rate is not None:
+            self._discard_idle_buckets(now)
+            bucket = self._destinations[destination] = TokenBucket(self._destination_rate, self._destination_burst)
+        elif bucket is not None and self._destination_rate is None and bucket.is_idle(now):
+            # Without per-destination budgets, a bucket only exists to hold the destination back after
+            # retry_after(), and that has expired.
+            del self._destinations[destination]
+            bucket = None
+        return bucket
+
+    def try_acquire(self, destination: Hashable = None) -> float:
+        """Take a token for an operation on the given destination if one is available now, returning zero. If not,
+        take nothing, and return how long to wait before trying again."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._get_bucket(destination, now)
+            delay = 0
+            if self._global is not None:
+                delay = self._global.delay(now)
+            if bucket is not None:
+                delay = max(delay, bucket.delay(now))
+            if delay <= 0:
+                if self._global is not None:
+                    self._global.spend(now)
+                if bucket is not None:
+                    bucket.spend(now)
+            return delay
+
+    def acquire(self, destination: Hashable = None, timeout: float = None, interrupted: Event = None) -> bool:
+        """Wait until an operation on the given destination is allowed, and take a token for it. Returns False,
+        without taking a token, if the timeout expires or the interrupted event is set first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.try_acquire(destination)
+            if delay <= 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            if interrupted is None:
+                time.sleep(delay)
+            elif interrupted.wait(delay):
+                return False
+
+    def retry_after(self, seconds: float, destination: Hashable = None) -> None:
+        """Hold back operations on the given destination, or on all destinations if none is given, for the given
+        number of seconds."""
+        now = time.monotonic()
+        with self._lock:
+            if destination is None:
+                if self._global is None:
+                    self._global = TokenBucket(None)
+                self._global.block(now + seconds)
+            else:
+                bucket = self._get_bucket(destination, now)
+                if bucket is None:
+                    self._discard_idle_buckets(now)
+                    bucket = self._destinations[destination] = TokenBucket(None)
+                bucket.block(now + seconds)
@@ -0,0 +1,165 @@
+from collections import OrderedDict
+from fnmatch import translate
+from itertools import chain
+from threading import Lock
+from typing import Dict, FrozenSet, Hashable, Iterable, List, Optional, Pattern, Set, Tuple
+import re
+
+from chatty.signals.metadata import SignalMetaData
+from chatty.types import Handle, RouteType, RouteTypes
+
+
+_WILDCARD_CHARACTERS = frozenset('*?[')
+
+
+class RoutingTable:
+    """
+    An index which maps signal metadata to the set of targets (bots or sessions) registered to receive it. Routes
+    can be keyed by room, by origin, by exact handle, or by handle pattern (see chatty.types.RouteTypes); a handle
+    route matches if the handle appears among the signal's addressees or visible_to. Patterns use shell-style
+    wildcards. Patterns of the form 'prefix*' are common enough that they are indexed by prefix instead of being
+    matched individually.
+
+    The targets resolved for each room, origin and set of addressees are cached, so repeated signals for the same
+    conversation resolve with a single lookup. The member list (visible_to) isn't part of the cache key, since
+    hashing it would cost as much as the lookup saves in a large room; each entry remembers the member list it was
+    built from instead, and is rebuilt if a signal arrives with a different one. Member lists are interned (see
+    chatty.signals.metadata.intern_handles), so this is usually an identity check. Signals without a room are keyed
+    by their member list as well. Any change to the routes invalidates the cache. Each target appears in the
+    resolved set once, however many of its routes match; resolve_matches() also reports the total number of matching
+    (route, target) pairs, which is how many deliveries a naive route-by-route walk would have made.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        self._lock = Lock()
+        # Route maps are copied on write, never modified in place, so lookups can proceed without locking.
+        self._routes = {route_type: {} for route_type in (RouteTypes.HANDLE, RouteTypes.PATTERN, RouteTypes.ROOM,
+                                                          RouteTypes.ORIGIN)}  # type: Dict[RouteType, Dict]
+        # Compiled pattern routes, as (prefix map, sorted prefix lengths, wildcard patterns). These are replaced
+        # together, rather than updated in place, so that concurrent lookups always see a consistent set.
+        self._patterns = ({}, (), ())  # type: Tuple[Dict[str, FrozenSet[Hashable]], Tuple[int, ...], tuple]
+        self._version = 0
+        self._cache_size = cache_size
+        self._cache = OrderedDict()  # type: OrderedDict[tuple, Tuple[Tuple[Handle, ...], FrozenSet[Hashable], int]]
+        self._cache_lock = Lock()
+
+    def add(self, route_type: RouteType, key: Handle, target: Hashable) -> None:
+        with self._lock:
+            routes = dict(self._get_routes(route_type))
+            routes[key] = routes.get(key, frozenset()) | {target}
+            self._update(route_type, routes)
+
+    def remove(self, route_type: RouteType, key: Handle, target: Hashable) -> None:
+        with self._lock:
+            routes = dict(self._get_routes(route_type))
+            if target in routes.get(key, ()):
+                routes[key] = routes[key] - {target}
+                if not routes[key]:
+                    del routes[key]
+                self._update(route_type, routes)
+
+    def targets(self, route_type: RouteType, key: Handle) -> FrozenSet[Hashable]:
+        """Return the targets registered directly under the given route."""
+        return self._get_routes(route_type).get(key, frozenset())
+
+    def resolve(self, meta_data: SignalMetaData) -> FrozenSet[Hashable]:
+        """Return the set of targets which should receive a signal with the given metadata."""
+        return self.resolve_matches(meta_data)[0]
+
+    def resolve_matches(self, meta_data: SignalMetaData) -> Tuple[FrozenSet[Hashable], int]:
+        """Return the set of targets which should receive a signal with the given metadata, together with the
+        number of (route, target) pairs which matched it."""
+        # The version is part of the cache key so that results computed against an outdated set of routes are
+        # never returned after a change.
+        version = self._version
+        room = meta_data.room
+        visible_to = meta_data.visible_to
+        addressees = frozenset(meta_data.addressees)
+        key = (version, room, meta_data.origin, addressees, frozenset(visible_to) if room is None else None)
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None and (entry[0] is visible_to or entry[0] == visible_to):
+                self._cache.move_to_end(key)
+                return entry[1:]
+        results, matches = self._resolve_uncached(room, meta_data.origin, addressees, visible_to)
+        if self._cache_size != 0:
+            with self._cache_lock:
+                self._cache[key] = (visible_to, results, matches)
+                self._cache.move_to_end(key)
+                if self._cache_size is not None and len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return results, matches
+
+    def _get_routes(self, route_type: RouteType) -> Dict[Handle, FrozenSet[Hashable]]:
+        if route_type not in self._routes:
+            raise ValueError(route_type)
+        return self._routes[route_type]
+
+    def _update(self, route_type: RouteType, routes: Dict[Handle, FrozenSet[Hashable]]) -> None:
+        # Must be called with the lock held.
+        all_routes = dict(self._routes)
+        all_routes[route_type] = routes
+        self._routes = all_routes
+        if route_type == RouteTypes.PATTERN:
+            self._compile_patterns()
+        self._version += 1
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _compile_patterns(self) -> None:
+        prefixes = {}  # type: Dict[str, Set[Hashable]]
+        wildcards = []  # type: List[Tuple[Pattern, FrozenSet[Hashable]]]
+        for pattern, targets in self._routes[RouteTypes.PATTERN].items():
+            if pattern.endswith('*') and not _WILDCARD_CHARACTERS.intersection(pattern[:-1]):
+                prefixes.setdefault(pattern[:-1], set()).update(targets)
+            else:
+                wildcards.append((re.compile(translate(pattern)), frozenset(targets)))
+        self._patterns = ({prefix: frozenset(targets) for prefix, targets in prefixes.items()},
+                          tuple(sorted({len(prefix) for prefix in prefixes})),
+                          tuple(wildcards))
+
+    def _resolve_uncached(self, room: Optional[Handle], origin: Optional[Handle], addressees: FrozenSet[Handle],
+                          visible_to: Tuple[Handle, ...]) -> Tuple[FrozenSet[Hashable], int]:
+        all_routes = self._routes
+        results = set()  # type: Set[Hashable]
+        matches = 0
+        rooms = all_routes[RouteTypes.ROOM]
+        if room is not None and room in rooms:
+            results.update(rooms[room])
+            matches += len(rooms[room])
+        origins = all_routes[RouteTypes.ORIGIN]
+        if origin is not None and origin in origins:
+            results.update(origins[origin])
+            matches += len(origins[origin])
+
+        exact = all_routes[RouteTypes.HANDLE]
+        for handle in chain(addressees, visible_to):
+            if handle in exact:
+                results.update(exact[handle])
+                matches += len(exact[handle])
+
+        prefixes, prefix_lengths, wildcards = self._patterns
+        if prefix_lengths or wildcards:
+            matches += self._match_patterns(frozenset(chain(addressees, visible_to)), prefixes, prefix_lengths,
+                                            wildcards, results)
+
+        return frozenset(results), matches
+
+    @staticmethod
+    def _match_patterns(handles: Iterable[Handle], prefixes: Dict[str, FrozenSet[Hashable]],
+                        prefix_lengths: Tuple[int, ...], wildcards: Tuple[Tuple[Pattern, FrozenSet[Hashable]], ...],
+                        results: Set[Hashable]) -> int:
+        matches = 0
+        for handle in handles:
+            for length in prefix_lengths:
+                if length > len(handle):
+                    break
+                targets = prefixes.get(handle[:length])
+                if targets:
+                    results.update(targets)
+                    matches += len(targets)
+            for pattern, targets in wildcards:
+                if pattern.match(handle):
+                    results.update(targets)
+                    matches += len(targets)
+        return matches
@@ -0,0 +1,93 @@
+from abc import ABCMeta, abstractmethod
+import asyncio
+import logging
+
+import chatty.bots.asynchronous
+import chatty.signals
+from chatty.sessions.interface import Session
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncSession(metaclass=ABCMeta):
+    """Abstract interface for bot sessions which run on an asyncio event loop instead of their own threads."""
+
+    def __init__(self):
+        self._bots = set()
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def join(self, timeout=None) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def send(self, signal: 'chatty.signals.interface.Signal') -> None:
+        raise NotImplementedError()
+
+    def add_bot(self, bot: 'chatty.bots.asynchronous.AsyncBot') -> None:
+        self._bots.add(bot)
+
+    def remove_bot(self, bot: 'chatty.bots.asynchronous.AsyncBot') -> None:
+        self._bots.remove(bot)
+
+    async def receive(self, signal: 'chatty.signals.interface.Signal') -> None:
+        # Each bot gets the signal concurrently, but since we wait for all of them to finish before returning, each
+        # bot still sees the session's signals in order.
+        results = await asyncio.gather(*[bot.receive(self, signal) for bot in self._bots], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                LOGGER.error("Error in AsyncBot.receive().", exc_info=result)
+
+
+class SyncSessionAdapter(Session):
+    """Presents an AsyncSession as an ordinary Session, so it can be handed to synchronous bots. The methods of this
+    class must not be called from the event loop's own thread, as they block until the corresponding coroutine
+    completes on the loop."""
+
+    def __init__(self, session: AsyncSession, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self._session = session
+        self._loop = loop
+
+    @property
+    def session(self) -> AsyncSession:
+        return self._session
+
+    def close(self) -> None:
+        # Closing the adapter doesn't close the underlying session; the adapter doesn't own it.
+        pass
+
+    def join(self, timeout=None) -> None:
+        asyncio.run_coroutine_threadsafe(self._session.join(timeout), self._loop).result()
+
+    def send(self, signal: 'chatty.signals.interface.Signal') -> None:
+        asyncio.run_coroutine_threadsafe(self._session.send(signal), self._loop).result()
+
+
+class AsyncSessionAdapter(AsyncSession):
+    """Presents an ordinary Session as an AsyncSession, so it can be handed to asynchronous bots. Blocking calls
+    into the wrapped session are run in an executor (the loop's default executor, unless one is given), so they
+    don't stall the event loop. Each call holds one of the executor's threads until it returns; see SyncBotAdapter
+    for what that means for replies which come straight back through the adapters."""
+
+    def __init__(self, session: Session, executor=None):
+        super().__init__()
+        self._session = session
+        self._executor = executor
+
+    @property
+    def session(self) -> Session:
+        return self._session
+
+    async def close(self) -> None:
+        # Closing the adapter doesn't close the underlying session; the adapter doesn't own it.
+        pass
+
+    async def join(self, timeout=None) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._session.join, timeout)
+
+    async def send(self, signal: 'chatty.signals.interface.Signal') -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._session.send, signal)
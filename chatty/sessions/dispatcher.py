@@ -0,0 +1,117 @@
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from threading import Condition, local
+from typing import Dict, Tuple
+import logging
+
+import chatty.bots.interface
+import chatty.sessions.interface
+import chatty.signals
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ParallelDispatcher:
+    """
+    Hands signals received by a session to its bots on an executor, instead of calling each bot in turn on the
+    session's own thread. Each bot sees its signals in the order the session received them, since at most one task
+    per bot is ever running at a time, but separate bots run in parallel and the session can go back to reading
+    events immediately. At most max_in_flight signals may be queued or running for any one bot; once a bot reaches
+    that limit, dispatching another signal to it blocks the session until the bot catches up. Signals dispatched
+    from the dispatcher's own threads, such as a bot's reply echoed straight back into a session, are queued without
+    waiting, even past the limit, since the thread that would make room may be the one waiting for it.
+
+    If no executor is provided, the dispatcher creates and owns a thread pool, which is shut down when the
+    dispatcher is closed. A single dispatcher may be shared by several sessions.
+    """
+
+    def __init__(self, executor: Executor = None, max_in_flight: int = 100):
+        if max_in_flight < 1:
+            raise ValueError(max_in_flight)
+        self._owns_executor = executor is None
+        self._executor = ThreadPoolExecutor() if executor is None else executor
+        self._max_in_flight = max_in_flight
+        self._pending = {}  # type: Dict[chatty.bots.interface.Bot, deque]
+        self._running = set()
+        self._handling = set()
+        self._condition = Condition()
+        self._local = local()
+        self._alive = True
+
+    @property
+    def max_in_flight(self) -> int:
+        return self._max_in_flight
+
+    def in_flight(self, bot: 'chatty.bots.interface.Bot') -> int:
+        """Return the number of signals queued or being handled for the given bot."""
+        with self._condition:
+            return self._count(bot)
+
+    def close(self, wait: bool = True) -> None:
+        with self._condition:
+            self._alive = False
+            self._condition.notify_all()
+        if self._owns_executor:
+            self._executor.shutdown(wait=wait)
+
+    def dispatch(self, session: 'chatty.sessions.interface.Session', bot: 'chatty.bots.interface.Bot',
+                 signal: 'chatty.signals.interface.Signal') -> None:
+        with self._condition:
+            if not getattr(self._local, 'draining', False):
+                self._condition.wait_for(lambda: not self._alive or self._count(bot) < self._max_in_flight)
+            if not self._alive:
+                return
+            pending = self._pending.get(bot)
+            if pending is None:
+                pending = self._pending[bot] = deque()
+            pending.append((session, signal))
+            if bot in self._running:
+                return
+            self._running.add(bot)
+        try:
+            self._executor.submit(self._drain, bot)
+        except RuntimeError:
+            # The executor was shut down after the check above, so the signal is dropped, as it would have been
+            # if close() had come first.
+            LOGGER.warning("Dropping signal dispatched while closing.")
+            with self._condition:
+                self._pending.pop(bot, None)
+                self._running.discard(bot)
+                self._condition.notify_all()
+
+    def _count(self, bot: 'chatty.bots.interface.Bot') -> int:
+        # Must be called with the lock held.
+        pending = self._pending.get(bot)
+        return (len(pending) if pending else 0) + (bot in self._handling)
+
+    def _next(self, bot: 'chatty.bots.interface.Bot') -> Tuple['chatty.sessions.interface.Session',
+                                                             'chatty.signals.interface.Signal']:
+        # Also marks the previous signal, if any, as handled.
+        with self._condition:
+            self._handling.discard(bot)
+            pending = self._pending.get(bot)
+            if not self._alive or not pending:
+                self._pending.pop(bot, None)
+                self._running.discard(bot)
+                self._condition.notify_all()
+                return None, None
+            item = pending.popleft()
+            self._handling.add(bot)
+            self._condition.notify_all()
+            return item
+
+    def _drain(self, bot: 'chatty.bots.interface.Bot') -> None:
+        self._local.draining = True
+        try:
+            while True:
+                session, signal = self._next(bot)
+                if session is None:
+                    return
+                # noinspection PyBroadException
+                try:
+                    bot.receive(session, signal)
+                except Exception:
+                    LOGGER.exception("Error in Bot.receive().")
+        finally:
+            self._local.draining = False
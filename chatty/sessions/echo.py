@@ -1,5 +1,7 @@
+import asyncio
 import time
 
+from chatty.sessions.asynchronous import AsyncSession
 from chatty.sessions.interface import Session
 from chatty.signals.interface import Signal
 
@@ -25,3 +27,25 @@ class EchoSession(Session):
 
     def send(self, signal: Signal) -> None:
         self.receive(signal)
+
+
+class AsyncEchoSession(AsyncSession):
+    """
+    An asynchronous session which simply echos any signal it is asked to send back to its own bots.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._closed = asyncio.Event()
+
+    async def close(self):
+        self._closed.set()
+
+    async def join(self, timeout=None) -> None:
+        try:
+            await asyncio.wait_for(self._closed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def send(self, signal: Signal) -> None:
+        await self.receive(signal)
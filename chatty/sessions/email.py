@@ -1,12 +1,21 @@
-from email import message_from_bytes
+from concurrent.futures import ThreadPoolExecutor
 # noinspection PyProtectedMember
-from email.message import EmailMessage, MIMEPart
+from email.message import EmailMessage, MIMEPart, Message as EmailMessageBase
+from email.parser import BytesHeaderParser, BytesParser
+from email.policy import compat32
 from email.utils import parsedate_to_datetime
-from typing import Callable, Type
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type, Union
 import datetime
+import heapq
 import imaplib
+import json
 import logging
+import os
+import re
+import select
 import smtplib
+import socket
+import tempfile
 import threading
 import time
 
@@ -18,7 +27,7 @@ from chatty.signals.interface import Signal
 from chatty.signals.message import Message
 from chatty.signals.delivery_failure import DeliveryFailure
 from chatty.signals.metadata import SignalMetaData
-from chatty.types import LoginConfig
+from chatty.types import ErrorCode, LoginConfig
 
 
 LOGGER = logging.getLogger(__name__)
@@ -51,19 +60,565 @@ def parse_email_datetime(value, default=None):
     return result
 
 
-def is_delivery_status_notification(message: EmailMessage) -> bool:
-    # noinspection SpellCheckingInspection
-    """See https://stackoverflow.com/questions/5298285/""" \
-        """detecting-if-an-email-is-a-delivery-status-notification-and-extract-informatio
-    for details on how to detect delivery status notifications.
+# The header-level signs of a delivery status notification, applied to unfolded header values. See
+# https://stackoverflow.com/questions/5298285/detecting-if-an-email-is-a-delivery-status-notification-and-extract-informatio
+_DSN_HEADER_RULES = {
+    'from': re.compile(r'mailer-daemon@', re.IGNORECASE).search,
+    'x-failed-recipients': re.compile(r'\S').search,
+    'content-type': re.compile(r'\s*(multipart/report|[^;\s]*delivery-status)', re.IGNORECASE).match,
+    'action': re.compile(r'\s*failed\s*$', re.IGNORECASE).match,
+    'subject': re.compile(r'\s*delivery status notification', re.IGNORECASE).match,
+}
+
+_HEADER_END = re.compile(br'\r?\n\r?\n')
+_HEADER_FOLD = re.compile(br'\r?\n[ \t]+')
+_MAX_LINE = 2 ** 16
+
+
+def has_delivery_status_headers(headers: Union[bytes, EmailMessageBase]) -> bool:
+    """
+    Check whether a message's headers mark it as a delivery status notification, without looking at its body.
+    The headers can be given either as a message or as raw bytes, e.g. as fetched with BODY.PEEK[HEADER]; anything
+    after the first blank line is ignored. This catches almost all bounces, so is_delivery_status_notification()
+    only needs the body for the rest.
+    """
+    if isinstance(headers, EmailMessageBase):
+        items = headers.items()
+    else:
+        match = _HEADER_END.search(headers)
+        if match is not None:
+            headers = headers[:match.start()]
+        items = (line.partition(b':')[::2] for line in _HEADER_FOLD.sub(b' ', headers).splitlines())
+        items = ((name.decode('latin-1'), value.decode('latin-1')) for name, value in items)
+    for name, value in items:
+        rule = _DSN_HEADER_RULES.get(name.strip().lower())
+        if rule is not None and rule(str(value)):
+            return True
+    return False
+
+
+def is_delivery_status_notification(message: EmailMessageBase) -> bool:
+    """Check whether a message is a delivery status notification, first by its headers (see
+    has_delivery_status_headers()), then by looking for a top-level delivery-status part. The parts of a
+    LazyEmailMessage are checked without parsing its body."""
+    if has_delivery_status_headers(message):
+        return True
+    if message.get_content_maintype() != 'multipart':
+        return False
+    if isinstance(message, LazyEmailMessage):
+        parts = message.iter_part_headers()
+    else:
+        parts = (part for part in message.get_payload() if not isinstance(part, str))
+    return any('delivery-status' in part.get_content_type() for part in parts)
+
+
+class LazyEmailMessage(EmailMessageBase):
+    """
+    An email message whose headers are parsed up front, but whose body is only parsed when something actually
+    touches it. Until then, the raw message is held in a spooled temporary file, which is moved to disk once it
+    exceeds spool_threshold bytes, so that large attachments don't sit in memory while the signal waits to be
+    handled, or when the bot never looks at them. Header access, get_content_type() and as_bytes() don't trigger
+    parsing; anything that reaches the payload (get_payload(), walk(), is_multipart(), etc.) does, once. If the
+    headers are changed before then, as_bytes() gives the current headers followed by the original body.
+    """
+
+    def __init__(self, raw: bytes, headers: bytes = None, spool_threshold: int = 2 ** 20):
+        super().__init__()
+        match = _HEADER_END.search(raw)
+        self._body_offset = len(raw) if match is None else match.end()
+        self._linesep = '\r\n' if match is not None and match.group().startswith(b'\r') else '\n'
+        if headers is None:
+            headers = raw[:self._body_offset]
+        parsed = BytesHeaderParser().parsebytes(headers)
+        self._headers = parsed._headers
+        self._original_headers = list(parsed._headers)
+        self._unixfrom = parsed._unixfrom
+        self.defects = parsed.defects
+        # Bots may read the same signal from several threads at once, so every access to the shared spool, and the
+        # switch from spooled to parsed, happens under this lock.
+        self._spool_lock = threading.Lock()
+        self._spool = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        self._spool.write(raw)
+
+    @property
+    def parsed(self) -> bool:
+        """Whether the body has been parsed yet."""
+        return self.__dict__.get('_spool') is None
+
+    @property
+    def _payload(self):
+        if not self.parsed:
+            self._parse()
+        return self.__dict__['_lazy_payload']
+
+    @_payload.setter
+    def _payload(self, value) -> None:
+        self.__dict__['_lazy_payload'] = value
+
+    def _parse(self) -> None:
+        with self._spool_lock:
+            if self.parsed:
+                return
+            spool = self._spool
+            spool.seek(0)
+            message = BytesParser().parse(spool)
+            self._payload = message._payload
+            self._charset = message._charset
+            self._default_type = message._default_type
+            self.preamble = message.preamble
+            self.epilogue = message.epilogue
+            self.defects = message.defects
+            self._spool = None
+            spool.close()
+
+    def iter_part_headers(self) -> Iterator[EmailMessageBase]:
+        """For a multipart message, yield the top-level parts, with headers only unless the body has already been
+        parsed. The part headers are read line by line from the spooled raw message, and the contents of the parts,
+        including any nested messages, are skipped over."""
+        if self.parsed:
+            if self.is_multipart():
+                yield from (part for part in self.get_payload() if not isinstance(part, str))
+            return
+        boundary = self.get_boundary()
+        if boundary is None or self.get_content_maintype() != 'multipart':
+            return
+        delimiter = b'--' + boundary.encode('latin-1')
+        parser = BytesHeaderParser()
+        with self._spool_lock:
+            if self.parsed:
+                header_blocks = None
+            else:
+                header_blocks = self._read_part_headers(delimiter)
+        if header_blocks is None:
+            # The body was parsed by another thread in the meantime.
+            yield from self.iter_part_headers()
+            return
+        for headers in header_blocks:
+            yield parser.parsebytes(headers)
+
+    def _read_part_headers(self, delimiter: bytes) -> List[bytes]:
+        # Called with the spool lock held. Only the part headers are kept, so this stays small however large the
+        # parts are.
+        spool = self._spool
+        spool.seek(self._body_offset)
+        header_blocks = []  # type: List[bytes]
+        headers = None  # type: Optional[List[bytes]]
+        at_line_start = True
+        for line in iter(lambda: spool.readline(_MAX_LINE), b''):
+            line_start, at_line_start = at_line_start, line.endswith(b'\n')
+            if headers is not None:
+                if line_start and not line.strip():
+                    header_blocks.append(b''.join(headers))
+                    headers = None
+                else:
+                    headers.append(line)
+            elif line_start and line.startswith(delimiter):
+                rest = line[len(delimiter):].strip()
+                if rest == b'--':
+                    break
+                if not rest:
+                    headers = []
+        return header_blocks
+
+    def as_bytes(self, unixfrom=False, policy=None) -> bytes:
+        if not (self.parsed or unixfrom or policy is not None):
+            with self._spool_lock:
+                if not self.parsed:
+                    return self._raw_bytes()
+        return super().as_bytes(unixfrom, policy)
+
+    def _raw_bytes(self) -> bytes:
+        # Called with the spool lock held. Hand back the original bytes, rather than parsing the message just to
+        # serialize it again.
+        if self._headers == self._original_headers:
+            self._spool.seek(0)
+            return self._spool.read()
+        # The headers have been changed, so serialize them as they are now, in front of the original body.
+        policy = compat32.clone(linesep=self._linesep)
+        header_bytes = b''.join(policy.fold_binary(name, value) for name, value in self._headers)
+        self._spool.seek(self._body_offset)
+        return header_bytes + self._linesep.encode('ascii') + self._spool.read()
+
+    def __getstate__(self):
+        if not self.parsed:
+            self._parse()
+        state = dict(self.__dict__)
+        del state['_spool_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._spool_lock = threading.Lock()
+
+
+_MAILBOX_CHANGE = re.compile(br'^\* \d+ (EXISTS|RECENT)\b', re.IGNORECASE)
+
+
+def imap_supports_idle(connection: imaplib.IMAP4) -> bool:
+    """Return whether the IMAP server advertises the IDLE capability (RFC 2177)."""
+    return 'IDLE' in getattr(connection, 'capabilities', ())
+
+
+def _has_buffered_input(connection: imaplib.IMAP4, sock: socket.socket) -> bool:
+    # imaplib reads through a buffered file object, and an SSL socket keeps its own buffer of decrypted data.
+    # Either may already hold responses that select() won't report, because they have left the kernel's buffer.
+    pending = getattr(sock, 'pending', None)
+    if pending is not None and pending():
+        return True
+    file = getattr(connection, 'file', None)
+    if file is None or not hasattr(file, 'peek'):
+        return False
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(file.peek(1))
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def imap_idle(connection: imaplib.IMAP4, timeout: float, interrupted: threading.Event = None) -> bool:
     """
-    # https://stackoverflow.com/questions/5298285/detecting-if-an-email-is-a-delivery-status-notification-and-extract-informatio
-    return bool('mailer-daemon@' in message['from'].lower() or message['x-failed-recipients'] or
-                'multipart/report' in message.get_content_type() or 'delivery-status' in message.get_content_type() or
-                (message['action'] or '').lower() == 'failed' or
-                (message['subject'] or '').lower().startswith('delivery status notification') or
-                any('delivery-status' in part.get_content_type() for part in message.get_payload()
-                    if not isinstance(part, str)))
+    Put the connection into IDLE mode (RFC 2177) and wait until the server reports a change to the selected mailbox,
+    the timeout expires, or the interrupted event is set, whichever comes first. Then end the IDLE command and return
+    whether the mailbox changed. The connection must already have a mailbox selected.
+    """
+    # imaplib has no support for IDLE, so we speak the protocol directly.
+    # noinspection PyProtectedMember
+    tag = connection._new_tag()
+    connection.send(tag + b' IDLE\r\n')
+    response = connection.readline()
+    if not response.startswith(b'+'):
+        raise connection.error("Unexpected response to IDLE command: %r" % response)
+
+    sock = connection.socket()
+    deadline = time.monotonic() + timeout
+    changed = False
+    while not changed and not (interrupted is not None and interrupted.is_set()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not _has_buffered_input(connection, sock) and not select.select([sock], [], [], min(remaining, 1))[0]:
+            continue
+        line = connection.readline()
+        if not line:
+            raise connection.abort("Connection closed during IDLE.")
+        changed = bool(_MAILBOX_CHANGE.match(line))
+
+    connection.send(b'DONE\r\n')
+    while True:
+        line = connection.readline()
+        if not line:
+            raise connection.abort("Connection closed while ending IDLE.")
+        if line.startswith(tag + b' '):
+            if not line[len(tag) + 1:].upper().startswith(b'OK'):
+                raise connection.error("Unexpected response to IDLE command: %r" % line)
+            return changed
+        changed = changed or bool(_MAILBOX_CHANGE.match(line))
+
+
+def imap_uid_validity(connection: imaplib.IMAP4) -> Optional[int]:
+    """Return the UIDVALIDITY of the selected mailbox, as reported by the server when the mailbox was selected, or
+    None if it isn't known. This consumes the untagged response, so it only works once per selection."""
+    _, data = connection.response('UIDVALIDITY')
+    if not data or data[-1] is None:
+        return None
+    return int(data[-1])
+
+
+_FETCH_UID = re.compile(br'\bUID (\d+)', re.IGNORECASE)
+_FETCH_SIZE = re.compile(br'\bRFC822\.SIZE (\d+)', re.IGNORECASE)
+
+
+def imap_uid_set(uids: Iterable[int]) -> str:
+    """Format UIDs as a compact IMAP sequence set, e.g. [1, 2, 3, 7] becomes '1:3,7'."""
+    ranges = []  # type: List[List[int]]
+    for uid in sorted(uids):
+        if ranges and uid <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(uid, ranges[-1][1])
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(start) if start == end else '%d:%d' % (start, end) for start, end in ranges)
+
+
+def _imap_fetch_responses(connection: imaplib.IMAP4, uids: Iterable[int],
+                          query: str) -> Iterator[Tuple[int, bytes, bytes]]:
+    # Yield the UID, response line and data for each message fetched.
+    result, data = connection.uid('fetch', imap_uid_set(uids), query)
+    if result != 'OK':
+        raise RuntimeError("Unexpected response to fetch command: %s" % result)
+    for item in data:
+        # Each message comes back as a (b'<seq> (UID <uid> <item> {<size>}', <data>) pair, followed by b')'.
+        if not isinstance(item, tuple):
+            continue
+        match = _FETCH_UID.search(item[0])
+        if match:
+            yield int(match.group(1)), item[0], item[1]
+
+
+def imap_fetch(connection: imaplib.IMAP4, uids: Iterable[int], query: str) -> Dict[int, bytes]:
+    """Fetch a single data item for a set of messages in one round trip, returning the data by UID. The query should
+    request the UID along with the data item, e.g. '(UID BODY.PEEK[HEADER])'. Messages which have been expunged in
+    the meantime are simply missing from the result."""
+    return {uid: value for uid, _, value in _imap_fetch_responses(connection, uids, query)}
+
+
+def imap_fetch_headers(connection: imaplib.IMAP4, uids: Iterable[int]) -> Dict[int, Tuple[bytes, int]]:
+    """Fetch the headers and total size of a set of messages in one round trip, returning (headers, size) pairs by
+    UID."""
+    fetched = {}
+    for uid, response, headers in _imap_fetch_responses(connection, uids, '(UID RFC822.SIZE BODY.PEEK[HEADER])'):
+        match = _FETCH_SIZE.search(response)
+        fetched[uid] = headers, int(match.group(1)) if match else len(headers)
+    return fetched
+
+
+def group_by_size(uids: Iterable[int], sizes: Dict[int, int], limit: int) -> Iterator[List[int]]:
+    """Split the UIDs, in order, into groups whose sizes add up to no more than the limit. A message larger than the
+    limit gets a group of its own."""
+    group = []  # type: List[int]
+    total = 0
+    for uid in uids:
+        if group and total + sizes[uid] > limit:
+            yield group
+            group = []
+            total = 0
+        group.append(uid)
+        total += sizes[uid]
+    if group:
+        yield group
+
+
+class IMAPSyncCheckpoint:
+    """
+    Tracks how far an IMAP mailbox has been synchronized: the highest message UID already processed, together with
+    the mailbox's UIDVALIDITY, which the server changes whenever previously assigned UIDs can no longer be trusted.
+    If a path is given, the checkpoint is loaded from it on construction and written back to it by save(), so that
+    a restarted session picks up where the last one left off.
+    """
+
+    def __init__(self, path: str = None):
+        self._path = path
+        self.uid_validity = None  # type: Optional[int]
+        self.last_uid = None  # type: Optional[int]
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+            self.uid_validity = state.get('uid_validity')
+            self.last_uid = state.get('last_uid')
+
+    @property
+    def path(self) -> Optional[str]:
+        return self._path
+
+    def validate(self, uid_validity: Optional[int]) -> bool:
+        """Check the checkpoint against the mailbox's current UIDVALIDITY, discarding the processed UID if it no
+        longer applies. Returns whether the checkpoint is still valid."""
+        if uid_validity == self.uid_validity:
+            return True
+        if self.last_uid is not None:
+            LOGGER.warning("IMAP UIDVALIDITY changed from %s to %s; resynchronizing." %
+                           (self.uid_validity, uid_validity))
+        self.uid_validity = uid_validity
+        self.last_uid = None
+        return False
+
+    def save(self) -> None:
+        if self._path is None:
+            return
+        # Write to a temporary file and swap it into place, so a crash can't leave a truncated checkpoint behind.
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'uid_validity': self.uid_validity, 'last_uid': self.last_uid}, file)
+        os.replace(temp_path, self._path)
+
+
+class SMTPConnectionPool:
+    """
+    A pool of long-lived, authenticated SMTP connections, so that sending a message doesn't require a fresh
+    handshake and login each time. Connections are created on demand by the factory (e.g. an SMTPFactory), up to
+    the pool's size, and reused for up to max_messages messages each. Idle connections are sent a NOOP every
+    keepalive_interval seconds, so that the server doesn't time them out, and are closed if the server has dropped
+    them anyway. A connection which has sat idle for longer than keepalive_interval seconds is also checked with a
+    NOOP before it is reused, and replaced if need be. (A keepalive_interval of 0 checks connections every time they
+    are reused, without the periodic NOOPs.) If the server disconnects in the middle of a send, the message is
+    retried once on a new connection.
+    """
+
+    class _Entry:
+
+        def __init__(self, connection: smtplib.SMTP):
+            self.connection = connection
+            self.last_used = time.monotonic()
+            self.messages_sent = 0
+
+    def __init__(self, smtp_factory: Callable[[], smtplib.SMTP], size: int = 2, keepalive_interval: float = 30,
+                 max_messages: int = 100):
+        if size < 1:
+            raise ValueError(size)
+        self._smtp_factory = smtp_factory
+        self._keepalive_interval = keepalive_interval
+        self._max_messages = max_messages
+        self._size = size
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []  # type: List[SMTPConnectionPool._Entry]
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stopped = threading.Event()
+        self._keepalive_thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def idle_connections(self) -> int:
+        return len(self._idle)
+
+    def close(self) -> None:
+        self._stopped.set()
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            keepalive_thread = self._keepalive_thread
+        for entry in idle:
+            self._quit(entry)
+        if keepalive_thread is not None and keepalive_thread is not threading.current_thread():
+            keepalive_thread.join(1)
+
+    def send_message(self, message: MIMEPart, to_addrs: List[str] = None) -> Dict[str, Tuple[int, bytes]]:
+        """Send a message, returning any recipients the server refused, as smtplib.SMTP.send_message() does."""
+        return self._send(lambda connection: connection.send_message(message, to_addrs=to_addrs))
+
+    def send_messages(self, messages: Iterable[MIMEPart]) -> List[Union[Dict[str, Tuple[int, bytes]], Exception]]:
+        """Send several messages back to back over a single connection, rather than checking a connection out of
+        the pool for each one. Return, for each message in turn, either the recipients the server refused or the
+        exception which prevented it from being sent; a failure doesn't stop the messages after it."""
+        return self._send_all([lambda connection, message=message: connection.send_message(message)
+                               for message in messages])
+
+    def sendmail(self, from_addr: str, to_addrs: List[str], message: bytes) -> Dict[str, Tuple[int, bytes]]:
+        """Send an already serialized message, returning any recipients the server refused, as
+        smtplib.SMTP.sendmail() does."""
+        return self._send(lambda connection: connection.sendmail(from_addr, to_addrs, message))
+
+    def _send(self, operation: Callable[[smtplib.SMTP], Dict[str, Tuple[int, bytes]]]) -> Dict[str, Tuple[int, bytes]]:
+        result = self._send_all([operation])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _send_all(self, operations: List[Callable[[smtplib.SMTP], Dict[str, Tuple[int, bytes]]]]) \
+            -> List[Union[Dict[str, Tuple[int, bytes]], Exception]]:
+        results = []  # type: List[Union[Dict[str, Tuple[int, bytes]], Exception]]
+        with self._slots:
+            entry = None  # type: Optional[SMTPConnectionPool._Entry]
+            try:
+                for operation in operations:
+                    try:
+                        if entry is None:
+                            entry = self._check_out()
+                        try:
+                            refused = operation(entry.connection)
+                        except smtplib.SMTPServerDisconnected:
+                            LOGGER.info("SMTP server disconnected; retrying on a new connection.")
+                            self._quit(entry)
+                            entry = None
+                            entry = self._Entry(self._smtp_factory())
+                            refused = operation(entry.connection)
+                    except (smtplib.SMTPServerDisconnected, OSError) as exc:
+                        if entry is not None:
+                            self._quit(entry)
+                            entry = None
+                        results.append(exc)
+                        continue
+                    except smtplib.SMTPException as exc:
+                        # The message was rejected, but the connection should still be usable once it's reset.
+                        try:
+                            entry.connection.rset()
+                        except (smtplib.SMTPException, OSError):
+                            self._quit(entry)
+                            entry = None
+                        results.append(exc)
+                        continue
+                    entry.messages_sent += 1
+                    results.append(refused)
+                    if entry.messages_sent >= self._max_messages:
+                        self._quit(entry)
+                        entry = None
+            except BaseException:
+                if entry is not None:
+                    self._quit(entry)
+                raise
+            if entry is not None:
+                self._check_in(entry)
+        return results
+
+    def _check_out(self) -> 'SMTPConnectionPool._Entry':
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise smtplib.SMTPServerDisconnected("Connection pool is closed.")
+                entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                return self._Entry(self._smtp_factory())
+            if time.monotonic() - entry.last_used < self._keepalive_interval:
+                return entry
+            try:
+                code, _ = entry.connection.noop()
+            except (smtplib.SMTPException, OSError):
+                code = None
+            if code == 250:
+                return entry
+            LOGGER.info("Discarding stale SMTP connection.")
+            self._quit(entry)
+
+    def _check_in(self, entry: 'SMTPConnectionPool._Entry') -> None:
+        if entry.messages_sent >= self._max_messages:
+            self._quit(entry)
+            return
+        entry.last_used = time.monotonic()
+        with self._lock:
+            if not self._closed:
+                self._idle.append(entry)
+                if self._keepalive_thread is None and self._keepalive_interval > 0:
+                    self._keepalive_thread = threading.Thread(target=self._keepalive_main, daemon=True)
+                    self._keepalive_thread.start()
+                return
+        self._quit(entry)
+
+    def _keepalive_main(self) -> None:
+        while not self._stopped.wait(self._keepalive_interval):
+            # Take the connections that are due out of the pool while they are checked, so nothing else uses them.
+            now = time.monotonic()
+            with self._lock:
+                if self._closed:
+                    return
+                due = [entry for entry in self._idle if now - entry.last_used >= self._keepalive_interval]
+                self._idle = [entry for entry in self._idle if now - entry.last_used < self._keepalive_interval]
+            for entry in due:
+                try:
+                    code, _ = entry.connection.noop()
+                except (smtplib.SMTPException, OSError):
+                    code = None
+                if code != 250:
+                    LOGGER.info("Discarding stale SMTP connection.")
+                    self._quit(entry)
+                    continue
+                entry.last_used = time.monotonic()
+                with self._lock:
+                    if not self._closed:
+                        self._idle.append(entry)
+                        continue
+                self._quit(entry)
+
+    @staticmethod
+    def _quit(entry: 'SMTPConnectionPool._Entry') -> None:
+        try:
+            entry.connection.quit()
+        except (smtplib.SMTPException, OSError):
+            entry.connection.close()
 
 
 class EmailSession(Session):
@@ -71,7 +626,29 @@ class EmailSession(Session):
     An SMTP/IMAP4 email session. The smtp_factory and imap_factory arguments should be functions which
     take no arguments and return fully initialized SMTP and IMAP4 connections, respectively. Connections should
     already be authenticated before being returned, and the IMAP4 connection should have the appropriate folder
-    selected.
+    selected. Outbound SMTP connections are kept open and reused, up to smtp_pool_size at a time; see
+    SMTPConnectionPool.
+
+    Messages with more than max_recipients recipients are sent in several SMTP transactions, each to a batch of at
+    most that many recipients, spread across the pooled connections in parallel. Recipients the server refuses
+    are reported to the bots as DeliveryFailure signals, rather than causing the whole send to fail.
+
+    If the IMAP server supports IDLE (and use_idle is set), new mail is picked up as soon as it arrives; the IDLE
+    command is renewed every idle_renewal seconds, well inside the 29 minutes servers are required to allow.
+    Otherwise the mailbox is polled, starting every min_rate seconds and backing off to every rate seconds while no
+    new mail arrives.
+
+    Only mail newer than the highest UID already processed is fetched. If checkpoint_path is given, that UID is
+    saved there (see IMAPSyncCheckpoint), and a restarted session skips mail it has already processed rather than
+    going back to the starting date. New mail is fetched in batches of up to fetch_batch_size messages, headers
+    first, so that the bodies of messages sent before the starting date are never downloaded. Messages are
+    delivered as LazyEmailMessages, which only parse their bodies on demand, spooling any larger than
+    spool_threshold bytes to disk in the meantime. Bodies are downloaded in groups of at most spool_threshold bytes
+    in all, going by the sizes reported with the headers, or one at a time if they are larger than that.
+
+    By default each session reads mail on a thread of its own. To monitor many mailboxes, pass a shared
+    IMAPScheduler instead, and the mailbox will be polled by the scheduler's workers. (IDLE isn't used in that
+    case, as it would tie up a worker for each mailbox.)
     """
 
     @classmethod
@@ -93,24 +670,111 @@ class EmailSession(Session):
         return Message(meta_data, message)
 
     def __init__(self, smtp_factory: Callable[[], smtplib.SMTP], imap_factory: Callable[[], imaplib.IMAP4],
-                 starting: datetime.datetime = None, rate: float = 300):
+                 starting: datetime.datetime = None, rate: float = 300, smtp_pool_size: int = 2,
+                 use_idle: bool = True, idle_renewal: float = 600, min_rate: float = 5, checkpoint_path: str = None,
+                 fetch_batch_size: int = 100, spool_threshold: int = 2 ** 20, scheduler: 'IMAPScheduler' = None,
+                 max_recipients: int = 100):
         super().__init__()
-        self._smtp_factory = smtp_factory
+        self._smtp_pool = SMTPConnectionPool(smtp_factory, smtp_pool_size)
+        self._max_recipients = max_recipients
+        self._bulk_executor = None  # type: Optional[ThreadPoolExecutor]
+        self._bulk_executor_lock = threading.Lock()
         self._imap_factory = imap_factory
         self._starting = datetime.datetime.now(tzlocal.get_localzone()) if starting is None else starting
         self._rate = rate
-        self._imap_thread = threading.Thread(target=self._imap_thread_main, daemon=True)
+        self._min_rate = min(min_rate, rate)
+        self._use_idle = use_idle
+        self._idle_renewal = idle_renewal
+        self._checkpoint = IMAPSyncCheckpoint(checkpoint_path)
+        self._fetch_batch_size = fetch_batch_size
+        self._spool_threshold = spool_threshold
+        self._stopped = threading.Event()
+        self._scheduler = scheduler
+        self._imap_connection = None  # type: Optional[imaplib.IMAP4]
+        self._imap_lock = threading.Lock()
         self._alive = True
-        self._imap_thread.start()
+        if scheduler is None:
+            self._imap_thread = threading.Thread(target=self._imap_thread_main, daemon=True)
+            self._imap_thread.start()
+        else:
+            self._imap_thread = None
+            scheduler.add(self)
 
     def close(self):
         self._alive = False
-        self._imap_thread.join(timeout=1)
+        self._stopped.set()
+        if self._bulk_executor is not None:
+            self._bulk_executor.shutdown()
+        self._smtp_pool.close()
+        if self._imap_thread is None:
+            self._scheduler.remove(self)
+            with self._imap_lock:  # Wait for any poll in progress to finish.
+                self._disconnect_imap()
+        else:
+            self._imap_thread.join(timeout=1)
 
     def join(self, timeout=None):
-        self._imap_thread.join(timeout)
+        if self._imap_thread is None:
+            self._stopped.wait(timeout)
+        else:
+            self._imap_thread.join(timeout)
 
     def send(self, signal: Signal) -> None:
+        content, recipients = self._prepare(signal)
+        if len(recipients) <= self._max_recipients:
+            try:
+                refused = self._smtp_pool.send_message(content)
+            except smtplib.SMTPRecipientsRefused as exc:
+                refused = exc.recipients
+        else:
+            refused = self._send_bulk(content, recipients)
+        self._report_refused_recipients(signal, refused)
+
+    def send_batch(self, signals: Iterable[Signal]) -> None:
+        """Send several messages at once. The messages are shared out among the pooled connections, which send
+        them in parallel, each sending its share back to back without going back to the pool in between. As a
+        result, the messages are not necessarily sent in order. Messages to more than max_recipients recipients are
+        sent as by send(). If any messages couldn't be sent at all, the first such error is raised once the rest
+        have been sent."""
+        signals = list(signals)
+        prepared = [self._prepare(signal) for signal in signals]  # Check them all before sending any.
+        errors = []
+        small = []
+        for signal, (content, recipients) in zip(signals, prepared):
+            if len(recipients) <= self._max_recipients:
+                small.append((signal, content))
+                continue
+            try:
+                refused = self._send_bulk(content, recipients)
+            except (smtplib.SMTPException, OSError) as exc:
+                errors.append(exc)
+            else:
+                self._report_refused_recipients(signal, refused)
+
+        shares = min(self._smtp_pool.size, len(small))
+        if shares == 1:
+            results = self._smtp_pool.send_messages([content for _, content in small])
+        elif shares > 1:
+            share_size = -(-len(small) // shares)
+            futures = [self._get_bulk_executor().submit(self._smtp_pool.send_messages,
+                                                        [content for _, content in small[start:start + share_size]])
+                       for start in range(0, len(small), share_size)]
+            results = [result for future in futures for result in future.result()]
+        else:
+            results = []
+        for (signal, _), result in zip(small, results):
+            if isinstance(result, smtplib.SMTPRecipientsRefused):
+                result = result.recipients
+            elif isinstance(result, Exception):
+                errors.append(result)
+                continue
+            self._report_refused_recipients(signal, result)
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _prepare(signal: Signal) -> Tuple[MIMEPart, List[str]]:
+        # Build the message to send for a signal, and the list of its recipients.
         if not isinstance(signal, Signal):
             raise TypeError(type(signal))
         if not isinstance(signal, Message):
@@ -138,39 +802,252 @@ class EmailSession(Session):
         if meta_data.response_to:
             content['reply-to'] = meta_data.response_to
 
-        with self._smtp_factory() as connection:
-            connection.send_message(content)
+        return content, list(meta_data.addressees) + list(meta_data.visible_to)
+
+    def _get_bulk_executor(self) -> ThreadPoolExecutor:
+        with self._bulk_executor_lock:
+            if self._bulk_executor is None:
+                self._bulk_executor = ThreadPoolExecutor(self._smtp_pool.size)
+            return self._bulk_executor
+
+    def _send_bulk(self, content: MIMEPart, recipients: List[str]) -> Dict[str, Tuple[int, bytes]]:
+        # Serialize the message once, and send it to each batch of recipients in its own transaction.
+        from_address = content['from']
+        data = content.as_bytes()
+        batches = [recipients[start:start + self._max_recipients]
+                   for start in range(0, len(recipients), self._max_recipients)]
+        futures = [self._get_bulk_executor().submit(self._smtp_pool.sendmail, from_address, batch, data)
+                   for batch in batches]
+        refused = {}
+        errors = []
+        for batch, future in zip(batches, futures):
+            try:
+                refused.update(future.result())
+            except smtplib.SMTPRecipientsRefused as exc:
+                refused.update(exc.recipients)
+            except (smtplib.SMTPException, OSError) as exc:
+                LOGGER.warning("Failed to send to a batch of %s recipients: %s" % (len(batch), exc))
+                errors.append(exc)
+                code = getattr(exc, 'smtp_code', None)
+                reason = getattr(exc, 'smtp_error', str(exc).encode())
+                for recipient in batch:
+                    refused[recipient] = (code, reason)
+        if len(errors) == len(batches):
+            raise errors[0]  # Nothing got through at all, so treat it as a failure of the send itself.
+        return refused
+
+    def _report_refused_recipients(self, signal: Signal, refused: Dict[str, Tuple[int, bytes]]) -> None:
+        for recipient, (code, reason) in refused.items():
+            self._report_refused_recipient(signal, recipient, code, reason)
+
+    def _report_refused_recipient(self, signal: Signal, recipient: str, code: Optional[int], reason: bytes) -> None:
+        meta_data = SignalMetaData(
+            origin=recipient,
+            addressees=[signal.meta_data.origin] if signal.meta_data.origin else None,
+            response_to=signal.meta_data.identifier,
+            received_at=datetime.datetime.now()
+        )
+        if isinstance(reason, bytes):
+            reason = reason.decode('utf-8', 'replace')
+        self.receive(DeliveryFailure(meta_data, reason, None if code is None else ErrorCode(str(code))))
 
     def _imap_thread_main(self):
-        seen = set()
         while self._alive:
             # noinspection PyBroadException
             try:
                 with self._imap_factory() as connection:
+                    self._checkpoint.validate(imap_uid_validity(connection))
+                    idle = self._use_idle and imap_supports_idle(connection)
+                    delay = self._min_rate
                     while self._alive:
-                        where = '(SENTSINCE {date:%d-%b-%Y})'.format(date=self._starting - datetime.timedelta(1))
-                        result, data = connection.uid('search', None, where)
-                        if result != 'OK':
-                            raise RuntimeError("Unexpected response to search command: %s" % result)
-                        if data[0] is None:
-                            message_ids = []
+                        received = self._receive_new_messages(connection)
+                        if idle:
+                            imap_idle(connection, self._idle_renewal, self._stopped)
                         else:
-                            message_ids = data[0].split()
-                        for message_id in message_ids:
-                            if message_id in seen:
-                                continue
-                            result, data = connection.uid('fetch', message_id, '(RFC822)')
-                            if result != 'OK':
-                                raise RuntimeError("Unexpected response to fetch command: %s" % result)
-                            email_message = message_from_bytes(data[0][1])
-                            sent_date = parse_email_datetime(email_message['date'], self._starting)
-                            if sent_date >= self._starting:
-                                seen.add(message_id)
-                                self.receive(self.email_to_signal(email_message))
-                        time.sleep(self._rate)
+                            delay = self._next_poll_delay(delay, received)
+                            self._stopped.wait(delay)
+            except Exception:
+                LOGGER.exception("Error while trying to read email.")
+                self._stopped.wait(self._rate)
+
+    def _next_poll_delay(self, delay: float, received: int) -> float:
+        # Poll more often while mail is arriving, and back off while it isn't.
+        return self._min_rate if received else min(delay * 2, self._rate)
+
+    def _poll(self) -> int:
+        # Check for new mail once, on a connection kept open between calls. Called by the IMAPScheduler.
+        with self._imap_lock:
+            if not self._alive:
+                return 0
+            try:
+                if self._imap_connection is None:
+                    self._imap_connection = self._imap_factory()
+                    self._checkpoint.validate(imap_uid_validity(self._imap_connection))
+                return self._receive_new_messages(self._imap_connection)
+            except Exception:
+                self._disconnect_imap()
+                raise
+
+    def _disconnect_imap(self) -> None:
+        connection, self._imap_connection = self._imap_connection, None
+        if connection is None:
+            return
+        try:
+            connection.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    def _search_new_uids(self, connection: imaplib.IMAP4) -> List[int]:
+        last_uid = self._checkpoint.last_uid
+        if last_uid is None:
+            # First sync of this mailbox: fall back on the starting date.
+            where = '(SENTSINCE {date:%d-%b-%Y})'.format(date=self._starting - datetime.timedelta(1))
+        else:
+            where = 'UID %d:*' % (last_uid + 1)
+        result, data = connection.uid('search', None, where)
+        if result != 'OK':
+            raise RuntimeError("Unexpected response to search command: %s" % result)
+        if not data or data[0] is None:
+            return []
+        uids = sorted(int(uid) for uid in data[0].split())
+        if last_uid is not None:
+            # A range ending in * always matches the newest message, even if its UID is below the start.
+            uids = [uid for uid in uids if uid > last_uid]
+        return uids
+
+    def _receive_new_messages(self, connection: imaplib.IMAP4) -> int:
+        uids = self._search_new_uids(connection)
+        received = 0
+        for start in range(0, len(uids), self._fetch_batch_size):
+            batch = uids[start:start + self._fetch_batch_size]
+            try:
+                received += self._receive_batch(connection, batch)
+            finally:
+                self._checkpoint.save()
+        return received
+
+    def _receive_batch(self, connection: imaplib.IMAP4, uids: List[int]) -> int:
+        # Check the dates on the headers alone, so bodies (and attachments) of older messages are never downloaded.
+        parser = BytesHeaderParser()
+        headers = imap_fetch_headers(connection, uids)
+        wanted = [uid for uid in uids if uid in headers and
+                  parse_email_datetime(parser.parsebytes(headers[uid][0])['date'], self._starting) >= self._starting]
+        # Download the bodies in groups limited by total size, so a batch of large messages is never held in
+        # memory all at once.
+        groups = group_by_size(wanted, {uid: headers[uid][1] for uid in wanted}, self._spool_threshold)
+        wanted = set(wanted)
+        requested = set()
+        bodies = {}  # type: Dict[int, bytes]
+        received = 0
+        for uid in uids:
+            if uid in wanted and uid not in requested:
+                group = next(groups)
+                requested.update(group)
+                bodies = imap_fetch(connection, group, '(UID RFC822)')
+            if uid in bodies:
+                message = LazyEmailMessage(bodies[uid], headers[uid][0], self._spool_threshold)
+                del bodies[uid]  # Let the raw bytes go as soon as they're spooled.
+                self.receive(self.email_to_signal(message))
+                received += 1
+            self._checkpoint.last_uid = uid
+        return received
+
+
+class IMAPScheduler:
+    """
+    Polls the mailboxes of any number of EmailSessions from a small, fixed pool of worker threads, rather than a
+    thread per session. Mailboxes are kept in a priority queue ordered by when each is next due. Each mailbox's
+    polling interval adapts on its own, as it would with a dedicated thread: it drops to the session's min_rate
+    after new mail arrives, and doubles up to the session's rate while none does. A mailbox is never polled by
+    more than one worker at a time, and its IMAP connection stays open between polls. New mail is handed to the
+    mailbox's own session, which passes it to that session's bots as usual.
+    """
+
+    class _Entry:
+
+        def __init__(self, session: EmailSession):
+            self.session = session
+            # noinspection PyProtectedMember
+            self.delay = session._min_rate
+            self.cancelled = False
+
+    def __init__(self, workers: int = 4):
+        if workers < 1:
+            raise ValueError(workers)
+        self._queue = []  # type: List[Tuple[float, int, IMAPScheduler._Entry]]
+        self._entries = {}  # type: Dict[int, IMAPScheduler._Entry]
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def session_count(self) -> int:
+        return len(self._entries)
+
+    def add(self, session: EmailSession) -> None:
+        """Start polling the session's mailbox. This is called by EmailSession when it is given a scheduler."""
+        with self._condition:
+            if id(session) in self._entries:
+                return
+            entry = self._entries[id(session)] = self._Entry(session)
+            self._schedule(entry, 0)
+
+    def remove(self, session: EmailSession) -> None:
+        """Stop polling the session's mailbox. This is called by EmailSession.close()."""
+        with self._condition:
+            entry = self._entries.pop(id(session), None)
+            if entry is not None:
+                entry.cancelled = True
+
+    def close(self) -> None:
+        """Stop the workers. The sessions themselves are left open."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _schedule(self, entry: 'IMAPScheduler._Entry', delay: float) -> None:
+        # Must be called with the condition held.
+        self._sequence += 1
+        heapq.heappush(self._queue, (time.monotonic() + delay, self._sequence, entry))
+        self._condition.notify()
+
+    def _next_due(self) -> Optional['IMAPScheduler._Entry']:
+        with self._condition:
+            while not self._closed:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                due, _, entry = self._queue[0]
+                if entry.cancelled:
+                    heapq.heappop(self._queue)
+                    continue
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    heapq.heappop(self._queue)
+                    return entry
+                self._condition.wait(remaining)
+            return None
+
+    def _work(self) -> None:
+        while True:
+            entry = self._next_due()
+            if entry is None:
+                break
+            session = entry.session
+            # noinspection PyBroadException,PyProtectedMember
+            try:
+                entry.delay = session._next_poll_delay(entry.delay, session._poll())
             except Exception:
                 LOGGER.exception("Error while trying to read email.")
-                time.sleep(self._rate)
+                entry.delay = session._rate
+            with self._condition:
+                if not entry.cancelled and not self._closed:
+                    self._schedule(entry, entry.delay)
 
 
 class SMTPFactory:
@@ -1,7 +1,9 @@
 from abc import ABCMeta, abstractmethod
+from typing import Iterable
 import logging
 
 import chatty.bots.interface
+import chatty.sessions.dispatcher
 import chatty.signals
 
 
@@ -13,6 +15,17 @@ class Session(metaclass=ABCMeta):
 
     def __init__(self):
         self._bots = set()
+        self._dispatcher = None
+
+    @property
+    def dispatcher(self) -> 'chatty.sessions.dispatcher.ParallelDispatcher':
+        """The dispatcher used to hand received signals to the bots. If it is None (the default), each bot is
+        called in turn on the thread which received the signal."""
+        return self._dispatcher
+
+    @dispatcher.setter
+    def dispatcher(self, dispatcher: 'chatty.sessions.dispatcher.ParallelDispatcher') -> None:
+        self._dispatcher = dispatcher
 
     def __del__(self) -> None:
         self.close()
@@ -28,6 +41,12 @@ class Session(metaclass=ABCMeta):
     def send(self, signal: 'chatty.signals.interface.Signal') -> None:
         raise NotImplementedError()
 
+    def send_batch(self, signals: 'Iterable[chatty.signals.interface.Signal]') -> None:
+        """Send several signals, in order. Sessions which can deliver a group of signals more efficiently than one
+        at a time should override this."""
+        for signal in signals:
+            self.send(signal)
+
     def add_bot(self, bot: 'chatty.bots.interface.Bot') -> None:
         self._bots.add(bot)
 
@@ -35,6 +54,10 @@ class Session(metaclass=ABCMeta):
         self._bots.remove(bot)
 
     def receive(self, signal: 'chatty.signals.interface.Signal') -> None:
+        if self._dispatcher is not None:
+            for bot in self._bots:
+                self._dispatcher.dispatch(self, bot, signal)
+            return
         for bot in self._bots:
             # noinspection PyBroadException
             try:
@@ -0,0 +1,293 @@
+from threading import Lock, Thread
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import logging
+import os
+import socket
+import stat
+import struct
+
+import chatty.bots.interface
+from chatty.sessions.interface import Session
+from chatty.signals.encoding import SignalBatchView, encode_signals, join_records
+from chatty.signals.interface import Signal
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Either a (host, port) pair for TCP, or a file system path for a Unix domain socket.
+Address = Union[Tuple[str, int], str]
+
+# Each frame is a header, giving the payload length and the channel number, followed by the payload, which is a
+# batch of signals in the binary wire format (see chatty.signals.encoding). Channels let a single connection carry
+# the signals for any number of sessions.
+FRAME_HEADER = struct.Struct('<II')
+
+# Channel 0 is reserved for signals which aren't tied to a particular remote session.
+DEFAULT_CHANNEL = 0
+
+# Frames claiming to be larger than this are treated as a protocol error, rather than allocating whatever the peer
+# asks for.
+MAX_FRAME_SIZE = 64 * 2 ** 20
+
+
+def make_socket(address: Address) -> socket.socket:
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+
+
+def remove_stale_socket(path: str) -> None:
+    """Remove a Unix domain socket left behind at path by an earlier listener. Anything else at that path is left
+    alone, so binding to it fails as usual instead of destroying a file given by mistake."""
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if stat.S_ISSOCK(mode):
+        os.remove(path)
+
+
+def encode_frame(channel: int, payload: bytes) -> bytes:
+    """Frame an encoded batch of signals for the given channel."""
+    return FRAME_HEADER.pack(len(payload), channel) + payload
+
+
+def encode_record_frames(records: Iterable[Tuple[int, bytes]]) -> bytes:
+    """Frame a sequence of (channel, record) pairs, where each record is a single encoded signal (see
+    chatty.signals.encoding.encode_record()). Consecutive records for the same channel share a frame, and the
+    result is ready to be written to a socket in one go."""
+    buffer = bytearray()
+    channel = None
+    batch = []  # type: List[bytes]
+    for record_channel, record in records:
+        if batch and record_channel != channel:
+            buffer += encode_frame(channel, join_records(batch))
+            batch = []
+        channel = record_channel
+        batch.append(record)
+    if batch:
+        buffer += encode_frame(channel, join_records(batch))
+    return bytes(buffer)
+
+
+def _receive_exactly(connection: socket.socket, size: int) -> Optional[bytearray]:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = connection.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return buffer
+
+
+def read_frame(connection: socket.socket, max_size: int = MAX_FRAME_SIZE) -> Optional[Tuple[int, SignalBatchView]]:
+    """Read the next frame from the connection, returning its channel and signals, or None if the connection was
+    closed. Raises ValueError if the frame is larger than max_size bytes."""
+    header = _receive_exactly(connection, FRAME_HEADER.size)
+    if header is None:
+        return None
+    length, channel = FRAME_HEADER.unpack(header)
+    if length > max_size:
+        raise ValueError("Frame of %s bytes exceeds the maximum of %s." % (length, max_size))
+    payload = _receive_exactly(connection, length)
+    if payload is None:
+        return None
+    return channel, SignalBatchView(payload)
+
+
+class _RemoteChannel(Session):
+    """The session handed to bots for signals arriving on a particular channel of a remote connection. Signals sent
+    through it go back over the same connection and channel."""
+
+    def __init__(self, connection: '_RemoteConnection', channel: int):
+        super().__init__()
+        self._connection = connection
+        self._channel = channel
+
+    @property
+    def channel(self) -> int:
+        return self._channel
+
+    def join(self, timeout=None) -> None:
+        self._connection.join(timeout)
+
+    def send(self, signal: Signal) -> None:
+        self._connection.send(self._channel, [signal])
+
+    def send_batch(self, signals: Iterable[Signal]) -> None:
+        self._connection.send(self._channel, list(signals))
+
+
+class _RemoteConnection:
+
+    def __init__(self, session: 'RemoteSession', connection: socket.socket):
+        self._session = session
+        self._connection = connection
+        self._write_lock = Lock()
+        self._channels = {}  # type: Dict[int, _RemoteChannel]
+        self._thread = Thread(target=self._read_frames, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        try:
+            self._connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._connection.close()
+
+    def join(self, timeout=None) -> None:
+        self._thread.join(timeout)
+
+    def send(self, channel: int, signals: List[Signal]) -> None:
+        frame = encode_frame(channel, encode_signals(signals))
+        with self._write_lock:
+            self._connection.sendall(frame)
+
+    def _read_frames(self) -> None:
+        try:
+            while True:
+                frame = read_frame(self._connection)
+                if frame is None:
+                    break
+                channel_number, signals = frame
+                channel = self._channels.get(channel_number)
+                if channel is None:
+                    channel = self._channels[channel_number] = _RemoteChannel(self, channel_number)
+                for signal in signals:
+                    # noinspection PyProtectedMember
+                    self._session._dispatch(channel, signal)
+        except OSError:
+            LOGGER.info("Remote connection lost.")
+        except Exception:
+            LOGGER.exception("Error while reading from remote connection.")
+        finally:
+            self.close()
+            # noinspection PyProtectedMember
+            self._session._forget(self)
+
+
+class RemoteSession(Session):
+    """
+    A session which receives signals from RemoteBots on other processes or machines, over TCP or a Unix domain
+    socket. This lets protocol sessions run on edge nodes, each with a RemoteBot attached, while the bots that
+    handle their signals run here. Any number of RemoteBots can connect, and each can multiplex any number of
+    sessions over its connection. Bots added to this session receive, as their session argument, a stand-in for
+    the originating edge session, and signals they send through it are routed back to that session. Signals sent
+    directly through the RemoteSession itself go out on the default channel of every connection, to be handled by
+    each RemoteBot's default session, if it has one.
+
+    Connections aren't accepted until start() is called, or the first bot is added, so no signals arrive before
+    there is a bot to receive them. Until then, connecting RemoteBots wait in the listen backlog.
+    """
+
+    def __init__(self, address: Address, backlog: int = 16):
+        super().__init__()
+        self._listener = make_socket(address)
+        try:
+            if isinstance(address, str):
+                remove_stale_socket(address)
+            else:
+                self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listener.bind(address)
+            self._listener.listen(backlog)
+        except OSError:
+            self._listener.close()
+            raise
+        self._address = self._listener.getsockname()
+        self._connections = set()
+        self._connections_lock = Lock()
+        self._alive = True
+        self._accept_thread = Thread(target=self._accept_connections, daemon=True)
+        self._start_lock = Lock()
+        self._started = False
+
+    def start(self) -> None:
+        """Start accepting connections. Called automatically when the first bot is added."""
+        with self._start_lock:
+            if self._started or not self._alive:
+                return
+            self._started = True
+            self._accept_thread.start()
+
+    @property
+    def address(self) -> Address:
+        """The address the session is listening on. (Useful when binding to port 0.)"""
+        return self._address
+
+    @property
+    def connection_count(self) -> int:
+        """The number of remote connections currently open."""
+        return len(self._connections)
+
+    def close(self) -> None:
+        if not getattr(self, '_alive', False):
+            return
+        self._alive = False
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)  # Wakes up the thread blocked in accept().
+        except OSError:
+            pass
+        self._listener.close()
+        with self._connections_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.close()
+
+    def join(self, timeout=None) -> None:
+        if self._started:
+            self._accept_thread.join(timeout)
+
+    def add_bot(self, bot: 'chatty.bots.interface.Bot') -> None:
+        super().add_bot(bot)
+        self.start()
+
+    def send(self, signal: Signal) -> None:
+        self.send_batch([signal])
+
+    def send_batch(self, signals: Iterable[Signal]) -> None:
+        # The whole batch goes to each connection as a single frame.
+        signals = list(signals)
+        with self._connections_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            # noinspection PyBroadException
+            try:
+                connection.send(DEFAULT_CHANNEL, signals)
+            except Exception:
+                LOGGER.exception("Error sending signal over remote connection.")
+
+    def _dispatch(self, channel: Session, signal: Signal) -> None:
+        # Hand a signal that arrived on the given channel to the bots. Called from connection threads.
+        if self._dispatcher is not None:
+            for bot in self._bots:
+                self._dispatcher.dispatch(channel, bot, signal)
+            return
+        for bot in self._bots:
+            # noinspection PyBroadException
+            try:
+                bot.receive(channel, signal)
+            except Exception:
+                LOGGER.exception("Error in Bot.receive().")
+
+    def _forget(self, connection: _RemoteConnection) -> None:
+        with self._connections_lock:
+            self._connections.discard(connection)
+
+    def _accept_connections(self) -> None:
+        while self._alive:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                if self._alive:
+                    LOGGER.exception("Error accepting remote connection.")
+                break
+            if isinstance(self._address, tuple):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            remote = _RemoteConnection(self, connection)
+            with self._connections_lock:
+                self._connections.add(remote)
+            remote.start()
@@ -1,23 +1,48 @@
 import logging
+import threading
 import time
-from itertools import chain
-from typing import Dict, Set
+from collections import OrderedDict
+from typing import Iterable, List
 
+from chatty.routing import RoutingTable
 from chatty.sessions.interface import Session
 from chatty.signals.interface import Signal
-from chatty.types import Handle
+from chatty.types import Handle, RouteType, RouteTypes
 
 
 LOGGER = logging.getLogger(__name__)
 
 
 class RouterSession(Session):
-    """A session router which directs each outbound signal to the correct session(s) based on its metadata."""
+    """A session router which directs each outbound signal to the correct session(s) based on its metadata. Sessions
+    can be registered by addressee/visible_to handle (the default), handle pattern, room, or origin; see
+    chatty.types.RouteTypes. The distinct set of target sessions is resolved before anything is sent, so each session
+    is sent a signal once, no matter how many of its routes match it."""
 
-    def __init__(self):
+    def __init__(self, cache_size: int = 4096):
         super().__init__()
-        self._session_map = {}  # type: Dict[Handle, Set[Session]]
+        self._routes = RoutingTable(cache_size)
         self._alive = True
+        self._stats_lock = threading.Lock()
+        self._signals_routed = 0
+        self._deliveries = 0
+        self._duplicates_avoided = 0
+
+    @property
+    def signals_routed(self) -> int:
+        """The number of outbound signals routed so far."""
+        return self._signals_routed
+
+    @property
+    def deliveries(self) -> int:
+        """The number of (signal, session) deliveries made so far."""
+        return self._deliveries
+
+    @property
+    def duplicates_avoided(self) -> int:
+        """The number of redundant deliveries avoided so far, because a session was matched by more than one route
+        for the same signal."""
+        return self._duplicates_avoided
 
     def close(self):
         self._alive = False
@@ -29,28 +54,40 @@ class RouterSession(Session):
         else:
             time.sleep(timeout)
 
-    def register_session(self, handle: Handle, session: Session):
-        if handle in self._session_map:
-            self._session_map[handle].add(session)
-        else:
-            self._session_map[handle] = {session}
+    def register_session(self, handle: Handle, session: Session, route_type: RouteType = RouteTypes.HANDLE):
+        self._routes.add(route_type, handle, session)
 
-    def unregister_session(self, handle: Handle, session: Session):
-        if handle in self._session_map:
-            self._session_map[handle].discard(session)
-            if not self._session_map[handle]:
-                del self._session_map[handle]
+    def unregister_session(self, handle: Handle, session: Session, route_type: RouteType = RouteTypes.HANDLE):
+        self._routes.remove(route_type, handle, session)
 
     def send(self, signal: Signal):
-        mapped = False
-        for handle in chain(signal.meta_data.addressees, signal.meta_data.visible_to):
-            if handle in self._session_map:
-                for session in self._session_map[handle]:
-                    # noinspection PyBroadException
-                    try:
-                        session.send(signal)
-                    except Exception:
-                        LOGGER.exception("Exception in session router for handle %s" % handle)
-                    mapped = True
-        if not mapped:
-            LOGGER.warning("Unhandled signal in session router:\n%s" % signal)
+        self.send_batch([signal])
+
+    def send_batch(self, signals: Iterable[Signal]):
+        # Group the signals by target session, preserving their order, so each session gets a single batch.
+        batches = OrderedDict()  # type: OrderedDict[Session, List[Signal]]
+        routed = deliveries = duplicates = 0
+        for signal in signals:
+            sessions, matches = self._routes.resolve_matches(signal.meta_data)
+            if not sessions:
+                LOGGER.warning("Unhandled signal in session router:\n%s" % signal)
+            for session in sessions:
+                batches.setdefault(session, []).append(signal)
+            routed += 1
+            deliveries += len(sessions)
+            duplicates += matches - len(sessions)
+
+        with self._stats_lock:
+            self._signals_routed += routed
+            self._deliveries += deliveries
+            self._duplicates_avoided += duplicates
+
+        for session, batch in batches.items():
+            # noinspection PyBroadException
+            try:
+                if len(batch) == 1:
+                    session.send(batch[0])
+                else:
+                    session.send_batch(batch)
+            except Exception:
+                LOGGER.exception("Exception in session router for session %s" % session)
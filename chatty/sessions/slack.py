@@ -1,7 +1,12 @@
-from collections import deque
-from typing import Union, Optional
+from collections import defaultdict, deque
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 import datetime
 import logging
+import mmap
+import os
+import random
+import select
+import struct
 import threading
 import time
 
@@ -13,11 +18,12 @@ from slackclient.channel import Channel
 from slackclient.user import User
 
 from chatty.exceptions import AuthenticationFailure, OperationNotSupported
+from chatty.rate_limiting import RateLimiter
 from chatty.sessions.interface import Session
 from chatty.signals.delivery_failure import DeliveryFailure
 from chatty.signals.interface import Signal
 from chatty.signals.message import Message
-from chatty.signals.metadata import SignalMetaData
+from chatty.signals.metadata import SignalMetaData, intern_handles
 from chatty.signals.status_change import StatusChange
 from chatty.types import Handle, SignalID, Password, StatusTypes, TypingStatusValues
 
@@ -25,23 +31,437 @@ from chatty.types import Handle, SignalID, Password, StatusTypes, TypingStatusVa
 LOGGER = logging.getLogger(__name__)
 
 
+def is_rate_limit_error(error: dict) -> bool:
+    """Return whether an error reported by Slack (in an error event or a failed acknowledgement) means we're sending
+    too fast."""
+    message = str(error.get('msg', '')).lower()
+    return error.get('code') == 429 or 'ratelimited' in message or 'rate limit' in message
+
+
+def wait_for_websocket_input(websocket, timeout: float, poll_interval: float = .1) -> bool:
+    """
+    Wait until the websocket has data to read, or the timeout expires, and return whether it has. websocket-client
+    offers no way to do this, so this looks at its internals: the underlying socket, which is what select() can
+    see, and the buffers in front of it, which may hold data that has already left the socket. If these aren't
+    where they are expected to be, as may happen with another version of websocket-client, this falls back to
+    waiting poll_interval seconds and reporting that there may be data, so the caller reads and finds out.
+    """
+    sock = getattr(websocket, 'sock', None)
+    if sock is None:
+        time.sleep(min(timeout, poll_interval))
+        return True
+    try:
+        pending = getattr(sock, 'pending', None)  # Data already decrypted and buffered by an SSL socket.
+        if pending is not None and pending():
+            return True
+        frame_buffer = getattr(websocket, 'frame_buffer', None)  # Data already read by the websocket itself.
+        if any(getattr(frame_buffer, 'recv_buffer', None) or ()):
+            return True
+        return bool(select.select([sock], [], [], timeout)[0])
+    except (AttributeError, TypeError, ValueError, OSError):
+        return True  # Let the caller's read report any problem.
+
+
+class SlackClientFactory:
+    """Creates new SlackClients for a SlackSession, so it can replace a client whose connection was lost."""
+
+    def __init__(self, token: Password, **kwargs):
+        self.token = token
+        self.kwargs = kwargs
+
+    def __call__(self) -> SlackClient:
+        return SlackClient(token=self.token, **self.kwargs)
+
+
+class SlackDirectory:
+    """
+    A persistent directory of a Slack team's users and channels, so sessions can start without waiting for
+    rtm.start to download the whole team, which takes minutes for large workspaces. The directory is loaded from a
+    snapshot file on construction. Changes reported by the session are kept in memory on top of the snapshot, and
+    save() merges them into a new snapshot, which is swapped into place.
+
+    Snapshots are compact binary files which are memory mapped rather than read, so loading one is instant no matter
+    how big it is, and only the entries actually looked up are ever decoded. A snapshot starts with a header
+    giving the number of users and channels, followed by a table for each of (offset, length) pairs, sorted by ID,
+    pointing at the records. Each record is a NUL-separated list of UTF-8 fields: ID, name, real name, time zone
+    and email for users; ID, name and member IDs for channels. Lookups are binary searches of the tables.
+    """
+
+    MAGIC = b'CSD\x01'
+    HEADER = struct.Struct('<4sII')  # Magic, user count, channel count
+    INDEX_ENTRY = struct.Struct('<II')  # Record offset, record length
+
+    def __init__(self, path: str = None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._snapshot = None  # type: Optional[mmap.mmap]
+        self._user_count = self._channel_count = 0
+        # Changes since the snapshot was taken, which take precedence over it. None marks a deleted entry.
+        self._users = {}  # type: Dict[str, Optional[Tuple[str, ...]]]
+        self._channels = {}  # type: Dict[str, Optional[Tuple[str, ...]]]
+        if path is not None and os.path.exists(path):
+            self._open_snapshot()
+
+    @property
+    def path(self) -> Optional[str]:
+        return self._path
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self._user_count or self._channel_count or self._users or self._channels)
+
+    @property
+    def modified(self) -> bool:
+        """Whether there are changes which haven't been saved yet."""
+        return bool(self._users or self._channels)
+
+    def _open_snapshot(self) -> None:
+        with open(self._path, 'rb') as file:
+            try:
+                snapshot = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file
+                return
+        if len(snapshot) < self.HEADER.size or snapshot[:len(self.MAGIC)] != self.MAGIC:
+            LOGGER.warning("Ignoring Slack directory snapshot with unrecognized format: %s" % self._path)
+            snapshot.close()
+            return
+        _, self._user_count, self._channel_count = self.HEADER.unpack_from(snapshot)
+        self._snapshot = snapshot
+
+    def _close_snapshot(self) -> None:
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = None
+        self._user_count = self._channel_count = 0
+
+    def _snapshot_record(self, table: int, position: int) -> Tuple[str, ...]:
+        # Table 0 holds the users, and table 1 the channels.
+        entry = self.HEADER.size + (position + table * self._user_count) * self.INDEX_ENTRY.size
+        offset, length = self.INDEX_ENTRY.unpack_from(self._snapshot, entry)
+        return tuple(self._snapshot[offset:offset + length].decode('utf-8').split('\0'))
+
+    def _snapshot_find(self, table: int, key: str) -> Optional[Tuple[str, ...]]:
+        if self._snapshot is None:
+            return None
+        low, high = 0, self._channel_count if table else self._user_count
+        key_bytes = key.encode('utf-8')
+        while low < high:
+            middle = (low + high) // 2
+            entry = self.HEADER.size + (middle + table * self._user_count) * self.INDEX_ENTRY.size
+            offset, length = self.INDEX_ENTRY.unpack_from(self._snapshot, entry)
+            end = self._snapshot.find(b'\0', offset, offset + length)
+            middle_key = self._snapshot[offset:offset + length if end < 0 else end]
+            if middle_key == key_bytes:
+                return self._snapshot_record(table, middle)
+            if middle_key < key_bytes:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _find(self, table: int, key: str) -> Optional[Tuple[str, ...]]:
+        # Must be called with the lock held.
+        changes = self._channels if table else self._users
+        if key in changes:
+            return changes[key]
+        return self._snapshot_find(table, key)
+
+    def get_user(self, user_id: str) -> Optional[User]:
+        """Look up a user. The User returned isn't attached to a server."""
+        with self._lock:
+            record = self._find(0, user_id)
+        if record is None:
+            return None
+        return User(None, record[1], record[0], *record[2:5])
+
+    def get_channel(self, channel_id: str) -> Optional[Channel]:
+        """Look up a channel. The Channel returned isn't attached to a server."""
+        with self._lock:
+            record = self._find(1, channel_id)
+        if record is None:
+            return None
+        return Channel(None, record[1], record[0], [member for member in record[2:] if member])
+
+    def update_user(self, user_id: str, name: str, real_name: str = None, tz: str = None, email: str = None) -> None:
+        with self._lock:
+            self._users[user_id] = (user_id, name, real_name or '', tz or '', email or '')
+
+    def remove_user(self, user_id: str) -> None:
+        with self._lock:
+            self._users[user_id] = None
+
+    def update_channel(self, channel_id: str, name: str, members: Iterable[str] = None) -> None:
+        """Add or update a channel. If members is None, the channel's current members, if any, are kept."""
+        with self._lock:
+            if members is None:
+                record = self._find(1, channel_id)
+                members = record[2:] if record else ()
+            self._channels[channel_id] = (channel_id, name) + tuple(members)
+
+    def remove_channel(self, channel_id: str) -> None:
+        with self._lock:
+            self._channels[channel_id] = None
+
+    def add_member(self, channel_id: str, user_id: str) -> None:
+        with self._lock:
+            record = self._find(1, channel_id)
+            if record is not None and user_id not in record[2:]:
+                self._channels[channel_id] = record + (user_id,)
+
+    def remove_member(self, channel_id: str, user_id: str) -> None:
+        with self._lock:
+            record = self._find(1, channel_id)
+            if record is not None and user_id in record[2:]:
+                self._channels[channel_id] = record[:2] + tuple(member for member in record[2:] if member != user_id)
+
+    def update_from_server(self, server) -> None:
+        """Copy the users and channels a SlackClient's server loaded when it connected."""
+        for user in server.users.values():
+            self.update_user(user.id, user.name, user.real_name, user.tz, user.email)
+        for channel in server.channels:
+            self.update_channel(channel.id, channel.name, channel.members)
+
+    def _records(self, table: int) -> Dict[str, Tuple[str, ...]]:
+        # Must be called with the lock held.
+        records = {}
+        if self._snapshot is not None:
+            for position in range(self._channel_count if table else self._user_count):
+                record = self._snapshot_record(table, position)
+                records[record[0]] = record
+        for key, record in (self._channels if table else self._users).items():
+            if record is None:
+                records.pop(key, None)
+            else:
+                records[key] = record
+        return records
+
+    def save(self) -> None:
+        """Write a new snapshot, including all changes made since the last one was loaded or saved."""
+        if self._path is None:
+            return
+        with self._lock:
+            tables = [self._records(0), self._records(1)]
+            index = bytearray()
+            records = bytearray()
+            data_offset = self.HEADER.size + sum(len(table) for table in tables) * self.INDEX_ENTRY.size
+            for table in tables:
+                for key in sorted(table, key=lambda key: key.encode('utf-8')):
+                    record = '\0'.join(table[key]).encode('utf-8')
+                    index += self.INDEX_ENTRY.pack(data_offset + len(records), len(record))
+                    records += record
+            # Write to a temporary file and swap it into place, so a crash can't leave a truncated snapshot behind.
+            temp_path = self._path + '.tmp'
+            with open(temp_path, 'wb') as file:
+                file.write(self.HEADER.pack(self.MAGIC, len(tables[0]), len(tables[1])))
+                file.write(index)
+                file.write(records)
+            self._close_snapshot()
+            os.replace(temp_path, self._path)
+            self._users.clear()
+            self._channels.clear()
+            self._open_snapshot()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_snapshot()
+
+
+class SlackMembershipIndex:
+    """
+    Channel membership and user display names for a Slack connection, indexed so that inbound signals can be given
+    their visible_to lists without a user lookup per channel member. The list of member handles for a channel is
+    built once per version of the channel, i.e. until someone joins or leaves it or one of its members changes their
+    name, and the same tuple is shared by every signal from the channel in the meantime. Channels and users are
+    loaded from the client's cache the first time they are seen, and kept current from events after that.
+    """
+
+    def __init__(self, get_user_info: Callable[[str], Optional[User]],
+                 get_channel_info: Callable[[str], Optional[Channel]]):
+        self._get_user_info = get_user_info
+        self._get_channel_info = get_channel_info
+        self._lock = threading.Lock()
+        self._user_names = {}  # type: Dict[str, Handle]
+        self._channel_names = {}  # type: Dict[str, Handle]
+        self._members = {}  # type: Dict[str, Set[str]]
+        self._channels_by_member = defaultdict(set)  # type: Dict[str, Set[str]]
+        self._visible_to = {}  # type: Dict[str, Tuple[Handle, ...]]
+        self._generation = 0  # Incremented by clear()
+
+    def _load_user_names(self, user_ids: Iterable[str]) -> None:
+        # Must be called without the lock held, since the lookups may go over the network, and one slow request
+        # shouldn't hold up every other lookup. Names loaded across a clear() are discarded, being possibly stale.
+        with self._lock:
+            generation = self._generation
+        users = {user_id: self._get_user_info(user_id) for user_id in user_ids}
+        with self._lock:
+            if generation != self._generation:
+                return
+            for user_id, user in users.items():
+                self._user_names.setdefault(user_id, Handle(user.name if user else user_id))
+
+    def _load_channel(self, channel_id: str) -> bool:
+        # Must be called without the lock held, as for _load_user_names(). Unknown channels aren't remembered, in
+        # case they turn up later.
+        with self._lock:
+            if channel_id in self._members:
+                return True
+            generation = self._generation
+        channel = self._get_channel_info(channel_id)
+        if channel is None:
+            return False
+        with self._lock:
+            if generation != self._generation or channel_id in self._members:
+                return True
+            self._channel_names[channel_id] = Handle(channel.name)
+            self._members[channel_id] = set(channel.members)
+            for member in channel.members:
+                self._channels_by_member[member].add(channel_id)
+        return True
+
+    def user_name(self, user_id: str) -> Handle:
+        """The display name of the user, or the user ID if the user is unknown."""
+        with self._lock:
+            name = self._user_names.get(user_id)
+        if name is None:
+            self._load_user_names([user_id])
+            with self._lock:
+                name = self._user_names.get(user_id, Handle(user_id))
+        return name
+
+    def channel_name(self, channel_id: str) -> Optional[Handle]:
+        """The name of the channel, or None if the channel is unknown."""
+        self._load_channel(channel_id)
+        with self._lock:
+            return self._channel_names.get(channel_id)
+
+    def is_member(self, channel_id: str, user_id: str) -> bool:
+        self._load_channel(channel_id)
+        with self._lock:
+            return user_id in self._members.get(channel_id, ())
+
+    def visible_to(self, channel_id: str) -> Tuple[Handle, ...]:
+        """The display names of the channel's members, in sorted order, as a tuple shared until the membership or a
+        member's name changes. Empty if the channel is unknown."""
+        with self._lock:
+            visible_to = self._visible_to.get(channel_id)
+        if visible_to is not None:
+            return visible_to
+        if not self._load_channel(channel_id):
+            return ()
+        while True:
+            with self._lock:
+                visible_to = self._visible_to.get(channel_id)
+                if visible_to is not None:
+                    return visible_to
+                members = self._members.get(channel_id)
+                if members is None:
+                    return ()  # Cleared in the meantime.
+                missing = [member for member in members if member not in self._user_names]
+                if not missing:
+                    visible_to = intern_handles(sorted(self._user_names[member] for member in members))
+                    self._visible_to[channel_id] = visible_to
+                    return visible_to
+            self._load_user_names(missing)
+
+    def add_member(self, channel_id: str, user_id: str) -> None:
+        if not self._load_channel(channel_id):
+            return
+        with self._lock:
+            members = self._members.get(channel_id)
+            if members is None or user_id in members:
+                return
+            members.add(user_id)
+            self._channels_by_member[user_id].add(channel_id)
+            self._visible_to.pop(channel_id, None)
+
+    def remove_member(self, channel_id: str, user_id: str) -> None:
+        with self._lock:
+            members = self._members.get(channel_id)
+            if members is None or user_id not in members:
+                return
+            members.discard(user_id)
+            self._channels_by_member[user_id].discard(channel_id)
+            if not self._channels_by_member[user_id]:
+                del self._channels_by_member[user_id]
+            self._visible_to.pop(channel_id, None)
+
+    def clear(self) -> List[str]:
+        """Forget everything, so it is loaded afresh on demand, e.g. after a reconnect, when change events may have
+        been missed. Returns the IDs of the channels which were loaded."""
+        with self._lock:
+            channel_ids = list(self._members)
+            self._generation += 1
+            self._user_names.clear()
+            self._channel_names.clear()
+            self._members.clear()
+            self._channels_by_member.clear()
+            self._visible_to.clear()
+            return channel_ids
+
+    def rename_user(self, user_id: str, name: str) -> None:
+        with self._lock:
+            name = Handle(name)
+            if self._user_names.get(user_id) == name:
+                return
+            self._user_names[user_id] = name
+            for channel_id in self._channels_by_member.get(user_id, ()):
+                self._visible_to.pop(channel_id, None)
+
+
 class SlackSession(Session):
     """
     A Slack chat session interface.
+
+    Outbound posts are paced by a RateLimiter. Slack's limit of roughly one message per second applies per channel,
+    so by default each channel (or direct message) gets its own budget of one post per rate_limit seconds, with
+    short bursts allowed, under a looser global budget for the whole connection. If Slack reports that we're being
+    rate limited anyway, all posts are held back for the time it asks. A custom rate_limiter can be passed in
+    instead, e.g. to share one budget between several sessions using the same token. A rate_limit of zero turns
+    pacing off, other than when Slack asks us to back off.
+
+    The slack_client can be a token, a connected SlackClient, or a factory function which returns new SlackClients
+    (see SlackClientFactory). If the connection is lost, the session reconnects, with jittered exponential backoff
+    between attempts: first to the most recent URL given in a reconnect_url event, if any, then by connecting a new
+    client from the factory, or the same client again if there is no factory. Outbound posts not yet sent are kept
+    and go out in order once the connection is back. Posts which were in flight when the connection dropped may
+    be lost. Since membership and name changes may have been missed in the meantime, channel members and user
+    names are reloaded after reconnecting (with a directory, only the members of the channels in use are).
+
+    If a SlackDirectory is given, users and channels are looked up in it, and it is kept up to date from change
+    events. It is saved once it has been filled from the team state, every directory_save_interval seconds while
+    it has unsaved changes, and when the session is closed. Unless it is still empty, the session then connects,
+    and reconnects, without downloading the team's users and channels, and fetches any that are missing from the
+    directory individually.
+
+    Bots which reply with many short lines can opt into coalescing by setting coalesce_window. Consecutive posts to
+    the same room or addressee are then merged, one per line, into a single post of at most coalesce_limit
+    characters. This includes posts sent within coalesce_window seconds of the first one, as well as any that
+    queued up while it waited for the rate limiter. This saves API calls and rate limit waits, and keeps the order.
     """
 
-    # TODO: Accept a factory function which returns new SlackClients, similar to how EmailSession works.
-    def __init__(self, slack_client: Union[Password, SlackClient], starting: datetime.datetime = None,
-                 rate_limit: float = 1):
+    def __init__(self, slack_client: Union[Password, SlackClient, Callable[[], SlackClient]],
+                 starting: datetime.datetime = None, rate_limit: float = 1, rate_limiter: RateLimiter = None,
+                 reconnect_delay: float = 1, max_reconnect_delay: float = 60, directory: SlackDirectory = None,
+                 coalesce_window: float = None, coalesce_limit: int = 4000, directory_save_interval: float = 300):
         super().__init__()
 
         if isinstance(slack_client, str):
-            slack_client = SlackClient(token=slack_client)
+            slack_client = SlackClientFactory(slack_client)
+        if callable(slack_client):
+            self._slack_client_factory = slack_client
+            slack_client = slack_client()
+        else:
+            self._slack_client_factory = None
 
         self._slack_client = slack_client
         self._starting = datetime.datetime.now(tzlocal.get_localzone()) if starting is None else starting
+        self._directory = directory
+        self._directory_save_interval = directory_save_interval
+        self._directory_saved_at = time.monotonic()
+        self._coalesce_window = coalesce_window
+        self._coalesce_limit = coalesce_limit
 
-        if not self._slack_client.rtm_connect():
+        if not self._rtm_connect(self._slack_client):
             raise AuthenticationFailure()
 
         self._handle = self._slack_client.server.login_data['self']['id']
@@ -49,12 +469,28 @@ class SlackSession(Session):
 
         self._main_thread = threading.current_thread()
         self._thread_error = None
-        self._outbound_queue = deque()
+        self._outbound_queue = deque()  # (destination, content) pairs, one per post
+        self._outbound_condition = threading.Condition()
+        self._connected = True
+        self._reconnect_url = None  # type: Optional[str]
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
         self._rate_limit = rate_limit
-
-        self._slack_thread = threading.Thread(target=self._slack_thread_main, daemon=True)
+        if rate_limiter is None and rate_limit <= 0:
+            rate_limiter = RateLimiter()  # No limits, other than any Slack asks for.
+        elif rate_limiter is None:
+            rate_limiter = RateLimiter(rate=5 / rate_limit, burst=10, destination_rate=1 / rate_limit,
+                                       destination_burst=3)
+        self._rate_limiter = rate_limiter
+        self._stopped = threading.Event()
+        self._membership = SlackMembershipIndex(self._get_user_info, self._get_channel_info)
+
+        # Inbound and outbound traffic are handled on separate threads, so a backlog in one never holds up the other.
+        self._reader_thread = threading.Thread(target=self._slack_reader_main, daemon=True)
+        self._writer_thread = threading.Thread(target=self._slack_writer_main, daemon=True)
         self._alive = True
-        self._slack_thread.start()
+        self._reader_thread.start()
+        self._writer_thread.start()
         self._check_for_thread_errors()
 
     def _check_for_thread_errors(self):
@@ -66,46 +502,145 @@ class SlackSession(Session):
         LOGGER.exception("Error in thread: %s" % exc)
         self._thread_error = exc
 
-    def close(self):
+    def _stop(self):
         self._alive = False
-        self._slack_thread.join(timeout=5)
+        self._stopped.set()
+        with self._outbound_condition:
+            self._outbound_condition.notify_all()
+
+    def close(self):
+        already_closed = self._stopped.is_set()
+        self._stop()
+        self._reader_thread.join(timeout=5)
+        self._writer_thread.join(timeout=5)
+        if self._directory is not None and not already_closed:
+            self._save_directory()  # Logs, rather than raises, any error, so closing always completes.
         self._check_for_thread_errors()
 
     def join(self, timeout=None):
-        self._slack_thread.join(timeout)
+        self._reader_thread.join(timeout)
+        self._writer_thread.join(timeout)
 
     def send(self, signal: Signal) -> None:
+        self.send_batch([signal])
+
+    def send_batch(self, signals: Iterable[Signal]) -> None:
+        """Queue the posts for several signals at once, so they go out together and in order, with no other
+        thread's posts in between. With coalescing on, consecutive posts in the batch to the same room or addressee
+        are therefore always merged, up to coalesce_limit, however long the bot took to produce them."""
+        posts = []
+        for signal in signals:
+            posts.extend(self._get_posts(signal))
+        with self._outbound_condition:
+            self._outbound_queue.extend(posts)
+            self._outbound_condition.notify()
+        self._check_for_thread_errors()
+
+    @staticmethod
+    def _get_posts(signal: Signal) -> List[Tuple[Handle, str]]:
         if not isinstance(signal, Message):
             raise TypeError(signal)
 
         if signal.meta_data.visible_to:
             raise OperationNotSupported("Slack interface does not support carbon-copying.")
 
-        self._outbound_queue.append(signal)
-        self._check_for_thread_errors()
-
-    def _handle_outbound_message(self, message: Message):
-        content = str(message.content)
-        if message.meta_data.room:
-            self._slack_client.rtm_send_message(message.meta_data.room, content)
-            time.sleep(self._rate_limit)
-        for handle in message.meta_data.addressees:
-            self._slack_client.rtm_send_message(handle, content)
-            time.sleep(self._rate_limit)
+        content = str(signal.content)
+        posts = [(handle, content) for handle in signal.meta_data.addressees]
+        if signal.meta_data.room:
+            posts.insert(0, (signal.meta_data.room, content))
+        return posts
+
+    def _coalesce(self, destination: Handle, content: str) -> str:
+        # Merge the posts that follow in the queue for the same destination into this one, waiting up to the
+        # coalescing window for more to arrive.
+        deadline = time.monotonic() + self._coalesce_window
+        with self._outbound_condition:
+            while self._alive:
+                if self._outbound_queue:
+                    next_destination, next_content = self._outbound_queue[0]
+                    if (next_destination != destination or
+                            len(content) + 1 + len(next_content) > self._coalesce_limit):
+                        break
+                    self._outbound_queue.popleft()
+                    content += '\n' + next_content
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._outbound_condition.wait(remaining)
+        return content
+
+    def _handle_rate_limited(self, error: dict) -> None:
+        retry_after = float(error.get('retry_after') or self._rate_limit)
+        LOGGER.warning("Rate limited by Slack; holding back posts for %s seconds." % retry_after)
+        self._rate_limiter.retry_after(retry_after)
+
+    def _rtm_connect(self, client: SlackClient) -> bool:
+        # With a directory to serve lookups from, there's no need to download the whole team on connecting.
+        with_team_state = self._directory is None or self._directory.is_empty
+        if not client.rtm_connect(with_team_state=with_team_state):
+            return False
+        if self._directory is not None and with_team_state:
+            self._directory.update_from_server(client.server)
+            self._save_directory()
+        return True
+
+    def _save_directory(self) -> None:
+        self._directory_saved_at = time.monotonic()
+        # noinspection PyBroadException
+        try:
+            self._directory.save()
+        except Exception:
+            LOGGER.exception("Error saving Slack directory.")
+
+    def _save_directory_if_due(self) -> None:
+        if (self._directory is not None and self._directory.modified and
+                time.monotonic() - self._directory_saved_at >= self._directory_save_interval):
+            self._save_directory()
+
+    def _fetch_user_info(self, user_id) -> Optional[User]:
+        reply = self._slack_client.api_call('users.info', user=user_id)
+        if not reply.get('ok'):
+            return None
+        user = reply['user']
+        profile = user.get('profile', {})
+        self._directory.update_user(user['id'], user['name'], profile.get('real_name'), user.get('tz'),
+                                    profile.get('email'))
+        return self._directory.get_user(user_id)
+
+    def _fetch_channel_info(self, channel_id) -> Optional[Channel]:
+        reply = self._slack_client.api_call('conversations.info', channel=channel_id)
+        if not reply.get('ok'):
+            return None
+        channel = reply['channel']
+        members = []
+        cursor = None
+        while True:
+            reply = self._slack_client.api_call('conversations.members', channel=channel_id, cursor=cursor,
+                                                limit=1000)
+            if not reply.get('ok'):
+                break
+            members.extend(reply['members'])
+            cursor = reply.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+        self._directory.update_channel(channel_id, channel.get('name') or channel_id, members)
+        return self._directory.get_channel(channel_id)
 
     def _get_user_info(self, user_id) -> Optional[User]:
-        return self._slack_client.server.users.get(user_id, None)
+        if self._directory is None:
+            return self._slack_client.server.users.get(user_id, None)
+        return self._directory.get_user(user_id) or self._fetch_user_info(user_id)
 
     def _get_channel_info(self, channel_id) -> Optional[Channel]:
-        return self._slack_client.server.channels.find(channel_id)
+        if self._directory is None:
+            return self._slack_client.server.channels.find(channel_id)
+        return self._directory.get_channel(channel_id) or self._fetch_channel_info(channel_id)
 
     def _get_event_meta_data(self, event):
         room = event['channel']
-
-        origin = event['user']
-        user = self._get_user_info(origin)
-        if user:
-            origin = user.name
+        origin_id = event['user']
+        origin = self._membership.user_name(origin_id)
 
         time_stamp = event.get('ts', None)
         if time_stamp is None:
@@ -113,25 +648,26 @@ class SlackSession(Session):
         else:
             sent_time = datetime.datetime.fromtimestamp(float(time_stamp))
 
-        visible_to = []
-        channel = self._get_channel_info(room)
-        if channel:
-            room = channel.name
-            for member in channel.members:
-                user = self._get_user_info(member)
-                visible_to.append(Handle(user.name if user else member))
-
         bot = Handle(self._slack_client.server.username)
-        if visible_to:
-            addressees = None  # We can't know.
-        else:
+        channel_name = self._membership.channel_name(room)
+        visible_to = self._membership.visible_to(room)
+        if channel_name is not None:
+            room = channel_name
+        if not visible_to:
             # This only happens when we're in a private channel, so the addressee is clear.
             addressees = [bot]
-
-        if origin not in visible_to:
-            visible_to.append(Handle(origin))
-        if bot not in visible_to:
-            visible_to.append(bot)
+            visible_to = (origin, bot) if origin != bot else (bot,)
+        else:
+            addressees = None  # We can't know.
+            # Membership is checked by ID, so the shared tuple for the channel is only copied if the origin or the
+            # bot is somehow missing from it.
+            extras = []
+            if not self._membership.is_member(event['channel'], origin_id):
+                extras.append(origin)
+            if not self._membership.is_member(event['channel'], self._handle) and bot != origin:
+                extras.append(bot)
+            if extras:
+                visible_to += tuple(handle for handle in extras if handle not in visible_to)
 
         return SignalMetaData(
             identifier=SignalID('/'.join([room, origin, time_stamp])),
@@ -173,13 +709,45 @@ class SlackSession(Session):
     def _handle_inbound_hello(self, event):
         LOGGER.info("Server says hello: %s" % event)
 
-    # noinspection PyMethodMayBeStatic
     def _handle_inbound_reconnect_url(self, event):
         LOGGER.info("Received reconnect url event: %s" % event)
+        self._reconnect_url = event.get('url') or self._reconnect_url
+
+    def _handle_inbound_member_joined_channel(self, event):
+        self._membership.add_member(event['channel'], event['user'])
+        if self._directory is not None:
+            self._directory.add_member(event['channel'], event['user'])
+
+    def _handle_inbound_member_left_channel(self, event):
+        self._membership.remove_member(event['channel'], event['user'])
+        if self._directory is not None:
+            self._directory.remove_member(event['channel'], event['user'])
+
+    def _handle_inbound_user_change(self, event):
+        # Also handles team_join events, which carry the same user object.
+        user = event['user']
+        self._membership.rename_user(user['id'], user['name'])
+        if self._directory is not None:
+            profile = user.get('profile', {})
+            self._directory.update_user(user['id'], user['name'], profile.get('real_name'), user.get('tz'),
+                                        profile.get('email'))
+
+    def _handle_inbound_channel_created(self, event):
+        # Also handles channel_joined and group_joined events.
+        if self._directory is not None:
+            channel = event['channel']
+            self._directory.update_channel(channel['id'], channel.get('name') or channel['id'],
+                                           channel.get('members'))
+
+    def _handle_inbound_channel_deleted(self, event):
+        if self._directory is not None:
+            self._directory.remove_channel(event['channel'])
 
     def _handle_inbound_error(self, event):
         error = event['error']
-        if error['msg'] in ('invalid channel id', 'channel not found'):
+        if is_rate_limit_error(error):
+            self._handle_rate_limited(error)
+        elif error['msg'] in ('invalid channel id', 'channel not found'):
             meta_data = SignalMetaData(received_at=datetime.datetime.now())
             self.receive(DeliveryFailure(meta_data, error['msg'], error['code']))
         else:
@@ -191,7 +759,81 @@ class SlackSession(Session):
     def _handle_pong(event):
         LOGGER.info("Server responded to ping.")
 
-    def _slack_thread_main(self):
+    def _wait_for_inbound(self, timeout: float) -> bool:
+        # Block until the websocket has data to read, or the timeout expires.
+        websocket = getattr(self._slack_client.server, 'websocket', None)
+        if websocket is None:
+            self._stopped.wait(timeout)
+            return False
+        return wait_for_websocket_input(websocket, timeout)
+
+    def _connection_lost(self, client: SlackClient) -> None:
+        # Called from either thread. The reader thread takes care of reconnecting.
+        with self._outbound_condition:
+            if client is self._slack_client and self._connected:
+                LOGGER.warning("Lost connection to Slack; reconnecting.")
+                self._connected = False
+                self._outbound_condition.notify_all()
+
+    def _connect(self) -> bool:
+        # Make one attempt to reconnect, returning whether it succeeded.
+        client = self._slack_client
+        reconnect_url, self._reconnect_url = self._reconnect_url, None
+        if reconnect_url:
+            try:
+                client.server.connect_slack_websocket(reconnect_url)
+                return True
+            except SlackConnectionError as exc:
+                LOGGER.warning("Unable to reconnect to Slack at reconnect URL: %s" % exc)
+        if self._slack_client_factory is None:
+            if self._directory is None or self._directory.is_empty:
+                # The team state is about to be reloaded. slackclient only adds channels it doesn't know yet, and
+                # has no public way to forget them, so empty its channel list, or the old member lists would stay.
+                # (Building a new client instead would lose whatever the caller configured on this one.)
+                del client.server.channels[:]
+            return self._rtm_connect(client)
+        client = self._slack_client_factory()
+        if not self._rtm_connect(client):
+            return False
+        self._slack_client = client
+        return True
+
+    def _refresh_after_reconnect(self) -> None:
+        # Membership and name changes may have been missed while disconnected. The client's team state has just been
+        # reloaded, unless lookups are served from a directory, in which case the channels that were in use are
+        # fetched again.
+        channel_ids = self._membership.clear()
+        if self._directory is None:
+            return
+        for channel_id in channel_ids:
+            # noinspection PyBroadException
+            try:
+                self._fetch_channel_info(channel_id)
+            except Exception:
+                LOGGER.exception("Error refreshing Slack channel %s." % channel_id)
+
+    def _reconnect(self) -> bool:
+        delay = self._reconnect_delay
+        while self._alive:
+            # noinspection PyBroadException
+            try:
+                connected = self._connect()
+            except Exception:
+                LOGGER.exception("Error reconnecting to Slack.")
+                connected = False
+            if connected:
+                LOGGER.info("Reconnected to Slack.")
+                self._refresh_after_reconnect()
+                with self._outbound_condition:
+                    self._connected = True
+                    self._outbound_condition.notify_all()
+                return True
+            # Full jitter keeps many sessions from reconnecting in lockstep after an outage.
+            self._stopped.wait(random.uniform(0, delay))
+            delay = min(delay * 2, self._max_reconnect_delay)
+        return False
+
+    def _slack_reader_main(self):
         # TODO: dnd_updated_user, channel_joined Are there others? Also, why isn't presence_change getting triggered?
         inbound_event_handlers = {
             'message': self._handle_inbound_message,
@@ -200,33 +842,72 @@ class SlackSession(Session):
             'hello': self._handle_inbound_hello,
             'reconnect_url': self._handle_inbound_reconnect_url,
             'error': self._handle_inbound_error,
+            'member_joined_channel': self._handle_inbound_member_joined_channel,
+            'member_left_channel': self._handle_inbound_member_left_channel,
+            'user_change': self._handle_inbound_user_change,
+            'team_join': self._handle_inbound_user_change,
+            'channel_created': self._handle_inbound_channel_created,
+            'channel_joined': self._handle_inbound_channel_created,
+            'group_joined': self._handle_inbound_channel_created,
+            'channel_deleted': self._handle_inbound_channel_deleted,
             'pong': self._handle_pong,
             'desktop_notification': lambda e: None,  # Just ignore these. We don't even need to log them.
         }
         while self._alive:
+            if not self._connected and not self._reconnect():
+                return
+            client = self._slack_client
+            self._save_directory_if_due()
             # noinspection PyBroadException
             try:
-                if self._outbound_queue:
-                    message = self._outbound_queue.popleft()
-                    self._handle_outbound_message(message)
-                else:
-                    for event in self._slack_client.rtm_read():
+                if not self._wait_for_inbound(1):
+                    continue
+                # Each rtm_read() returns a single websocket frame, and frames beyond it which were already read off
+                # the socket are buffered where select() can't see them, so keep reading until nothing is left.
+                events = client.rtm_read()
+                while events:
+                    for event in events:
                         event_type = event.get('type')
                         if not event_type:
                             # It's an acknowledgement.
-                            # Keys: ok, reply_to, ts, and text
+                            # Keys: ok, reply_to, ts, and text (or error, if it failed)
+                            if not event.get('ok', True) and is_rate_limit_error(event.get('error') or {}):
+                                self._handle_rate_limited(event['error'])
                             continue
                         handler = inbound_event_handlers.get(event_type, None)
                         if handler is None:
                             LOGGER.warning("Unhandled Slack event: %s", event)
                         else:
                             handler(event)
-                    time.sleep(self._rate_limit)
+                    if not self._alive:
+                        break
+                    events = client.rtm_read()
             except SlackConnectionError:
-                # TODO: If we have a SlackClient factory function, call it to get a new connection instead of dying.
-                LOGGER.exception("Fatal error in Slack thread.")
-                self._alive = False
-                return
+                self._connection_lost(client)
+            except Exception:
+                LOGGER.exception("Error in Slack reader thread.")
+                self._stopped.wait(self._rate_limit)
+
+    def _slack_writer_main(self):
+        while self._alive:
+            with self._outbound_condition:
+                self._outbound_condition.wait_for(
+                    lambda: (self._outbound_queue and self._connected) or not self._alive)
+                if not self._alive:
+                    return
+                destination, content = self._outbound_queue.popleft()
+                client = self._slack_client
+            # noinspection PyBroadException
+            try:
+                if not self._rate_limiter.acquire(destination, interrupted=self._stopped):
+                    continue
+                if self._coalesce_window is not None:
+                    content = self._coalesce(destination, content)
+                client.rtm_send_message(destination, content)
+            except SlackConnectionError:
+                with self._outbound_condition:
+                    # Put the post back at the front of the queue, so it goes out first, in order, on reconnect.
+                    self._outbound_queue.appendleft((destination, content))
+                self._connection_lost(client)
             except Exception:
-                LOGGER.exception("Error in Slack thread.")
-                time.sleep(self._rate_limit)
+                LOGGER.exception("Error in Slack writer thread.")
@@ -6,10 +6,20 @@ from chatty.types import ErrorCode, Content
 
 class DeliveryFailure(Signal):
 
+    __slots__ = ('_error_code',)
+
     def __init__(self, meta_data: SignalMetaData, content: Content = None, error_code: ErrorCode=None):
         super().__init__(meta_data, content)
-        self._error_code = error_code
+        object.__setattr__(self, '_error_code', error_code)
 
     @property
     def error_code(self) -> ErrorCode:
         return self._error_code
+
+    def __eq__(self, other: Signal) -> bool:
+        result = super().__eq__(other)
+        if result is True:
+            return self._error_code == other._error_code
+        return result
+
+    __hash__ = Signal.__hash__  # Defining __eq__ would otherwise make instances unhashable.
@@ -0,0 +1,358 @@
+"""
+A compact, versioned binary encoding for signals and their metadata, suitable for passing signals between processes
+or storing them for later replay.
+
+An encoded batch consists of a header (the magic bytes b'CSIG', a format version byte, and the signal count),
+followed by one record per signal. Each record is prefixed with its length, so a received buffer can be indexed
+without decoding it; see SignalBatchView. Within a record, integers are unsigned LEB128 varints and strings are
+UTF-8, prefixed by their length plus one (so that a zero length denotes None). MIME content is passed through as
+its raw serialized bytes.
+"""
+
+from email import message_from_bytes
+# noinspection PyProtectedMember
+from email.message import MIMEPart, Message as EmailMessageBase
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+import datetime
+import struct
+
+from chatty.exceptions import SignalTypeNotSupported
+from chatty.signals.delivery_failure import DeliveryFailure
+from chatty.signals.interface import Signal
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.signals.status_change import StatusChange
+
+
+MAGIC = b'CSIG'
+FORMAT_VERSION = 1
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+_HEADER = struct.Struct('<4sBI')
+_LENGTH = struct.Struct('<I')
+_TIMESTAMP = struct.Struct('<qi')
+
+# Signal type tags
+_SIGNAL = 0
+_MESSAGE = 1
+_DELIVERY_FAILURE = 2
+_STATUS_CHANGE = 3
+
+# Content type tags
+_NO_CONTENT = 0
+_TEXT_CONTENT = 1
+_MIME_CONTENT = 2  # email.message.MIMEPart/EmailMessage, parsed with the modern email policy
+_LEGACY_MIME_CONTENT = 3  # email.message.Message, parsed with the compat32 policy
+_BYTES_CONTENT = 4
+
+# Date/time tags
+_NO_TIME = 0
+_NAIVE_TIME = 1
+_AWARE_TIME = 2
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_UTC_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class _Writer:
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def varint(self, value: int) -> None:
+        if value < 0x80:
+            self.buffer.append(value)
+            return
+        while value >= 0x80:
+            self.buffer.append((value & 0x7F) | 0x80)
+            value >>= 7
+        self.buffer.append(value)
+
+    def blob(self, value: Optional[bytes]) -> None:
+        if value is None:
+            self.buffer.append(0)
+        else:
+            self.varint(len(value) + 1)
+            self.buffer += value
+
+    def string(self, value: Optional[str]) -> None:
+        if value is not None and not isinstance(value, str):
+            raise TypeError("Expected a string, not %s" % type(value).__name__)
+        self.blob(None if value is None else value.encode('utf-8'))
+
+    def strings(self, values: Sequence[str]) -> None:
+        self.varint(len(values))
+        for value in values:
+            self.string(value)
+
+    def time(self, value: Optional[datetime.datetime]) -> None:
+        if value is None:
+            self.buffer.append(_NO_TIME)
+            return
+        offset = value.utcoffset()
+        if offset is None:
+            self.buffer.append(_NAIVE_TIME)
+            self.buffer += _TIMESTAMP.pack((value - _EPOCH) // _MICROSECOND, 0)
+        else:
+            self.buffer.append(_AWARE_TIME)
+            self.buffer += _TIMESTAMP.pack((value - _UTC_EPOCH) // _MICROSECOND, offset // datetime.timedelta(0, 1))
+
+    def content(self, value) -> None:
+        if value is None:
+            self.buffer.append(_NO_CONTENT)
+        elif isinstance(value, str):
+            self.buffer.append(_TEXT_CONTENT)
+            self.string(value)
+        elif isinstance(value, MIMEPart):
+            self.buffer.append(_MIME_CONTENT)
+            self.blob(value.as_bytes())
+        elif isinstance(value, EmailMessageBase):
+            self.buffer.append(_LEGACY_MIME_CONTENT)
+            self.blob(value.as_bytes())
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            self.buffer.append(_BYTES_CONTENT)
+            self.blob(bytes(value))
+        else:
+            raise TypeError("Unsupported signal content type: %s" % type(value).__name__)
+
+
+class _Reader:
+
+    def __init__(self, buffer: memoryview, offset: int = 0):
+        self.buffer = buffer
+        self.offset = offset
+
+    def byte(self) -> int:
+        if self.offset >= len(self.buffer):
+            raise ValueError("Truncated signal record.")
+        value = self.buffer[self.offset]
+        self.offset += 1
+        return value
+
+    def varint(self) -> int:
+        value = self.byte()
+        if value < 0x80:
+            return value
+        result = value & 0x7F
+        shift = 7
+        while True:
+            value = self.byte()
+            result |= (value & 0x7F) << shift
+            if value < 0x80:
+                return result
+            shift += 7
+
+    def blob(self) -> Optional[memoryview]:
+        length = self.varint()
+        if not length:
+            return None
+        start = self.offset
+        self.offset += length - 1
+        if self.offset > len(self.buffer):
+            raise ValueError("Truncated signal record.")
+        return self.buffer[start:self.offset]
+
+    def string(self) -> Optional[str]:
+        value = self.blob()
+        return None if value is None else str(value, 'utf-8')
+
+    def strings(self) -> List[str]:
+        return [self.string() for _ in range(self.varint())]
+
+    def time(self) -> Optional[datetime.datetime]:
+        tag = self.byte()
+        if tag == _NO_TIME:
+            return None
+        if self.offset + _TIMESTAMP.size > len(self.buffer):
+            raise ValueError("Truncated signal record.")
+        microseconds, offset = _TIMESTAMP.unpack_from(self.buffer, self.offset)
+        self.offset += _TIMESTAMP.size
+        if tag == _NAIVE_TIME:
+            return _EPOCH + datetime.timedelta(microseconds=microseconds)
+        if tag == _AWARE_TIME:
+            time_zone = datetime.timezone(datetime.timedelta(seconds=offset))
+            return (_UTC_EPOCH + datetime.timedelta(microseconds=microseconds)).astimezone(time_zone)
+        raise ValueError("Unknown time tag: %s" % tag)
+
+    def content(self):
+        tag = self.byte()
+        if tag == _NO_CONTENT:
+            return None
+        if tag == _TEXT_CONTENT:
+            return self.string()
+        if tag == _MIME_CONTENT:
+            return BytesParser(policy=default_policy).parsebytes(bytes(self.blob()))
+        if tag == _LEGACY_MIME_CONTENT:
+            return message_from_bytes(bytes(self.blob()))
+        if tag == _BYTES_CONTENT:
+            return bytes(self.blob())
+        raise ValueError("Unknown content tag: %s" % tag)
+
+
+def _write_signal(writer: _Writer, signal: Signal) -> None:
+    if type(signal) is Message:
+        tag = _MESSAGE
+    elif type(signal) is DeliveryFailure:
+        tag = _DELIVERY_FAILURE
+    elif type(signal) is StatusChange:
+        tag = _STATUS_CHANGE
+    elif type(signal) is Signal:
+        tag = _SIGNAL
+    else:
+        raise SignalTypeNotSupported(type(signal))
+    writer.buffer.append(tag)
+
+    meta_data = signal.meta_data
+    writer.string(meta_data.identifier)
+    writer.string(meta_data.origin)
+    writer.strings(meta_data.addressees)
+    writer.strings(meta_data.visible_to)
+    writer.string(meta_data.response_to)
+    writer.time(meta_data.sent_at)
+    writer.time(meta_data.received_at)
+    writer.string(meta_data.room)
+
+    writer.content(signal.content)
+
+    if tag == _DELIVERY_FAILURE:
+        writer.string(signal.error_code)
+    elif tag == _STATUS_CHANGE:
+        writer.string(signal.type)
+        writer.string(signal.value)
+
+
+def _read_signal(reader: _Reader) -> Signal:
+    tag = reader.byte()
+    meta_data = SignalMetaData(
+        identifier=reader.string(),
+        origin=reader.string(),
+        addressees=reader.strings(),
+        visible_to=reader.strings(),
+        response_to=reader.string(),
+        sent_at=reader.time(),
+        received_at=reader.time(),
+        room=reader.string()
+    )
+    content = reader.content()
+    if tag == _MESSAGE:
+        return Message(meta_data, content)
+    if tag == _DELIVERY_FAILURE:
+        return DeliveryFailure(meta_data, content, reader.string())
+    if tag == _STATUS_CHANGE:
+        type_ = reader.string()
+        return StatusChange(meta_data, type_, reader.string(), content)
+    if tag == _SIGNAL:
+        return Signal(meta_data, content)
+    raise ValueError("Unknown signal tag: %s" % tag)
+
+
+def encode_record(signal: Signal) -> bytes:
+    """Encode a single signal as a raw record, without a batch header. Records can be assembled into a batch with
+    join_records()."""
+    writer = _Writer()
+    _write_signal(writer, signal)
+    return bytes(writer.buffer)
+
+
+def encode_signals(signals: Iterable[Signal]) -> bytes:
+    """Encode a batch of signals."""
+    writer = _Writer()
+    writer.buffer += _HEADER.pack(MAGIC, FORMAT_VERSION, 0)
+    count = 0
+    for signal in signals:
+        length_offset = len(writer.buffer)
+        writer.buffer += _LENGTH.pack(0)
+        _write_signal(writer, signal)
+        _LENGTH.pack_into(writer.buffer, length_offset, len(writer.buffer) - length_offset - _LENGTH.size)
+        count += 1
+    _HEADER.pack_into(writer.buffer, 0, MAGIC, FORMAT_VERSION, count)
+    return bytes(writer.buffer)
+
+
+def join_records(records: Iterable[Buffer]) -> bytes:
+    """Assemble a batch from raw records, as returned by encode_record() or SignalBatchView.record(), without
+    decoding them."""
+    buffer = bytearray(_HEADER.pack(MAGIC, FORMAT_VERSION, 0))
+    count = 0
+    for record in records:
+        buffer += _LENGTH.pack(len(record))
+        buffer += record
+        count += 1
+    _HEADER.pack_into(buffer, 0, MAGIC, FORMAT_VERSION, count)
+    return bytes(buffer)
+
+
+def encode_signal(signal: Signal) -> bytes:
+    """Encode a single signal, as a batch of one."""
+    return encode_signals([signal])
+
+
+def decode_signals(buffer: Buffer) -> List[Signal]:
+    """Decode a batch of signals. Raises ValueError if the buffer is malformed or truncated."""
+    return list(SignalBatchView(buffer))
+
+
+def decode_signal(buffer: Buffer) -> Signal:
+    """Decode a batch which is expected to contain exactly one signal."""
+    view = SignalBatchView(buffer)
+    if len(view) != 1:
+        raise ValueError("Expected a single signal, but found %s." % len(view))
+    return view[0]
+
+
+class SignalBatchView(Sequence[Signal]):
+    """
+    A read-only sequence over an encoded batch of signals, which decodes each signal only when it is accessed.
+    Constructing the view only walks the record lengths; no data is copied. The raw bytes of an individual record
+    are available, again without copying, through record(), which is useful for forwarding signals without
+    decoding them.
+    """
+
+    def __init__(self, buffer: Buffer):
+        self._buffer = memoryview(buffer).cast('B')
+        if len(self._buffer) < _HEADER.size:
+            raise ValueError("Buffer is too short to contain a signal batch.")
+        magic, version, count = _HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Buffer does not contain a signal batch.")
+        if version > FORMAT_VERSION:
+            raise ValueError("Unsupported signal encoding version: %s" % version)
+        self._version = version
+        offsets = []  # type: List[Tuple[int, int]]
+        offset = _HEADER.size
+        for _ in range(count):
+            if offset + _LENGTH.size > len(self._buffer):
+                raise ValueError("Truncated signal batch.")
+            length, = _LENGTH.unpack_from(self._buffer, offset)
+            offset += _LENGTH.size
+            if offset + length > len(self._buffer):
+                raise ValueError("Truncated signal batch.")
+            offsets.append((offset, offset + length))
+            offset += length
+        self._offsets = offsets
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        start, end = self._offsets[index]
+        return _read_signal(_Reader(self._buffer[:end], start))
+
+    def __iter__(self) -> Iterator[Signal]:
+        for start, end in self._offsets:
+            yield _read_signal(_Reader(self._buffer[:end], start))
+
+    def record(self, index: int) -> memoryview:
+        """Return a view of the raw encoded record for the signal at the given index."""
+        start, end = self._offsets[index]
+        return self._buffer[start:end]
@@ -5,10 +5,28 @@ from chatty.types import Content
 
 
 class Signal:
+    """Base class for signals. Signals are slotted and immutable, and expose their fields as read-only properties;
+    they compare by type, metadata and content, and hash by metadata, whose hash is computed once and cached.
+    Subclasses set their own fields in __init__() with object.__setattr__()."""
+
+    __slots__ = ('_meta_data', '_content')
 
     def __init__(self, meta_data: SignalMetaData, content: Content = None):
-        self._meta_data = meta_data
-        self._content = content
+        initialize = object.__setattr__
+        initialize(self, '_meta_data', meta_data)
+        initialize(self, '_content', content)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s objects are immutable." % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s objects are immutable." % type(self).__name__)
+
+    def __setstate__(self, state) -> None:
+        # Unpickling would otherwise restore the slots with setattr(), which is blocked.
+        _, slots = state
+        for name, value in slots.items():
+            object.__setattr__(self, name, value)
 
     @property
     def meta_data(self) -> SignalMetaData:
@@ -24,10 +42,10 @@ class Signal:
         return type(self) is type(other) and self._meta_data == other._meta_data and self._content == other._content
 
     def __ne__(self, other: 'Signal') -> bool:
-        if not isinstance(other, Signal):
-            return NotImplemented
-        return not (type(self) is type(other) and self._meta_data == other._meta_data and
-                    self._content == other._content)
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
     def __hash__(self) -> int:
         return hash(self._meta_data)
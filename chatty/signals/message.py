@@ -5,6 +5,8 @@ from chatty.types import Content
 
 class Message(Signal):
 
+    __slots__ = ()
+
     def __init__(self, meta_data: SignalMetaData, content: Content):
         super().__init__(meta_data, content)
 
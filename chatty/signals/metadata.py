@@ -1,26 +1,85 @@
 import datetime
+import sys
+from functools import lru_cache
 from typing import Sequence, Tuple, Optional
 
 from chatty.types import Handle, SignalID
 
 
+def intern_handle(handle: Optional[Handle]) -> Optional[Handle]:
+    """Return a canonical copy of the handle, so that equal handles share a single string object."""
+    if isinstance(handle, str):
+        return Handle(sys.intern(str(handle)))
+    return handle
+
+
+@lru_cache(maxsize=1024)
+def _intern_handle_tuple(handles: Tuple[Handle, ...]) -> Tuple[Handle, ...]:
+    return tuple(intern_handle(handle) for handle in handles)
+
+
+def intern_handles(handles: Optional[Sequence[Handle]]) -> Tuple[Handle, ...]:
+    """Return a canonical tuple of canonical handles. Recently seen sequences of handles, such as the member list of
+    a busy channel, map to a single shared tuple instead of a new copy per signal."""
+    if not handles:
+        return ()
+    handles = tuple(handles)
+    try:
+        return _intern_handle_tuple(handles)
+    except TypeError:  # Unhashable handles
+        return handles
+
+
 class SignalMetaData:
+    """The immutable metadata attached to a signal. Metadata objects compare and hash by value."""
+
+    __slots__ = ('_identifier', '_origin', '_addressees', '_visible_to', '_response_to', '_sent_at', '_received_at',
+                 '_room', '_hash')
 
     def __init__(self, *, identifier: SignalID = None, origin: Handle = None, addressees: Sequence[Handle] = None,
                  visible_to: Sequence[Handle] = None, response_to: SignalID = None, sent_at: datetime.datetime = None,
                  received_at: datetime.datetime = None, room: Handle = None):
-        self._identifier = identifier
-        self._origin = origin
-        self._addressees = tuple(addressees or ())
-        self._visible_to = tuple(visible_to or ())
-        self._response_to = response_to
-        self._sent_at = sent_at
-        self._received_at = received_at
-        self._room = room
+        initialize = object.__setattr__
+        initialize(self, '_identifier', identifier)
+        initialize(self, '_origin', intern_handle(origin))
+        initialize(self, '_addressees', intern_handles(addressees))
+        initialize(self, '_visible_to', intern_handles(visible_to))
+        initialize(self, '_response_to', response_to)
+        initialize(self, '_sent_at', sent_at)
+        initialize(self, '_received_at', received_at)
+        initialize(self, '_room', intern_handle(room))
+        initialize(self, '_hash', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s objects are immutable." % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s objects are immutable." % type(self).__name__)
+
+    def __reduce__(self):
+        return _rebuild_meta_data, self._fields()
 
     def __str__(self) -> str:
-        return '|'.join(str(item) for item in (self._identifier, self._origin, self._addressees, self._visible_to,
-                                               self._response_to, self._sent_at, self._received_at, self._room))
+        return '|'.join(str(item) for item in self._fields())
+
+    def __eq__(self, other: 'SignalMetaData') -> bool:
+        if not isinstance(other, SignalMetaData):
+            return NotImplemented
+        return self is other or self._fields() == other._fields()
+
+    def __ne__(self, other: 'SignalMetaData') -> bool:
+        if not isinstance(other, SignalMetaData):
+            return NotImplemented
+        return not (self is other or self._fields() == other._fields())
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash(self._fields()))
+        return self._hash
+
+    def _fields(self) -> tuple:
+        return (self._identifier, self._origin, self._addressees, self._visible_to, self._response_to, self._sent_at,
+                self._received_at, self._room)
 
     @property
     def identifier(self) -> Optional[SignalID]:
@@ -53,3 +112,8 @@ class SignalMetaData:
     @property
     def room(self) -> Optional[Handle]:
         return self._room
+
+
+def _rebuild_meta_data(identifier, origin, addressees, visible_to, response_to, sent_at, received_at, room):
+    return SignalMetaData(identifier=identifier, origin=origin, addressees=addressees, visible_to=visible_to,
+                          response_to=response_to, sent_at=sent_at, received_at=received_at, room=room)
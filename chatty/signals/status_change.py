@@ -5,10 +5,13 @@ from chatty.types import Content, StatusType, StatusValue
 
 class StatusChange(Signal):
 
+    __slots__ = ('_type', '_value')
+
     def __init__(self, meta_data: SignalMetaData, type_: StatusType, value: StatusValue, content: Content = None):
         super().__init__(meta_data, content)
-        self._type = type_
-        self._value = value
+        initialize = object.__setattr__
+        initialize(self, '_type', type_)
+        initialize(self, '_value', value)
 
     @property
     def type(self) -> StatusType:
@@ -17,3 +20,11 @@ class StatusChange(Signal):
     @property
     def value(self) -> StatusValue:
         return self._value
+
+    def __eq__(self, other: Signal) -> bool:
+        result = super().__eq__(other)
+        if result is True:
+            return self._type == other._type and self._value == other._value
+        return result
+
+    __hash__ = Signal.__hash__  # Defining __eq__ would otherwise make instances unhashable.
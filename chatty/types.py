@@ -15,6 +15,10 @@ Content = NewType('Content', Union[str, MIMEPart])
 StatusType = NewType('StatusType', str)
 StatusValue = NewType('StatusValue', str)
 
+OverflowPolicy = NewType('OverflowPolicy', str)
+
+RouteType = NewType('RouteType', str)
+
 HandleConfig = NamedTuple(
     'HandleConfig',
     [('label', str),
@@ -47,3 +51,17 @@ class PresenceStatusValues:
 class TypingStatusValues:
     STARTED = StatusValue('STARTED')
     STOPPED = StatusValue('STOPPED')
+
+
+class OverflowPolicies:
+    BLOCK = OverflowPolicy('BLOCK')  # Block the producer until there is room.
+    DROP_OLDEST = OverflowPolicy('DROP_OLDEST')  # Discard the oldest queued signal to make room.
+    DROP_NEWEST = OverflowPolicy('DROP_NEWEST')  # Discard the incoming signal.
+    DROP_STATUS_CHANGES = OverflowPolicy('DROP_STATUS_CHANGES')  # Discard status changes first; block for the rest.
+
+
+class RouteTypes:
+    HANDLE = RouteType('HANDLE')  # Matches signals with the handle among their addressees or visible_to.
+    PATTERN = RouteType('PATTERN')  # Like HANDLE, but the key is a wildcard pattern, e.g. 'support-*'.
+    ROOM = RouteType('ROOM')  # Matches signals sent in the room.
+    ORIGIN = RouteType('ORIGIN')  # Matches signals sent by the handle.
@@ -0,0 +1,98 @@
+import gc
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+
+from chatty.bots.interface import Bot
+from chatty.bots.process_pool import ProcessPoolBot
+from chatty.sessions.interface import Session
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.types import Handle
+
+
+class PidBot(Bot):
+    """Replies to each message with the content and the process ID of the worker that handled it."""
+
+    def receive(self, session, signal):
+        meta_data = SignalMetaData(origin=Handle('bot'), room=signal.meta_data.room)
+        session.send(Message(meta_data, '%s:%s' % (signal.content, os.getpid())))
+
+
+class StuckBot(Bot):
+    """Never returns from handling a signal."""
+
+    def receive(self, session, signal):
+        threading.Event().wait()
+
+
+class RecordingSession(Session):
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def join(self, timeout=None):
+        pass
+
+    def send(self, signal):
+        with self.lock:
+            self.sent.append(signal)
+
+
+def wait_for(condition, timeout: float = 30):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(.01)
+    return condition()
+
+
+class ProcessPoolBotTestCase(unittest.TestCase):
+
+    def test_replies_and_affinity(self):
+        session = RecordingSession()
+        bot = ProcessPoolBot(PidBot, workers=3)
+        try:
+            rooms = ['room%d' % index for index in range(6)]
+            for index in range(20):
+                for room in rooms:
+                    bot.receive(session, Message(SignalMetaData(origin=Handle('alice'), room=Handle(room)), str(index)))
+            self.assertTrue(wait_for(lambda: len(session.sent) == 20 * len(rooms)))
+        finally:
+            bot.close()
+
+        pids = set()
+        for room in rooms:
+            replies = [signal.content.split(':') for signal in session.sent if signal.meta_data.room == room]
+            self.assertEqual([int(index) for index, _ in replies], list(range(20)))
+            room_pids = {pid for _, pid in replies}
+            self.assertEqual(len(room_pids), 1)
+            pids |= room_pids
+        self.assertNotIn(str(os.getpid()), pids)
+
+    def test_sessions_not_retained(self):
+        session = RecordingSession()
+        bot = ProcessPoolBot(PidBot, workers=1)
+        try:
+            bot.receive(session, Message(SignalMetaData(origin=Handle('alice'), room=Handle('room')), 'hi'))
+            self.assertTrue(wait_for(lambda: len(session.sent) == 1))
+            del session
+            gc.collect()
+            self.assertEqual(bot.session_count, 0)
+        finally:
+            bot.close()
+
+    def test_close_terminates_stuck_workers(self):
+        bot = ProcessPoolBot(StuckBot, workers=1, close_timeout=.5)
+        bot.receive(RecordingSession(), Message(SignalMetaData(origin=Handle('alice'), room=Handle('room')), 'hi'))
+        start = time.time()
+        bot.close()
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+from chatty.bots.interface import Bot
+from chatty.bots.router import RouterBot
+from chatty.sessions.echo import EchoSession
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.types import Handle, RouteTypes
+
+
+class RecordingBot(Bot):
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+
+    def receive(self, session, signal):
+        self.received.append(signal)
+
+
+class RouterBotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = EchoSession()
+        self.router = RouterBot()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_routing(self):
+        direct = RecordingBot()
+        room = RecordingBot()
+        self.router.register_bot(Handle('bot'), direct)
+        self.router.register_bot(Handle('helpers-*'), direct, RouteTypes.PATTERN)
+        self.router.register_bot(Handle('general'), room, RouteTypes.ROOM)
+
+        # The direct bot matches on both its handle and its pattern, but should only get the signal once.
+        signal = Message(SignalMetaData(origin=Handle('alice'), addressees=[Handle('bot')],
+                                        visible_to=[Handle('helpers-eu')], room=Handle('general')), 'hi')
+        self.router.receive(self.session, signal)
+        self.assertEqual(direct.received, [signal])
+        self.assertEqual(room.received, [signal])
+
+        self.router.unregister_bot(Handle('general'), room, RouteTypes.ROOM)
+        self.router.receive(self.session, signal)
+        self.assertEqual(len(direct.received), 2)
+        self.assertEqual(len(room.received), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
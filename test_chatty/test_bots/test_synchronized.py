@@ -0,0 +1,241 @@
+import threading
+import time
+import unittest
+from collections import defaultdict
+
+from chatty.bots.interface import Bot
+from chatty.bots.synchronized import SynchronizedBot
+from chatty.sessions.echo import EchoSession
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.signals.status_change import StatusChange
+from chatty.types import Handle, OverflowPolicies, StatusTypes, TypingStatusValues
+
+
+class RecordingBot(Bot):
+
+    def __init__(self, delay: float = 0):
+        super().__init__()
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.received = defaultdict(list)
+        self.threads = defaultdict(set)
+
+    def receive(self, session, signal):
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.received[signal.meta_data.room].append(signal.content)
+            self.threads[signal.meta_data.room].add(threading.current_thread())
+
+    def count(self):
+        with self.lock:
+            return sum(len(contents) for contents in self.received.values())
+
+
+def make_message(room: str, index: int) -> Message:
+    return Message(SignalMetaData(origin=Handle('someone'), room=Handle(room)), index)
+
+
+def make_status_change(room: str, index: int) -> StatusChange:
+    return StatusChange(SignalMetaData(origin=Handle('someone'), room=Handle(room)), StatusTypes.TYPING,
+                        TypingStatusValues.STARTED, index)
+
+
+def wait_for(condition, timeout: float = 10):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(.001)
+    return condition()
+
+
+class SynchronizedBotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = EchoSession()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_single_worker(self):
+        wrapped = RecordingBot()
+        bot = SynchronizedBot(wrapped)
+        for index in range(100):
+            bot.receive(self.session, make_message('room', index))
+        self.assertTrue(wait_for(lambda: wrapped.count() == 100))
+        self.assertEqual(wrapped.received['room'], list(range(100)))
+        bot.close()
+
+    def test_invalid_worker_count(self):
+        with self.assertRaises(ValueError):
+            SynchronizedBot(RecordingBot(), workers=0)
+
+    def test_conversation_order_preserved(self):
+        wrapped = RecordingBot()
+        bot = SynchronizedBot(wrapped, workers=4)
+        rooms = ['room%s' % index for index in range(20)]
+        for index in range(50):
+            for room in rooms:
+                bot.receive(self.session, make_message(room, index))
+        self.assertTrue(wait_for(lambda: wrapped.count() == 50 * len(rooms)))
+        for room in rooms:
+            self.assertEqual(wrapped.received[room], list(range(50)))
+            self.assertEqual(len(wrapped.threads[room]), 1)
+        bot.close()
+
+    def test_conversations_run_in_parallel(self):
+        wrapped = RecordingBot(delay=.05)
+        # Use a deterministic key so that each room is guaranteed its own worker.
+        bot = SynchronizedBot(wrapped, workers=8, conversation_key=lambda signal: int(signal.meta_data.room[4:]))
+        rooms = ['room%s' % index for index in range(8)]
+        start = time.time()
+        for index in range(4):
+            for room in rooms:
+                bot.receive(self.session, make_message(room, index))
+        self.assertTrue(wait_for(lambda: wrapped.count() == 4 * len(rooms)))
+        elapsed = time.time() - start
+        # Serially, this would take at least 32 * .05 = 1.6 seconds.
+        self.assertLess(elapsed, 1.5)
+        bot.close()
+
+    def test_receive_does_not_wait_for_handler(self):
+        release = threading.Event()
+        wrapped = RecordingBot()
+        original_receive = wrapped.receive
+
+        def blocking_receive(session, signal):
+            release.wait()
+            original_receive(session, signal)
+
+        wrapped.receive = blocking_receive
+        bot = SynchronizedBot(wrapped)
+        bot.receive(self.session, make_message('room', 0))
+        time.sleep(.05)  # Give the worker time to pick up the first signal and block in the handler.
+        start = time.time()
+        for index in range(1, 10):
+            bot.receive(self.session, make_message('room', index))
+        self.assertLess(time.time() - start, .5)
+        release.set()
+        self.assertTrue(wait_for(lambda: wrapped.count() == 10))
+        self.assertEqual(wrapped.received['room'], list(range(10)))
+        bot.close()
+
+    def test_handler_errors_do_not_stop_worker(self):
+        wrapped = RecordingBot()
+        original_receive = wrapped.receive
+
+        def failing_receive(session, signal):
+            if signal.content == 0:
+                raise RuntimeError()
+            original_receive(session, signal)
+
+        wrapped.receive = failing_receive
+        bot = SynchronizedBot(wrapped)
+        for index in range(3):
+            bot.receive(self.session, make_message('room', index))
+        self.assertTrue(wait_for(lambda: wrapped.count() == 2))
+        self.assertEqual(wrapped.received['room'], [1, 2])
+        bot.close()
+
+    def fill_blocked_bot(self, overflow_policy, signals):
+        """Wrap a bot whose handler blocks until released, occupy its worker with a first signal, and then queue up
+        the given signals behind it."""
+        release = threading.Event()
+        started = threading.Event()
+        wrapped = RecordingBot()
+        original_receive = wrapped.receive
+
+        def blocking_receive(session, signal):
+            started.set()
+            release.wait()
+            original_receive(session, signal)
+
+        wrapped.receive = blocking_receive
+        bot = SynchronizedBot(wrapped, capacity=3, overflow_policy=overflow_policy)
+        bot.receive(self.session, make_message('room', 'first'))
+        self.assertTrue(started.wait(10))
+        for signal in signals:
+            bot.receive(self.session, signal)
+        return bot, wrapped, release
+
+    def test_invalid_capacity(self):
+        with self.assertRaises(ValueError):
+            SynchronizedBot(RecordingBot(), capacity=0)
+        with self.assertRaises(ValueError):
+            SynchronizedBot(RecordingBot(), overflow_policy='nonsense')
+
+    def test_capacity_bounds_taken_signals(self):
+        # Signals the worker has taken off the queue, but not yet handled, still count against the capacity.
+        entered = defaultdict(threading.Event)
+        release = defaultdict(threading.Event)
+        wrapped = RecordingBot()
+        original_receive = wrapped.receive
+
+        def blocking_receive(session, signal):
+            entered[signal.content].set()
+            release[signal.content].wait(10)
+            original_receive(session, signal)
+
+        wrapped.receive = blocking_receive
+        bot = SynchronizedBot(wrapped, capacity=3, overflow_policy=OverflowPolicies.DROP_NEWEST)
+        bot.receive(self.session, make_message('room', 0))
+        self.assertTrue(entered[0].wait(10))
+        for index in range(1, 4):
+            bot.receive(self.session, make_message('room', index))
+        release[0].set()
+        self.assertTrue(entered[1].wait(10))
+        for index in range(4, 7):
+            bot.receive(self.session, make_message('room', index))
+        self.assertEqual(bot.dropped_signals, 2)
+        for index in range(1, 7):
+            release[index].set()
+        self.assertTrue(wait_for(lambda: wrapped.count() == 5))
+        self.assertEqual(wrapped.received['room'], [0, 1, 2, 3, 4])
+        bot.close()
+
+    def test_drop_newest(self):
+        signals = [make_message('room', index) for index in range(5)]
+        bot, wrapped, release = self.fill_blocked_bot(OverflowPolicies.DROP_NEWEST, signals)
+        self.assertEqual(bot.dropped_signals, 2)
+        release.set()
+        self.assertTrue(wait_for(lambda: wrapped.count() == 4))
+        self.assertEqual(wrapped.received['room'], ['first', 0, 1, 2])
+        bot.close()
+
+    def test_drop_oldest(self):
+        signals = [make_message('room', index) for index in range(5)]
+        bot, wrapped, release = self.fill_blocked_bot(OverflowPolicies.DROP_OLDEST, signals)
+        self.assertEqual(bot.dropped_signals, 2)
+        release.set()
+        self.assertTrue(wait_for(lambda: wrapped.count() == 4))
+        self.assertEqual(wrapped.received['room'], ['first', 2, 3, 4])
+        bot.close()
+
+    def test_drop_status_changes(self):
+        signals = [make_message('room', 0), make_status_change('room', 1), make_message('room', 2),
+                   make_message('room', 3), make_status_change('room', 4)]
+        bot, wrapped, release = self.fill_blocked_bot(OverflowPolicies.DROP_STATUS_CHANGES, signals)
+        self.assertEqual(bot.dropped_signals, 2)
+        release.set()
+        self.assertTrue(wait_for(lambda: wrapped.count() == 4))
+        self.assertEqual(wrapped.received['room'], ['first', 0, 2, 3])
+        bot.close()
+
+    def test_block(self):
+        signals = [make_message('room', index) for index in range(3)]
+        bot, wrapped, release = self.fill_blocked_bot(OverflowPolicies.BLOCK, signals)
+        producer = threading.Thread(target=bot.receive, args=(self.session, make_message('room', 3)), daemon=True)
+        producer.start()
+        producer.join(.1)
+        self.assertTrue(producer.is_alive())
+        release.set()
+        producer.join(10)
+        self.assertFalse(producer.is_alive())
+        self.assertTrue(wait_for(lambda: wrapped.count() == 5))
+        self.assertEqual(wrapped.received['room'], ['first', 0, 1, 2, 3])
+        self.assertEqual(bot.dropped_signals, 0)
+        bot.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from chatty.rate_limiting import RateLimiter, TokenBucket
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=10, burst=3)
+        now = time.monotonic()
+        for _ in range(3):
+            self.assertEqual(bucket.delay(now), 0)
+            bucket.spend(now)
+        self.assertAlmostEqual(bucket.delay(now), .1, places=3)
+        self.assertEqual(bucket.delay(now + .1), 0)
+
+    def test_block(self):
+        bucket = TokenBucket(rate=None)
+        now = time.monotonic()
+        self.assertEqual(bucket.delay(now), 0)
+        bucket.block(now + 2)
+        self.assertAlmostEqual(bucket.delay(now), 2)
+        self.assertEqual(bucket.delay(now + 2), 0)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def test_destinations_are_independent(self):
+        limiter = RateLimiter(destination_rate=1)
+        self.assertEqual(limiter.try_acquire('general'), 0)
+        self.assertGreater(limiter.try_acquire('general'), 0)
+        self.assertEqual(limiter.try_acquire('random'), 0)
+        self.assertEqual(limiter.try_acquire('alice'), 0)
+
+    def test_global_budget(self):
+        limiter = RateLimiter(rate=1, burst=2, destination_rate=100)
+        self.assertEqual(limiter.try_acquire('a'), 0)
+        self.assertEqual(limiter.try_acquire('b'), 0)
+        self.assertGreater(limiter.try_acquire('c'), 0)
+
+    def test_acquire_waits(self):
+        limiter = RateLimiter(destination_rate=20)
+        start = time.monotonic()
+        for _ in range(4):
+            self.assertTrue(limiter.acquire('general'))
+        self.assertGreaterEqual(time.monotonic() - start, .14)
+
+    def test_acquire_timeout_and_interrupt(self):
+        limiter = RateLimiter(rate=.01)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire(timeout=.05))
+        interrupted = threading.Event()
+        threading.Timer(.05, interrupted.set).start()
+        self.assertFalse(limiter.acquire(interrupted=interrupted))
+
+    def test_retry_after(self):
+        limiter = RateLimiter(destination_rate=100)
+        limiter.retry_after(10, 'general')
+        self.assertGreater(limiter.try_acquire('general'), 9)
+        self.assertEqual(limiter.try_acquire('random'), 0)
+        limiter.retry_after(10)
+        self.assertGreater(limiter.try_acquire('random'), 9)
+
+    def test_idle_destinations_discarded(self):
+        limiter = RateLimiter(destination_rate=1000, max_destinations=10)
+        for index in range(100):
+            limiter.try_acquire(index)
+            time.sleep(.002)
+        self.assertLessEqual(limiter.destination_count, 11)
+
+    def test_expired_retry_after_discarded(self):
+        limiter = RateLimiter(max_destinations=10)
+        for index in range(100):
+            limiter.retry_after(.001, index)
+        time.sleep(.01)
+        limiter.retry_after(.001, 'last')
+        self.assertLessEqual(limiter.destination_count, 10)
+        count = limiter.destination_count
+        self.assertEqual(limiter.try_acquire(0), 0)
+        self.assertEqual(limiter.destination_count, count)  # No bucket for 0 again.
+
+    def test_busy_destinations_not_rescanned(self):
+        limiter = RateLimiter(destination_rate=.001, max_destinations=10)
+        for index in range(1000):
+            limiter.try_acquire(index)
+        with mock.patch.object(TokenBucket, 'is_idle', autospec=True, side_effect=TokenBucket.is_idle) as is_idle:
+            limiter.try_acquire('new')
+        self.assertLessEqual(is_idle.call_count, 2)
+        self.assertEqual(limiter.destination_count, 1001)  # Busy buckets are never discarded.
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+from chatty.routing import RoutingTable
+from chatty.signals.metadata import SignalMetaData
+from chatty.types import Handle, RouteTypes
+
+
+class RoutingTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RoutingTable()
+
+    def test_handle_routes(self):
+        self.table.add(RouteTypes.HANDLE, Handle('alice'), 'a')
+        self.table.add(RouteTypes.HANDLE, Handle('bob'), 'b')
+        self.table.add(RouteTypes.HANDLE, Handle('bob'), 'a')
+        self.assertEqual(self.table.resolve(SignalMetaData(addressees=['alice'])), {'a'})
+        self.assertEqual(self.table.resolve(SignalMetaData(visible_to=['bob'])), {'a', 'b'})
+        self.assertEqual(self.table.resolve(SignalMetaData(addressees=['carol'])), frozenset())
+
+    def test_room_and_origin_routes(self):
+        self.table.add(RouteTypes.ROOM, Handle('general'), 'room')
+        self.table.add(RouteTypes.ORIGIN, Handle('alice'), 'origin')
+        self.assertEqual(self.table.resolve(SignalMetaData(room='general', origin='bob')), {'room'})
+        self.assertEqual(self.table.resolve(SignalMetaData(room='random', origin='alice')), {'origin'})
+        # Origin and room routes don't match against addressees.
+        self.assertEqual(self.table.resolve(SignalMetaData(addressees=['general', 'alice'])), frozenset())
+
+    def test_pattern_routes(self):
+        self.table.add(RouteTypes.PATTERN, Handle('support-*'), 'prefix')
+        self.table.add(RouteTypes.PATTERN, Handle('*@example.com'), 'suffix')
+        self.table.add(RouteTypes.PATTERN, Handle('bot?'), 'single')
+        self.assertEqual(self.table.resolve(SignalMetaData(addressees=['support-eu'])), {'prefix'})
+        self.assertEqual(self.table.resolve(SignalMetaData(visible_to=['a@example.com', 'bot1'])),
+                         {'suffix', 'single'})
+        self.assertEqual(self.table.resolve(SignalMetaData(addressees=['support', 'bot12'])), frozenset())
+
+    def test_changes_invalidate_cache(self):
+        meta_data = SignalMetaData(room='general', addressees=['alice'])
+        self.assertEqual(self.table.resolve(meta_data), frozenset())
+        self.table.add(RouteTypes.HANDLE, Handle('alice'), 'a')
+        self.assertEqual(self.table.resolve(meta_data), {'a'})
+        self.table.add(RouteTypes.PATTERN, Handle('gen*'), 'b')
+        self.assertEqual(self.table.resolve(meta_data), {'a'})
+        self.table.add(RouteTypes.ROOM, Handle('general'), 'b')
+        self.assertEqual(self.table.resolve(meta_data), {'a', 'b'})
+        self.table.remove(RouteTypes.HANDLE, Handle('alice'), 'a')
+        self.assertEqual(self.table.resolve(meta_data), {'b'})
+        self.table.remove(RouteTypes.ROOM, Handle('general'), 'b')
+        self.assertEqual(self.table.resolve(meta_data), frozenset())
+
+    def test_member_list_changes(self):
+        self.table.add(RouteTypes.HANDLE, Handle('carol'), 'c')
+        self.assertEqual(self.table.resolve(SignalMetaData(room='general', visible_to=['alice', 'bob'])), frozenset())
+        self.assertEqual(self.table.resolve(SignalMetaData(room='general', visible_to=['alice', 'carol'])), {'c'})
+        self.assertEqual(self.table.resolve(SignalMetaData(room='general', visible_to=['alice', 'bob'])), frozenset())
+        # Without a room, signals with different member lists are cached separately.
+        self.assertEqual(self.table.resolve(SignalMetaData(visible_to=['carol'])), {'c'})
+        self.assertEqual(self.table.resolve(SignalMetaData(visible_to=['bob'])), frozenset())
+
+    def test_cache_size(self):
+        table = RoutingTable(cache_size=2)
+        table.add(RouteTypes.ROOM, Handle('room0'), 'a')
+        for index in range(5):
+            self.assertEqual(table.resolve(SignalMetaData(room='room%d' % index)), {'a'} if index == 0 else set())
+        self.assertEqual(table.resolve(SignalMetaData(room='room0')), {'a'})
+
+    def test_invalid_route_type(self):
+        with self.assertRaises(ValueError):
+            self.table.add('nonsense', Handle('alice'), 'a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from chatty.bots.asynchronous import AsyncBot, AsyncBotAdapter, SyncBotAdapter
+from chatty.bots.standard import make_bot
+from chatty.sessions.echo import AsyncEchoSession, EchoSession
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.types import Handle
+
+
+def make_message(content) -> Message:
+    return Message(SignalMetaData(origin=Handle('test1'), addressees=[Handle('test2')]), content)
+
+
+class RecordingAsyncBot(AsyncBot):
+
+    def __init__(self):
+        self.received = []
+
+    async def receive(self, session, signal):
+        await asyncio.sleep(0)
+        self.received.append(signal.content)
+
+
+class AsyncSessionTestCase(unittest.TestCase):
+
+    def test_async_bot(self):
+        async def run():
+            session = AsyncEchoSession()
+            bot = RecordingAsyncBot()
+            session.add_bot(bot)
+            for index in range(10):
+                await session.send(make_message(index))
+            await session.close()
+            await session.join()
+            return bot.received
+
+        self.assertEqual(asyncio.run(run()), list(range(10)))
+
+    def test_many_sessions_on_one_loop(self):
+        async def run():
+            sessions = [AsyncEchoSession() for _ in range(200)]
+            bots = [RecordingAsyncBot() for _ in sessions]
+            for session, bot in zip(sessions, bots):
+                session.add_bot(bot)
+            await asyncio.gather(*[session.send(make_message(index)) for index, session in enumerate(sessions)])
+            return [bot.received for bot in bots]
+
+        self.assertEqual(asyncio.run(run()), [[index] for index in range(200)])
+
+    def test_sync_bot_on_async_session(self):
+        received = []
+
+        def converse(session, signal):
+            received.append(signal.content)
+            if signal.content == 'ping':
+                return make_message('pong')
+
+        async def run():
+            session = AsyncEchoSession()
+            session.add_bot(AsyncBotAdapter(make_bot(converse)))
+            await session.send(make_message('ping'))
+
+        asyncio.run(run())
+        self.assertEqual(received, ['ping', 'pong'])
+
+    def test_nested_replies(self):
+        received = []
+
+        def count(session, signal):
+            received.append(signal.content)
+            if signal.content < 3:
+                return make_message(signal.content + 1)
+
+        async def run():
+            # With a single thread to share, the loop's default executor alone couldn't handle nested replies.
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(1))
+            session = AsyncEchoSession()
+            bot = AsyncBotAdapter(make_bot(count))
+            session.add_bot(bot)
+            await session.send(make_message(0))
+            await bot.close()
+
+        thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(received, [0, 1, 2, 3])
+
+    def test_async_bot_on_sync_session(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            received = []
+
+            class PingBot(AsyncBot):
+                async def receive(self, session, signal):
+                    received.append(signal.content)
+                    if signal.content == 'ping':
+                        await session.send(make_message('pong'))
+
+            session = EchoSession()
+            session.add_bot(SyncBotAdapter(PingBot(), loop))
+            session.send(make_message('ping'))
+            session.close()
+            self.assertEqual(received, ['ping', 'pong'])
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import threading
+import time
+import unittest
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+from chatty.bots.interface import Bot
+from chatty.sessions.dispatcher import ParallelDispatcher
+from chatty.sessions.echo import EchoSession
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.types import Handle
+
+
+def make_message(content) -> Message:
+    return Message(SignalMetaData(origin=Handle('test1'), addressees=[Handle('test2')]), content)
+
+
+class RecordingBot(Bot):
+
+    def __init__(self, release: threading.Event = None):
+        super().__init__()
+        self.release = release
+        self.received = []
+
+    def receive(self, session, signal):
+        if self.release is not None:
+            self.release.wait()
+        self.received.append(signal.content)
+
+
+class CountingBot(Bot):
+    """Sends each number it receives, plus one, back through the session, until it reaches the limit."""
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.received = []
+
+    def receive(self, session, signal):
+        self.received.append(signal.content)
+        if signal.content < self.limit:
+            session.send(make_message(signal.content + 1))
+
+
+class ManualExecutor(Executor):
+    """Runs submitted tasks only when run() is called."""
+
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.tasks.append((fn, args, kwargs))
+
+    def run(self):
+        while self.tasks:
+            fn, args, kwargs = self.tasks.pop(0)
+            fn(*args, **kwargs)
+
+
+def wait_for(condition, timeout: float = 10):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(.001)
+    return condition()
+
+
+class ParallelDispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = EchoSession()
+        self.dispatcher = ParallelDispatcher(max_in_flight=5)
+        self.session.dispatcher = self.dispatcher
+
+    def tearDown(self):
+        self.dispatcher.close(wait=False)
+        self.session.close()
+
+    def test_per_bot_order(self):
+        bots = [RecordingBot() for _ in range(5)]
+        for bot in bots:
+            self.session.add_bot(bot)
+        for index in range(200):
+            self.session.receive(make_message(index))
+        for bot in bots:
+            self.assertTrue(wait_for(lambda: len(bot.received) == 200))
+            self.assertEqual(bot.received, list(range(200)))
+
+    def test_slow_bot_does_not_delay_others(self):
+        release = threading.Event()
+        slow = RecordingBot(release)
+        fast = RecordingBot()
+        self.session.add_bot(slow)
+        self.session.add_bot(fast)
+        for index in range(3):
+            self.session.receive(make_message(index))
+        self.assertTrue(wait_for(lambda: len(fast.received) == 3))
+        self.assertEqual(slow.received, [])
+        release.set()
+        self.assertTrue(wait_for(lambda: len(slow.received) == 3))
+
+    def test_in_flight_cap(self):
+        release = threading.Event()
+        slow = RecordingBot(release)
+        self.session.add_bot(slow)
+        for index in range(5):
+            self.session.receive(make_message(index))
+        self.assertEqual(self.dispatcher.in_flight(slow), 5)
+        producer = threading.Thread(target=self.session.receive, args=(make_message(5),), daemon=True)
+        producer.start()
+        producer.join(.1)
+        self.assertTrue(producer.is_alive())
+        release.set()
+        producer.join(10)
+        self.assertFalse(producer.is_alive())
+        self.assertTrue(wait_for(lambda: len(slow.received) == 6))
+        self.assertEqual(slow.received, list(range(6)))
+        self.assertTrue(wait_for(lambda: self.dispatcher.in_flight(slow) == 0))
+
+    def test_in_flight_count(self):
+        # The bot's task doesn't start until the executor is told to run it.
+        executor = ManualExecutor()
+        dispatcher = ParallelDispatcher(executor, max_in_flight=2)
+        bot = RecordingBot()
+        dispatcher.dispatch(self.session, bot, make_message(0))
+        self.assertEqual(dispatcher.in_flight(bot), 1)
+        producer = threading.Thread(target=dispatcher.dispatch, args=(self.session, bot, make_message(1)), daemon=True)
+        producer.start()
+        producer.join(10)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(dispatcher.in_flight(bot), 2)
+        executor.run()
+        self.assertEqual(bot.received, [0, 1])
+        self.assertEqual(dispatcher.in_flight(bot), 0)
+        dispatcher.close()
+
+    def test_reentrant_send_at_cap(self):
+        dispatcher = ParallelDispatcher(max_in_flight=1)
+        self.addCleanup(dispatcher.close, wait=False)
+        self.session.dispatcher = dispatcher
+        bot = CountingBot(20)
+        self.session.add_bot(bot)
+        self.session.receive(make_message(0))
+        self.assertTrue(wait_for(lambda: len(bot.received) == 21, timeout=2))
+        self.assertEqual(bot.received, list(range(21)))
+
+    def test_executor_shut_down(self):
+        # Stands in for close() shutting the executor down between the liveness check and the submit.
+        executor = ThreadPoolExecutor(1)
+        dispatcher = ParallelDispatcher(executor)
+        executor.shutdown()
+        bot = RecordingBot()
+        dispatcher.dispatch(self.session, bot, make_message(0))
+        self.assertEqual(dispatcher.in_flight(bot), 0)
+        self.assertEqual(bot.received, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
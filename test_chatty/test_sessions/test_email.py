@@ -1,11 +1,21 @@
 import datetime
+import email.message
 import imaplib
+import json
+import os
+import pickle
+import shutil
 import smtplib
+import socket
+import tempfile
+import threading
 import time
 import unittest
 from typing import Tuple
 
-from chatty.sessions.email import EmailSession, SMTPFactory, IMAPFactory
+from chatty.bots.interface import Bot
+from chatty.sessions.email import EmailSession, SMTPFactory, IMAPFactory, IMAPScheduler, SMTPConnectionPool, \
+    LazyEmailMessage, has_delivery_status_headers, imap_idle, is_delivery_status_notification
 from chatty.sessions.interface import Session
 from chatty.signals.delivery_failure import DeliveryFailure
 from chatty.signals.message import Message
@@ -59,5 +69,517 @@ class EmailSessionTestCase(BaseClasses.SessionTestCase):
         assert failure.meta_data.identifier == meta_data.identifier
 
 
+class FakeSMTP:
+    """Stands in for an authenticated smtplib.SMTP connection."""
+
+    def __init__(self, disconnect_after: int = None, refuse=()):
+        self.sent = []
+        self.noops = 0
+        self.closed = False
+        self.disconnect_after = disconnect_after
+        self.refuse = set(refuse)
+
+    def send_message(self, message, to_addrs=None):
+        if self.closed or (self.disconnect_after is not None and len(self.sent) >= self.disconnect_after):
+            self.closed = True
+            raise smtplib.SMTPServerDisconnected()
+        self.sent.append(message)
+        return {}
+
+    def sendmail(self, from_addr, to_addrs, message):
+        refused = {recipient: (550, b'No such user') for recipient in to_addrs if recipient in self.refuse}
+        if len(refused) == len(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        self.sent.append((from_addr, [recipient for recipient in to_addrs if recipient not in refused], message))
+        return refused
+
+    def noop(self):
+        self.noops += 1
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected()
+        return 250, b'OK'
+
+    def rset(self):
+        pass
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class SMTPConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+
+    def factory(self, **kwargs):
+        def make():
+            connection = FakeSMTP(**kwargs)
+            self.created.append(connection)
+            return connection
+        return make
+
+    def test_reuse(self):
+        pool = SMTPConnectionPool(self.factory())
+        for index in range(10):
+            pool.send_message('message %s' % index)
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(len(self.created[0].sent), 10)
+        pool.close()
+        self.assertTrue(self.created[0].closed)
+
+    def test_max_messages(self):
+        pool = SMTPConnectionPool(self.factory(), max_messages=3)
+        for index in range(7):
+            pool.send_message('message %s' % index)
+        self.assertEqual([len(connection.sent) for connection in self.created], [3, 3, 1])
+
+    def test_reconnect_on_disconnect(self):
+        pool = SMTPConnectionPool(self.factory(disconnect_after=2))
+        for index in range(5):
+            pool.send_message('message %s' % index)
+        self.assertEqual(sum(len(connection.sent) for connection in self.created), 5)
+        self.assertEqual(len(self.created), 3)
+
+    def test_keepalive(self):
+        pool = SMTPConnectionPool(self.factory(), keepalive_interval=0)
+        pool.send_message('first')
+        self.created[0].closed = True  # The server dropped the idle connection.
+        pool.send_message('second')
+        self.assertEqual(self.created[0].noops, 1)
+        self.assertEqual(len(self.created), 2)
+        self.assertEqual(self.created[1].sent, ['second'])
+
+    def test_periodic_keepalive(self):
+        pool = SMTPConnectionPool(self.factory(), keepalive_interval=.05)
+        self.addCleanup(pool.close)
+        pool.send_message('first')
+        end = time.monotonic() + 5
+        while self.created[0].noops < 2 and time.monotonic() < end:
+            time.sleep(.01)
+        self.assertGreaterEqual(self.created[0].noops, 2)  # Pinged repeatedly while idle.
+        self.created[0].closed = True  # The server dropped the idle connection anyway.
+        while pool.idle_connections and time.monotonic() < end:
+            time.sleep(.01)
+        self.assertEqual(pool.idle_connections, 0)
+        pool.send_message('second')
+        self.assertEqual(len(self.created), 2)
+
+    def test_send_messages(self):
+        pool = SMTPConnectionPool(self.factory(disconnect_after=2))
+        results = pool.send_messages(['message %s' % index for index in range(5)])
+        self.assertEqual(results, [{}] * 5)
+        self.assertEqual(sum(len(connection.sent) for connection in self.created), 5)
+        self.assertEqual(len(self.created), 3)
+
+
+class NullScheduler:
+    """Keeps an EmailSession from reading mail at all."""
+
+    def add(self, session):
+        pass
+
+    def remove(self, session):
+        pass
+
+
+class BulkSendTestCase(unittest.TestCase):
+
+    def test_batches_and_failures(self):
+        connections = []
+        refuse = {'user7@example.com', 'user42@example.com'} | {'user%d@example.com' % i for i in range(60, 70)}
+
+        def connect():
+            connection = FakeSMTP(refuse=refuse)
+            connections.append(connection)
+            return connection
+
+        session = EmailSession(connect, None, smtp_pool_size=3, max_recipients=10, scheduler=NullScheduler())
+        failures = []
+        session.receive = failures.append
+        recipients = ['user%d@example.com' % index for index in range(95)]
+        session.send(Message(SignalMetaData(identifier=SignalID('announcement'), origin=Handle('news@example.com'),
+                                            addressees=recipients), 'News!'))
+        session.close()
+
+        sent = [transaction for connection in connections for transaction in connection.sent]
+        self.assertEqual(len(sent), 9)  # One batch was refused outright.
+        self.assertTrue(all(len(to_addrs) <= 10 for _, to_addrs, _ in sent))
+        self.assertEqual(sorted(recipient for _, to_addrs, _ in sent for recipient in to_addrs),
+                         sorted(set(recipients) - refuse))
+        self.assertLessEqual(len(connections), 3)
+        self.assertEqual(sorted(failure.meta_data.origin for failure in failures), sorted(refuse))
+        self.assertTrue(all(isinstance(failure, DeliveryFailure) and failure.error_code == '550' and
+                            failure.meta_data.response_to == 'announcement' for failure in failures))
+
+    def test_send_batch(self):
+        connections = []
+
+        def connect():
+            connection = FakeSMTP()
+            connections.append(connection)
+            return connection
+
+        session = EmailSession(connect, None, smtp_pool_size=2, scheduler=NullScheduler())
+        session.send_batch([Message(SignalMetaData(origin=Handle('news@example.com'),
+                                                   addressees=[Handle('user%d@example.com' % index)]), 'News!')
+                            for index in range(10)])
+        session.close()
+        self.assertLessEqual(len(connections), 2)
+        self.assertEqual(sorted(message['to'] for connection in connections for message in connection.sent),
+                         sorted('user%d@example.com' % index for index in range(10)))
+
+
+class FakeIdleIMAP:
+    """Stands in for an imaplib.IMAP4 connection, with a scripted server on the other end of a socket pair."""
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+
+    def __init__(self, notification: bytes = None, delay: float = .1):
+        self._client, self._server = socket.socketpair()
+        self.file = self._client.makefile('rb')
+        self._notification = notification
+        self._delay = delay
+        self._server_thread = threading.Thread(target=self._serve, daemon=True)
+        self._server_thread.start()
+
+    def _serve(self):
+        server_file = self._server.makefile('rb')
+        assert server_file.readline() == b'A001 IDLE\r\n'
+        self._server.sendall(b'+ idling\r\n')
+        if self._notification:
+            time.sleep(self._delay)
+            self._server.sendall(self._notification)
+        assert server_file.readline() == b'DONE\r\n'
+        self._server.sendall(b'A001 OK IDLE terminated\r\n')
+
+    # noinspection PyMethodMayBeStatic
+    def _new_tag(self):
+        return b'A001'
+
+    def send(self, data):
+        self._client.sendall(data)
+
+    def readline(self):
+        return self.file.readline()
+
+    def socket(self):
+        return self._client
+
+
+class IMAPIdleTestCase(unittest.TestCase):
+
+    def test_wakes_on_new_mail(self):
+        connection = FakeIdleIMAP(b'* OK Still here\r\n* 4 EXISTS\r\n')
+        start = time.monotonic()
+        self.assertTrue(imap_idle(connection, 10))
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_timeout(self):
+        connection = FakeIdleIMAP()
+        start = time.monotonic()
+        self.assertFalse(imap_idle(connection, .2))
+        self.assertGreaterEqual(time.monotonic() - start, .2)
+
+    def test_interrupted(self):
+        connection = FakeIdleIMAP()
+        interrupted = threading.Event()
+        threading.Timer(.1, interrupted.set).start()
+        start = time.monotonic()
+        self.assertFalse(imap_idle(connection, 10, interrupted))
+        self.assertLess(time.monotonic() - start, 5)
+
+
+class FakeMailbox:
+    """Stands in for an authenticated imaplib.IMAP4 connection with a mailbox selected, without IDLE support."""
+
+    capabilities = ()
+
+    def __init__(self, uid_validity: int = 1):
+        self.uid_validity = uid_validity
+        self.messages = {}
+        self.searches = []
+        self.fetches = []
+        self.logged_out = False
+        self.lock = threading.Lock()
+
+    def add(self, uid: int, subject: str, age: datetime.timedelta = datetime.timedelta(minutes=-1)):
+        date = datetime.datetime.now(datetime.timezone.utc) - age
+        with self.lock:
+            self.messages[uid] = ('From: alice@example.com\r\nTo: bob@example.com\r\nDate: %s\r\n'
+                                  'Subject: %s\r\n\r\nHello.\r\n' %
+                                  (date.strftime('%a, %d %b %Y %H:%M:%S +0000'), subject)).encode()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def logout(self):
+        self.logged_out = True
+
+    def response(self, code):
+        return code, [str(self.uid_validity).encode()]
+
+    def uid(self, command, *args):
+        with self.lock:
+            if command == 'search':
+                where = args[1]
+                self.searches.append(where)
+                uids = sorted(self.messages)
+                if where.startswith('UID '):
+                    start = int(where[4:].split(':')[0])
+                    uids = [uid for uid in uids if uid >= start] or uids[-1:]
+                return 'OK', [' '.join(str(uid) for uid in uids).encode()]
+            if command == 'fetch':
+                uid_set, query = args
+                self.fetches.append((uid_set, query))
+                uids = set()
+                for piece in uid_set.split(','):
+                    start, _, end = piece.partition(':')
+                    uids.update(range(int(start), int(end or start) + 1))
+                data = []
+                for uid in sorted(uids & set(self.messages)):
+                    message = self.messages[uid]
+                    item = query[5:-1]
+                    if 'HEADER' in query:
+                        item = item.replace('RFC822.SIZE', 'RFC822.SIZE %d' % len(message))
+                        message = message[:message.index(b'\r\n\r\n') + 4]
+                    data.append((b'1 (UID %d %s {%d}' % (uid, item.encode(), len(message)), message))
+                    data.append(b')')
+                return 'OK', data
+        raise AssertionError(command)
+
+
+class RecordingBot(Bot):
+
+    def __init__(self):
+        super().__init__()
+        self.subjects = []
+
+    def receive(self, session, signal):
+        self.subjects.append(signal.content['subject'])
+
+
+class IMAPSyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.directory, 'checkpoint.json')
+        self.mailbox = FakeMailbox(uid_validity=7)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def sync(self, *expected, **kwargs):
+        bot = RecordingBot()
+        ready = threading.Event()
+
+        def connect():
+            ready.wait()  # Don't deliver anything until the bot has been added.
+            return self.mailbox
+
+        session = EmailSession(None, connect, rate=.05, min_rate=.01, checkpoint_path=self.checkpoint_path, **kwargs)
+        session.add_bot(bot)
+        ready.set()
+        end = time.time() + 5
+        while len(bot.subjects) < len(expected) and time.time() < end:
+            time.sleep(.01)
+        time.sleep(.1)
+        session.close()
+        self.assertEqual(bot.subjects, list(expected))
+
+    def test_incremental(self):
+        self.mailbox.add(3, 'first')
+        self.mailbox.add(5, 'second')
+        self.sync('first', 'second')
+        self.assertTrue(self.mailbox.searches[0].startswith('(SENTSINCE'))
+        self.assertIn('UID 6:*', self.mailbox.searches)
+        with open(self.checkpoint_path) as file:
+            self.assertEqual(json.load(file), {'uid_validity': 7, 'last_uid': 5})
+
+        # A restarted session only picks up new mail.
+        self.mailbox.add(8, 'third')
+        self.mailbox.searches.clear()
+        self.sync('third')
+        self.assertFalse(any(where.startswith('(SENTSINCE') for where in self.mailbox.searches))
+
+    def test_header_first_batches(self):
+        self.mailbox.add(1, 'old', age=datetime.timedelta(days=3))
+        for uid in range(2, 6):
+            self.mailbox.add(uid, 'new %d' % uid)
+        self.sync('new 2', 'new 3', 'new 4', 'new 5')
+        self.assertEqual(self.mailbox.fetches, [('1:5', '(UID RFC822.SIZE BODY.PEEK[HEADER])'),
+                                                ('2:5', '(UID RFC822)')])
+
+    def test_bodies_grouped_by_size(self):
+        for uid in range(1, 6):
+            self.mailbox.add(uid, 'message %d' % uid)
+        size = len(self.mailbox.messages[1])
+        self.sync(*['message %d' % uid for uid in range(1, 6)], spool_threshold=size * 2)
+        self.assertEqual(self.mailbox.fetches[1:], [('1:2', '(UID RFC822)'), ('3:4', '(UID RFC822)'),
+                                                    ('5', '(UID RFC822)')])
+
+    def test_uid_validity_change(self):
+        self.mailbox.add(1, 'first')
+        self.sync('first')
+        self.mailbox.uid_validity = 8
+        self.sync('first')
+
+
+class IMAPSchedulerTestCase(unittest.TestCase):
+
+    def test_many_mailboxes(self):
+        scheduler = IMAPScheduler(workers=2)
+        mailboxes = [FakeMailbox() for _ in range(20)]
+        sessions = []
+        bots = []
+        for index, mailbox in enumerate(mailboxes):
+            mailbox.add(1, 'first %d' % index)
+            bot = RecordingBot()
+            ready = threading.Event()
+            session = EmailSession(None, lambda mailbox=mailbox, ready=ready: ready.wait() and mailbox,
+                                   rate=.05, min_rate=.01, scheduler=scheduler)
+            session.add_bot(bot)
+            ready.set()
+            sessions.append(session)
+            bots.append(bot)
+        self.assertEqual(scheduler.session_count, 20)
+
+        end = time.time() + 5
+        while any(not bot.subjects for bot in bots) and time.time() < end:
+            time.sleep(.01)
+        for index, mailbox in enumerate(mailboxes):
+            mailbox.add(2, 'second %d' % index)
+        while any(len(bot.subjects) < 2 for bot in bots) and time.time() < end:
+            time.sleep(.01)
+        self.assertEqual([bot.subjects for bot in bots],
+                         [['first %d' % index, 'second %d' % index] for index in range(20)])
+
+        for session in sessions:
+            session.close()
+        self.assertEqual(scheduler.session_count, 0)
+        self.assertTrue(all(mailbox.logged_out for mailbox in mailboxes))
+        scheduler.close()
+
+
+class LazyEmailMessageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        message = email.message.EmailMessage()
+        message['From'] = 'alice@example.com'
+        message['To'] = 'bob@example.com'
+        message['Subject'] = 'Report'
+        message.set_content('See attached.')
+        message.add_attachment(bytes(100000), maintype='application', subtype='octet-stream', filename='report.bin')
+        self.raw = message.as_bytes()
+
+    def test_headers_without_parsing(self):
+        message = LazyEmailMessage(self.raw, spool_threshold=1000)
+        self.assertEqual(message['subject'], 'Report')
+        self.assertEqual(message.get_content_type(), 'multipart/mixed')
+        self.assertEqual(message.as_bytes(), self.raw)
+        self.assertFalse(message.parsed)
+
+    def test_changed_headers(self):
+        message = LazyEmailMessage(self.raw, spool_threshold=1000)
+        del message['from']
+        message['From'] = 'carol@example.com'
+        message['Cc'] = 'dave@example.com'
+        reparsed = email.message_from_bytes(message.as_bytes())
+        self.assertFalse(message.parsed)
+        self.assertEqual(reparsed['from'], 'carol@example.com')
+        self.assertEqual(reparsed['cc'], 'dave@example.com')
+        self.assertEqual(reparsed.get_payload()[0].get_payload(), 'See attached.\n')
+        self.assertTrue(self.raw.endswith(message.as_bytes().split(b'\n\n', 1)[1]))
+
+    def test_parse_on_demand(self):
+        message = LazyEmailMessage(self.raw, spool_threshold=1000)
+        self.assertEqual([part.get_content_type() for part in message.walk()],
+                         ['multipart/mixed', 'text/plain', 'application/octet-stream'])
+        self.assertTrue(message.parsed)
+        self.assertEqual(len(message.get_payload()[1].get_payload(decode=True)), 100000)
+
+    def test_concurrent_access(self):
+        for _ in range(20):
+            message = LazyEmailMessage(self.raw, spool_threshold=1000)
+            barrier = threading.Barrier(6)
+            results = []
+            errors = []
+
+            def read(method):
+                try:
+                    barrier.wait()
+                    if method == 'walk':
+                        results.append([part.get_content_type() for part in message.walk()])
+                    elif method == 'parts':
+                        results.append([part.get_content_type() for part in message.iter_part_headers()])
+                    else:
+                        reparsed = email.message_from_bytes(message.as_bytes())
+                        results.append([part.get_content_type() for part in reparsed.walk()])
+                except Exception as exc:
+                    errors.append(exc)
+
+            threads = [threading.Thread(target=read, args=(method,)) for method in ['walk', 'parts', 'bytes'] * 2]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(len(results), 6)
+            for result in results:
+                self.assertIn(result, [['multipart/mixed', 'text/plain', 'application/octet-stream'],
+                                       ['text/plain', 'application/octet-stream']])
+
+    def test_pickle(self):
+        message = pickle.loads(pickle.dumps(LazyEmailMessage(self.raw)))
+        self.assertEqual(message['subject'], 'Report')
+        self.assertEqual(len(message.get_payload()), 2)
+
+
+class DeliveryStatusTestCase(unittest.TestCase):
+
+    def test_headers(self):
+        self.assertTrue(has_delivery_status_headers(b'From: Mail Delivery System\r\n <MAILER-DAEMON@example.com>\r\n'
+                                                    b'Subject: Undelivered\r\n\r\nBody'))
+        self.assertTrue(has_delivery_status_headers(b'Content-Type: multipart/report; report-type=delivery-status\n'))
+        self.assertTrue(has_delivery_status_headers(b'Subject: Delivery Status Notification (Failure)\r\n'))
+        self.assertTrue(has_delivery_status_headers(b'X-Failed-Recipients: bob@example.com\r\n'))
+        self.assertFalse(has_delivery_status_headers(b'Subject: Hello\r\n\r\nFrom: mailer-daemon@example.com\r\n'))
+
+    def test_missing_from(self):
+        message = email.message.EmailMessage()
+        message['Subject'] = 'No sender'
+        message.set_content('Hello.')
+        self.assertFalse(is_delivery_status_notification(message))
+
+    def test_delivery_status_part(self):
+        raw = (b'From: postmaster@example.com\r\nContent-Type: multipart/mixed; boundary="b"\r\n\r\n'
+               b'--b\r\nContent-Type: text/plain\r\n\r\nFailed.\r\n'
+               b'--b\r\nContent-Type: message/delivery-status\r\n\r\nAction: failed\r\n--b--\r\n')
+        message = LazyEmailMessage(raw)
+        self.assertTrue(is_delivery_status_notification(message))
+        self.assertFalse(message.parsed)
+        self.assertTrue(is_delivery_status_notification(email.message_from_bytes(raw)))
+
+    def test_forwarded_bounce(self):
+        raw = (b'From: alice@example.com\r\nContent-Type: multipart/mixed; boundary="b"\r\n\r\n'
+               b'--b\r\nContent-Type: text/plain\r\n\r\nWhat does this mean?\r\n'
+               b'--b\r\nContent-Type: message/rfc822\r\n\r\n'
+               b'From: postmaster@example.com\r\nContent-Type: multipart/report; boundary="c"\r\n\r\n'
+               b'--c\r\nContent-Type: message/delivery-status\r\n\r\nAction: failed\r\n--c--\r\n'
+               b'--b--\r\n')
+        message = LazyEmailMessage(raw)
+        self.assertEqual([part.get_content_type() for part in message.iter_part_headers()],
+                         ['text/plain', 'message/rfc822'])
+        self.assertFalse(is_delivery_status_notification(message))
+        self.assertFalse(message.parsed)
+        self.assertFalse(is_delivery_status_notification(email.message_from_bytes(raw)))
+
+
 if __name__ == '__main__':
     unittest.main()
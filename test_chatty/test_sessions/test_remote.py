@@ -0,0 +1,148 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from chatty.bots.interface import Bot
+from chatty.bots.remote import RemoteBot
+from chatty.sessions.interface import Session
+from chatty.sessions.remote import FRAME_HEADER, RemoteSession, read_frame
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.types import Handle
+
+
+class ReplyBot(Bot):
+    """Replies to every message on the session it came from."""
+
+    def receive(self, session, signal):
+        session.send(Message(SignalMetaData(origin=Handle('bot'), addressees=[signal.meta_data.origin]),
+                             'Re: %s' % signal.content))
+
+
+class RecordingSession(Session):
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def join(self, timeout=None):
+        pass
+
+    def send(self, signal):
+        with self.lock:
+            self.sent.append(signal.content)
+
+
+def make_message(content) -> Message:
+    return Message(SignalMetaData(origin=Handle('alice'), addressees=[Handle('bot')]), content)
+
+
+def wait_for(condition, timeout: float = 10):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(.005)
+    return condition()
+
+
+class RemoteSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.closeables = []
+
+    def tearDown(self):
+        for closeable in reversed(self.closeables):
+            closeable.close()
+        shutil.rmtree(self.directory)
+
+    def make_server(self, address):
+        server = RemoteSession(address)
+        server.add_bot(ReplyBot())
+        self.closeables.append(server)
+        return server
+
+    def check_round_trip(self, address):
+        server = self.make_server(address)
+        first, second = RecordingSession(), RecordingSession()
+        bot = RemoteBot(server.address)
+        self.closeables.append(bot)
+        for index in range(50):
+            bot.receive(first, make_message('first %d' % index))
+            bot.receive(second, make_message('second %d' % index))
+        self.assertTrue(wait_for(lambda: len(first.sent) == 50 and len(second.sent) == 50))
+        self.assertEqual(first.sent, ['Re: first %d' % index for index in range(50)])
+        self.assertEqual(second.sent, ['Re: second %d' % index for index in range(50)])
+
+    def test_tcp(self):
+        self.check_round_trip(('127.0.0.1', 0))
+
+    def test_unix_socket(self):
+        self.check_round_trip(os.path.join(self.directory, 'remote.sock'))
+
+    def test_default_channel(self):
+        server = self.make_server(('127.0.0.1', 0))
+        default = RecordingSession()
+        bot = RemoteBot(server.address, default_session=default)
+        self.closeables.append(bot)
+        self.assertTrue(wait_for(lambda: server.connection_count == 1))
+        server.send(make_message('broadcast'))
+        self.assertTrue(wait_for(lambda: default.sent == ['broadcast']))
+        server.send_batch([make_message('first'), make_message('second')])
+        self.assertTrue(wait_for(lambda: default.sent == ['broadcast', 'first', 'second']))
+
+    def test_reconnect(self):
+        address = os.path.join(self.directory, 'remote.sock')
+        server = self.make_server(address)
+        session = RecordingSession()
+        bot = RemoteBot(address, reconnect_delay=.01, max_reconnect_delay=.05)
+        self.closeables.append(bot)
+        bot.receive(session, make_message('0'))
+        self.assertTrue(wait_for(lambda: len(session.sent) == 1))
+
+        server.close()
+        self.assertTrue(wait_for(lambda: not bot.connected))
+        for index in range(1, 10):
+            bot.receive(session, make_message(str(index)))
+        time.sleep(.1)
+        self.assertEqual(len(session.sent), 1)
+
+        self.make_server(address)
+        self.assertTrue(wait_for(lambda: len(session.sent) == 10))
+        self.assertEqual(session.sent, ['Re: %d' % index for index in range(10)])
+
+    def test_no_signals_before_bots(self):
+        address = os.path.join(self.directory, 'remote.sock')
+        server = RemoteSession(address)
+        self.closeables.append(server)
+        session = RecordingSession()
+        bot = RemoteBot(address, reconnect_delay=.01, max_reconnect_delay=.05)
+        self.closeables.append(bot)
+        bot.receive(session, make_message('0'))
+        time.sleep(.1)
+        server.add_bot(ReplyBot())
+        self.assertTrue(wait_for(lambda: session.sent == ['Re: 0']))
+
+    def test_existing_file_not_removed(self):
+        address = os.path.join(self.directory, 'remote.sock')
+        with open(address, 'w') as file:
+            file.write('data')
+        with self.assertRaises(OSError):
+            RemoteSession(address)
+        with open(address) as file:
+            self.assertEqual(file.read(), 'data')
+
+    def test_oversized_frame(self):
+        sender, receiver = socket.socketpair()
+        self.closeables.extend([sender, receiver])
+        sender.sendall(FRAME_HEADER.pack(2 ** 31, 1))
+        with self.assertRaises(ValueError):
+            read_frame(receiver)
+
+
+if __name__ == '__main__':
+    unittest.main()
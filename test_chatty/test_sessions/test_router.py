@@ -0,0 +1,70 @@
+import unittest
+
+from chatty.sessions.interface import Session
+from chatty.sessions.router import RouterSession
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.types import Handle, RouteTypes
+
+
+class RecordingSession(Session):
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+        self.batches = []
+
+    def join(self, timeout=None):
+        pass
+
+    def send(self, signal):
+        self.sent.append(signal)
+
+    def send_batch(self, signals):
+        self.batches.append(list(signals))
+        super().send_batch(signals)
+
+
+def make_message(content, addressees, visible_to=()) -> Message:
+    return Message(SignalMetaData(origin=Handle('bot'), addressees=addressees, visible_to=visible_to), content)
+
+
+class RouterSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.router = RouterSession()
+        self.slack = RecordingSession()
+        self.email = RecordingSession()
+        self.router.register_session(Handle('alice'), self.slack)
+        self.router.register_session(Handle('bob'), self.slack)
+        self.router.register_session(Handle('*@example.com'), self.email, RouteTypes.PATTERN)
+
+    def test_deduplicated_send(self):
+        message = make_message('hi', [Handle('alice'), Handle('bob')], [Handle('carol@example.com')])
+        self.router.send(message)
+        self.assertEqual(self.slack.sent, [message])
+        self.assertEqual(self.email.sent, [message])
+        self.assertEqual(self.router.signals_routed, 1)
+        self.assertEqual(self.router.deliveries, 2)
+        self.assertEqual(self.router.duplicates_avoided, 1)
+
+    def test_batched_send(self):
+        messages = [make_message(index, [Handle('alice')]) for index in range(3)]
+        messages.append(make_message(3, [Handle('dave@example.com')]))
+        self.router.send_batch(messages)
+        self.assertEqual(self.slack.batches, [messages[:3]])
+        self.assertEqual(self.slack.sent, messages[:3])
+        self.assertEqual(self.email.batches, [])
+        self.assertEqual(self.email.sent, messages[3:])
+        self.assertEqual(self.router.deliveries, 4)
+        self.assertEqual(self.router.duplicates_avoided, 0)
+
+    def test_unregister(self):
+        self.router.unregister_session(Handle('alice'), self.slack)
+        self.router.send(make_message('hi', [Handle('alice')]))
+        self.assertEqual(self.slack.sent, [])
+        self.assertEqual(self.router.deliveries, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,8 @@
 import datetime
+import os
+import socket
+import tempfile
+import threading
 import time
 import unittest
 from typing import Tuple
@@ -6,9 +10,14 @@ from typing import Tuple
 from chatty.signals.delivery_failure import DeliveryFailure
 from chatty.signals.message import Message
 from slackclient import SlackClient
+from slackclient.server import SlackConnectionError
+from slackclient.channel import Channel
+from slackclient.user import User
+from slackclient.util import SearchDict, SearchList
 
+from chatty.exceptions import OperationNotSupported
 from chatty.sessions.interface import Session
-from chatty.sessions.slack import SlackSession
+from chatty.sessions.slack import SlackDirectory, SlackMembershipIndex, SlackSession, wait_for_websocket_input
 from chatty.signals.interface import Signal
 from chatty.signals.metadata import SignalMetaData
 from chatty.types import Handle
@@ -69,5 +78,501 @@ class SlackSessionTestCase(BaseClasses.SessionTestCase):
         assert failure.meta_data.identifier == meta_data.identifier
 
 
+class FakeSlackServer:
+
+    def __init__(self, client: 'FakeSlackClient'):
+        self.login_data = {'self': {'id': 'U0', 'name': 'bot'}}
+        self.username = 'bot'
+        self.users = SearchDict()
+        self.channels = SearchList()
+        self.websocket = client
+        self.reconnect_urls = []
+
+    def connect_slack_websocket(self, url):
+        self.reconnect_urls.append(url)
+        self.websocket.broken = False
+
+    def attach_user(self, name, user_id):
+        self.users[user_id] = User(self, name, user_id, name, 'unknown', '')
+
+    def attach_channel(self, name, channel_id, members):
+        # Like slackclient, channels which are already known are left as they are.
+        if self.channels.find(channel_id) is None:
+            self.channels.append(Channel(self, name, channel_id, members))
+
+
+class FakeSlackClient:
+    """Stands in for a connected SlackClient. Events pushed into it are read back through a real socket, so that
+    the session can wait on it."""
+
+    def __init__(self):
+        self.sock, self._peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.server = FakeSlackServer(self)
+        self.sent = []
+        self.connects = 0
+        self.team_state_loads = 0
+        self.api_calls = []
+        self.broken = False
+        self.team_channels = []  # (name, ID, members), loaded with the team state on connecting
+        self._events = []
+        self._lock = threading.Lock()
+
+    def rtm_connect(self, with_team_state=True, **kwargs):
+        self.connects += 1
+        self.team_state_loads += with_team_state
+        if with_team_state:
+            for channel in self.team_channels:
+                self.server.attach_channel(*channel)
+        self.broken = False
+        return True
+
+    def break_connection(self):
+        self.broken = True
+        self._peer.send(b'.')
+
+    def push(self, *events: dict):
+        # Events pushed together arrive together, as a single read from the socket.
+        with self._lock:
+            self._events.extend(events)
+        self._peer.send(b'.')
+
+    def rtm_read(self):
+        if self.broken:
+            raise SlackConnectionError("Connection is broken.")
+        try:
+            while self.sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        # Like the real client, return at most one frame's worth of events per call, even if more have arrived.
+        with self._lock:
+            if not self._events:
+                return []
+            return [self._events.pop(0)]
+
+    def api_call(self, method, **kwargs):
+        self.api_calls.append(method)
+        if method == 'users.info' and kwargs['user'] == 'U7':
+            return {'ok': True, 'user': {'id': 'U7', 'name': 'grace', 'profile': {'real_name': 'Grace'}}}
+        return {'ok': False, 'error': 'not_found'}
+
+    def rtm_send_message(self, channel, message):
+        if self.broken:
+            raise SlackConnectionError("Connection is broken.")
+        self.sent.append((time.monotonic(), channel, message))
+
+
+def make_message_event(text: str, channel: str = 'D1', user: str = 'U1') -> dict:
+    return {'type': 'message', 'channel': channel, 'user': user, 'text': text, 'ts': '%f' % (time.time() + 1)}
+
+
+class SlackSessionThreadingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeSlackClient()
+        self.client.server.attach_user('alice', 'U1')
+        self.received = []
+
+    def make_session(self, **kwargs) -> SlackSession:
+        session = SlackSession(self.client, **kwargs)
+        session.receive = self.received.append
+        self.addCleanup(session.close)
+        return session
+
+    def test_inbound_not_blocked_by_outbound(self):
+        session = self.make_session(rate_limit=.1)
+        for index in range(10):
+            session.send(Message(SignalMetaData(addressees=[Handle('alice')]), 'reply %d' % index))
+        start = time.monotonic()
+        self.client.push(make_message_event('hello'))
+        while not self.received and time.monotonic() - start < 5:
+            time.sleep(.005)
+        self.assertEqual([signal.content for signal in self.received], ['hello'])
+        self.assertLess(time.monotonic() - start, .5)
+        self.assertLess(len(self.client.sent), 10)  # The outbound backlog is still being worked through.
+
+    def test_no_rate_limit(self):
+        session = self.make_session(rate_limit=0)
+        for index in range(20):
+            session.send(Message(SignalMetaData(room=Handle('general')), str(index)))
+        self.wait_for_sent(20)
+        self.assertEqual([text for _, _, text in self.client.sent], [str(index) for index in range(20)])
+
+    def wait_for_sent(self, count: int):
+        end = time.monotonic() + 5
+        while len(self.client.sent) < count and time.monotonic() < end:
+            time.sleep(.005)
+
+    def test_burst_of_events(self):
+        self.make_session()
+        self.client.push(*[make_message_event('hello %d' % index) for index in range(5)])
+        end = time.monotonic() + .5
+        while len(self.received) < 5 and time.monotonic() < end:
+            time.sleep(.005)
+        self.assertEqual([signal.content for signal in self.received], ['hello %d' % index for index in range(5)])
+
+    def test_direct_message_addressed_to_bot(self):
+        self.client.server.attach_channel('D1', 'D1', [])  # How slackclient registers IMs.
+        self.make_session()
+        self.client.push(make_message_event('hello', channel='D1'))
+        end = time.monotonic() + 5
+        while not self.received and time.monotonic() < end:
+            time.sleep(.005)
+        meta_data = self.received[0].meta_data
+        self.assertEqual(meta_data.addressees, ('bot',))
+        self.assertEqual(meta_data.visible_to, ('alice', 'bot'))
+        self.assertEqual(meta_data.room, 'D1')
+
+    def test_per_destination_rate_limits(self):
+        session = self.make_session(rate_limit=1)
+        start = time.monotonic()
+        session.send(Message(SignalMetaData(room=Handle('general'), addressees=[Handle('alice'), Handle('bob'),
+                                                                                Handle('carol')]), 'hi'))
+        self.wait_for_sent(4)
+        self.assertEqual([channel for _, channel, _ in self.client.sent], ['general', 'alice', 'bob', 'carol'])
+        self.assertLess(self.client.sent[-1][0] - start, .5)
+
+    def test_retry_after(self):
+        session = self.make_session(rate_limit=.01)
+        self.client.push({'type': 'error', 'error': {'code': 429, 'msg': 'ratelimited', 'retry_after': .3}})
+        time.sleep(.1)
+        start = time.monotonic()
+        session.send(Message(SignalMetaData(room=Handle('general')), 'hi'))
+        self.wait_for_sent(1)
+        self.assertGreater(self.client.sent[0][0] - start, .1)
+
+    def test_coalescing(self):
+        session = self.make_session(rate_limit=.01, coalesce_window=.2, coalesce_limit=15)
+        for text in ['a', 'b', 'c']:
+            session.send(Message(SignalMetaData(room=Handle('general')), text))
+        session.send(Message(SignalMetaData(room=Handle('random')), 'd'))
+        session.send(Message(SignalMetaData(room=Handle('general')), 'e'))
+        for _ in range(5):
+            session.send(Message(SignalMetaData(room=Handle('general')), 'ffff'))
+        self.wait_for_sent(4)
+        time.sleep(.3)  # Make sure nothing else is sent.
+        self.assertEqual([(channel, text) for _, channel, text in self.client.sent],
+                         [('general', 'a\nb\nc'), ('random', 'd'), ('general', 'e\nffff\nffff'),
+                          ('general', 'ffff\nffff\nffff')])
+
+    def test_send_batch(self):
+        session = self.make_session(rate_limit=.01, coalesce_window=0)
+        session.send_batch([Message(SignalMetaData(room=Handle('general')), text) for text in 'abc'] +
+                           [Message(SignalMetaData(room=Handle('random')), 'd')])
+        self.wait_for_sent(2)
+        self.assertEqual([(channel, text) for _, channel, text in self.client.sent],
+                         [('general', 'a\nb\nc'), ('random', 'd')])
+        with self.assertRaises(OperationNotSupported):
+            session.send_batch([Message(SignalMetaData(room=Handle('general')), 'e'),
+                                Message(SignalMetaData(visible_to=[Handle('alice')]), 'f')])
+        time.sleep(.1)
+        self.assertEqual(len(self.client.sent), 2)  # Nothing in the batch was sent.
+
+
+class WaitForWebsocketInputTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.addCleanup(self.sock.close)
+        self.addCleanup(self.peer.close)
+
+    def make_websocket(self, **attributes):
+        websocket = type('WebSocket', (), {})()
+        websocket.__dict__.update(attributes)
+        return websocket
+
+    def test_socket(self):
+        websocket = self.make_websocket(sock=self.sock)
+        self.assertFalse(wait_for_websocket_input(websocket, .01))
+        self.peer.send(b'.')
+        self.assertTrue(wait_for_websocket_input(websocket, .01))
+
+    def test_buffered_frame(self):
+        frame_buffer = self.make_websocket(recv_buffer=[b'frame'])
+        self.assertTrue(wait_for_websocket_input(self.make_websocket(sock=self.sock, frame_buffer=frame_buffer), 1))
+
+    def test_unknown_internals(self):
+        # Another version of websocket-client might keep these elsewhere, or under different names.
+        self.assertTrue(wait_for_websocket_input(self.make_websocket(), .01))
+        self.assertTrue(wait_for_websocket_input(self.make_websocket(sock=object()), .01))
+        frame_buffer = self.make_websocket(recv_buffer=None)
+        self.assertFalse(wait_for_websocket_input(self.make_websocket(sock=self.sock, frame_buffer=frame_buffer), .01))
+
+
+class SlackReconnectTestCase(unittest.TestCase):
+
+    def test_factory_reconnect_keeps_queue(self):
+        first, second = FakeSlackClient(), FakeSlackClient()
+        clients = [first, second]
+        session = SlackSession(lambda: clients.pop(0), rate_limit=.01, reconnect_delay=.01)
+        self.addCleanup(session.close)
+        first.break_connection()
+        for index in range(5):
+            session.send(Message(SignalMetaData(room=Handle('general')), 'post %d' % index))
+        end = time.monotonic() + 5
+        while len(second.sent) < 5 and time.monotonic() < end:
+            time.sleep(.005)
+        self.assertEqual(first.sent, [])
+        self.assertEqual([text for _, _, text in second.sent], ['post %d' % index for index in range(5)])
+        self.assertEqual(second.connects, 1)
+
+    def test_membership_reloaded(self):
+        first, second = FakeSlackClient(), FakeSlackClient()
+        for client in (first, second):
+            client.server.attach_user('alice', 'U1')
+            client.server.attach_user('bot', 'U0')
+        first.server.attach_channel('general', 'C1', ['U0', 'U1'])
+        second.server.attach_user('carol', 'U3')
+        second.server.attach_channel('general', 'C1', ['U0', 'U1', 'U3'])  # Carol joined during the outage.
+        clients = [first, second]
+        received = []
+        session = SlackSession(lambda: clients.pop(0), reconnect_delay=.01)
+        session.receive = received.append
+        self.addCleanup(session.close)
+        first.push(make_message_event('before', channel='C1'))
+        end = time.monotonic() + 5
+        while not received and time.monotonic() < end:
+            time.sleep(.005)
+        first.break_connection()
+        while second.connects < 1 and time.monotonic() < end:
+            time.sleep(.005)
+        second.push(make_message_event('after', channel='C1'))
+        while len(received) < 2 and time.monotonic() < end:
+            time.sleep(.005)
+        self.assertEqual(sorted(received[0].meta_data.visible_to), ['alice', 'bot'])
+        self.assertEqual(sorted(received[1].meta_data.visible_to), ['alice', 'bot', 'carol'])
+
+    def test_same_client_reloads_channels(self):
+        client = FakeSlackClient()
+        client.server.attach_user('alice', 'U1')
+        client.server.attach_user('bot', 'U0')
+        client.server.attach_user('carol', 'U3')
+        client.team_channels = [('general', 'C1', ['U0', 'U1'])]
+        received = []
+        session = SlackSession(client, reconnect_delay=.01)
+        session.receive = received.append
+        self.addCleanup(session.close)
+        client.push(make_message_event('before', channel='C1'))
+        end = time.monotonic() + 5
+        while not received and time.monotonic() < end:
+            time.sleep(.005)
+        client.team_channels = [('general', 'C1', ['U0', 'U1', 'U3'])]  # Carol joined during the outage.
+        client.break_connection()
+        while client.connects < 2 and time.monotonic() < end:
+            time.sleep(.005)
+        client.push(make_message_event('after', channel='C1'))
+        while len(received) < 2 and time.monotonic() < end:
+            time.sleep(.005)
+        self.assertEqual([signal.meta_data.room for signal in received], ['general', 'general'])
+        self.assertEqual(received[0].meta_data.visible_to, ('alice', 'bot'))
+        self.assertEqual(received[1].meta_data.visible_to, ('alice', 'bot', 'carol'))
+
+    def test_reconnect_url(self):
+        client = FakeSlackClient()
+        session = SlackSession(client, rate_limit=.01, reconnect_delay=.01)
+        self.addCleanup(session.close)
+        client.push({'type': 'reconnect_url', 'url': 'wss://example.com/resume'})
+        time.sleep(.05)
+        client.break_connection()
+        time.sleep(.05)
+        session.send(Message(SignalMetaData(room=Handle('general')), 'hi'))
+        end = time.monotonic() + 5
+        while not client.sent and time.monotonic() < end:
+            time.sleep(.005)
+        self.assertEqual(client.server.reconnect_urls, ['wss://example.com/resume'])
+        self.assertEqual(client.connects, 1)  # Just the initial connection.
+        self.assertEqual([text for _, _, text in client.sent], ['hi'])
+
+
+class SlackMembershipIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSlackServer(None)
+        self.server.attach_user('alice', 'U1')
+        self.server.attach_user('bob', 'U2')
+        self.server.attach_channel('general', 'C1', ['U1', 'U2'])
+        self.lookups = 0
+
+        def get_user_info(user_id):
+            self.lookups += 1
+            return self.server.users.get(user_id)
+
+        self.index = SlackMembershipIndex(get_user_info, self.server.channels.find)
+
+    def test_shared_until_changed(self):
+        visible_to = self.index.visible_to('C1')
+        self.assertEqual(visible_to, ('alice', 'bob'))
+        self.assertIs(self.index.visible_to('C1'), visible_to)
+        self.assertEqual(self.lookups, 2)
+        self.assertEqual(self.index.channel_name('C1'), 'general')
+        self.assertEqual(self.index.visible_to('C2'), ())
+        self.assertIsNone(self.index.channel_name('C2'))
+
+    def test_membership_changes(self):
+        self.server.attach_user('carol', 'U3')
+        before = self.index.visible_to('C1')
+        self.index.add_member('C1', 'U3')
+        self.assertTrue(self.index.is_member('C1', 'U3'))
+        self.assertEqual(self.index.visible_to('C1'), ('alice', 'bob', 'carol'))
+        self.index.remove_member('C1', 'U1')
+        self.assertFalse(self.index.is_member('C1', 'U1'))
+        self.assertEqual(sorted(self.index.visible_to('C1')), ['bob', 'carol'])
+        self.assertEqual(sorted(before), ['alice', 'bob'])
+
+    def test_rename(self):
+        self.index.visible_to('C1')
+        self.index.rename_user('U2', 'robert')
+        self.assertEqual(self.index.user_name('U2'), 'robert')
+        self.assertEqual(self.index.visible_to('C1'), ('alice', 'robert'))
+
+    def test_slow_lookup_does_not_block_others(self):
+        release = threading.Event()
+
+        def get_channel_info(channel_id):
+            if channel_id == 'C2':
+                release.wait(5)
+            return self.server.channels.find(channel_id)
+
+        index = SlackMembershipIndex(self.server.users.get, get_channel_info)
+        self.server.attach_channel('random', 'C2', ['U1'])
+        slow = threading.Thread(target=index.visible_to, args=('C2',))
+        slow.start()
+        self.addCleanup(slow.join)
+        self.addCleanup(release.set)
+        start = time.monotonic()
+        self.assertEqual(index.visible_to('C1'), ('alice', 'bob'))
+        self.assertLess(time.monotonic() - start, 1)
+        release.set()
+        slow.join()
+        self.assertEqual(index.visible_to('C2'), ('alice',))
+
+    def test_session_events(self):
+        client = FakeSlackClient()
+        client.server.attach_user('alice', 'U1')
+        client.server.attach_user('bot', 'U0')
+        client.server.attach_channel('general', 'C1', ['U0', 'U1'])
+        received = []
+        session = SlackSession(client)
+        session.receive = received.append
+        self.addCleanup(session.close)
+        client.push({'type': 'user_change', 'user': {'id': 'U1', 'name': 'alicia'}})
+        client.push({'type': 'member_joined_channel', 'channel': 'C1', 'user': 'U9'})
+        client.push(make_message_event('hello', channel='C1'))
+        end = time.monotonic() + 5
+        while not received and time.monotonic() < end:
+            time.sleep(.005)
+        meta_data = received[0].meta_data
+        self.assertEqual(meta_data.room, 'general')
+        self.assertEqual(meta_data.origin, 'alicia')
+        self.assertEqual(sorted(meta_data.visible_to), ['U9', 'alicia', 'bot'])
+
+
+class SlackDirectoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'directory')
+
+    def test_snapshot_round_trip(self):
+        directory = SlackDirectory(self.path)
+        self.assertTrue(directory.is_empty)
+        for index in range(100):
+            directory.update_user('U%03d' % index, 'user%d' % index, tz='UTC')
+        directory.update_channel('C1', 'general', ['U001', 'U002'])
+        directory.update_channel('C2', 'empty', [])
+        directory.save()
+        directory.close()
+
+        directory = SlackDirectory(self.path)
+        self.assertFalse(directory.is_empty)
+        user = directory.get_user('U042')
+        self.assertEqual((user.id, user.name, user.tz), ('U042', 'user42', 'UTC'))
+        self.assertIsNone(directory.get_user('U999'))
+        channel = directory.get_channel('C1')
+        self.assertEqual((channel.name, channel.members), ('general', ['U001', 'U002']))
+        self.assertEqual(directory.get_channel('C2').members, [])
+        directory.close()
+
+    def test_changes_overlay_snapshot(self):
+        directory = SlackDirectory(self.path)
+        directory.update_user('U1', 'alice')
+        directory.update_user('U2', 'bob')
+        directory.update_channel('C1', 'general', ['U1'])
+        directory.save()
+        directory.update_user('U1', 'alicia')
+        directory.remove_user('U2')
+        directory.add_member('C1', 'U2')
+        directory.remove_member('C1', 'U1')
+        directory.update_channel('C1', 'lobby')
+        self.assertEqual(directory.get_user('U1').name, 'alicia')
+        self.assertIsNone(directory.get_user('U2'))
+        self.assertEqual((directory.get_channel('C1').name, directory.get_channel('C1').members), ('lobby', ['U2']))
+        directory.save()
+        directory.close()
+        directory = SlackDirectory(self.path)
+        self.assertEqual(directory.get_user('U1').name, 'alicia')
+        self.assertIsNone(directory.get_user('U2'))
+        self.assertEqual(directory.get_channel('C1').members, ['U2'])
+        directory.close()
+
+    def test_session_uses_directory(self):
+        directory = SlackDirectory(self.path)
+        directory.update_user('U0', 'bot')
+        directory.update_user('U1', 'alice')
+        directory.update_channel('C1', 'general', ['U0', 'U1'])
+        directory.save()
+        client = FakeSlackClient()
+        received = []
+        session = SlackSession(client, directory=directory)
+        session.receive = received.append
+        self.assertEqual(client.team_state_loads, 0)
+        client.push({'type': 'member_joined_channel', 'channel': 'C1', 'user': 'U7'})
+        client.push(make_message_event('hello', channel='C1'))
+        end = time.monotonic() + 5
+        while not received and time.monotonic() < end:
+            time.sleep(.005)
+        session.close()
+        self.assertEqual(sorted(received[0].meta_data.visible_to), ['alice', 'bot', 'grace'])
+        self.assertEqual(client.api_calls, ['users.info'])
+        directory.close()
+        directory = SlackDirectory(self.path)
+        self.assertEqual(directory.get_user('U7').real_name, 'Grace')
+        self.assertEqual(directory.get_channel('C1').members, ['U0', 'U1', 'U7'])
+        directory.close()
+
+    def test_saved_without_close(self):
+        client = FakeSlackClient()
+        client.server.attach_user('alice', 'U1')
+        directory = SlackDirectory(self.path)
+        session = SlackSession(client, directory=directory, directory_save_interval=.05, reconnect_delay=.01)
+        self.addCleanup(session.close)
+        self.assertEqual(client.team_state_loads, 1)
+        self.assertEqual(SlackDirectory(self.path).get_user('U1').name, 'alice')  # Saved after the first load.
+
+        client.push({'type': 'user_change', 'user': {'id': 'U1', 'name': 'alicia'}})
+        end = time.monotonic() + 5
+        while SlackDirectory(self.path).get_user('U1').name != 'alicia' and time.monotonic() < end:
+            time.sleep(.01)
+        self.assertEqual(SlackDirectory(self.path).get_user('U1').name, 'alicia')
+
+        # Reconnecting the same client doesn't download the team again.
+        client.break_connection()
+        end = time.monotonic() + 5
+        while client.connects < 2 and time.monotonic() < end:
+            time.sleep(.01)
+        self.assertEqual((client.connects, client.team_state_loads), (2, 1))
+
+    def test_save_error_on_close(self):
+        client = FakeSlackClient()
+        directory = SlackDirectory(os.path.join(self.path, 'missing', 'directory'))
+        with self.assertLogs('chatty.sessions.slack', 'ERROR'):
+            session = SlackSession(client, directory=directory)
+        directory.update_user('U1', 'alice')
+        with self.assertLogs('chatty.sessions.slack', 'ERROR'):
+            session.close()
+
+
 if __name__ == '__main__':
     unittest.main()
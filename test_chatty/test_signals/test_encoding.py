@@ -0,0 +1,101 @@
+import datetime
+import unittest
+from email.message import EmailMessage
+
+from chatty.exceptions import SignalTypeNotSupported
+from chatty.signals.delivery_failure import DeliveryFailure
+from chatty.signals.encoding import SignalBatchView, decode_signal, decode_signals, encode_record, encode_signal, \
+    encode_signals, join_records
+from chatty.signals.interface import Signal
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.signals.status_change import StatusChange
+from chatty.types import ErrorCode, Handle, SignalID, StatusTypes, TypingStatusValues
+
+
+def make_meta_data(index: int = 0) -> SignalMetaData:
+    return SignalMetaData(
+        identifier=SignalID('message-%d' % index),
+        origin=Handle('alice'),
+        addressees=[Handle('bob'), Handle('çaé')],
+        visible_to=[Handle('user%d' % member) for member in range(200)],
+        response_to=SignalID('message-%d' % (index - 1)),
+        sent_at=datetime.datetime(2018, 5, 1, 12, 30, 15, 123456),
+        received_at=datetime.datetime(2018, 5, 1, 12, 30, 16, tzinfo=datetime.timezone(datetime.timedelta(hours=-5))),
+        room=Handle('general')
+    )
+
+
+class SignalEncodingTestCase(unittest.TestCase):
+
+    def assert_round_trip(self, signal: Signal):
+        decoded = decode_signal(encode_signal(signal))
+        self.assertEqual(decoded, signal)
+        return decoded
+
+    def test_signal_types(self):
+        self.assert_round_trip(Message(make_meta_data(), 'Hello, world!'))
+        self.assert_round_trip(Message(SignalMetaData(), ''))
+        self.assert_round_trip(Signal(SignalMetaData(origin=Handle('alice'))))
+        self.assert_round_trip(DeliveryFailure(make_meta_data(), 'No such user', ErrorCode('550')))
+        self.assert_round_trip(StatusChange(make_meta_data(), StatusTypes.TYPING, TypingStatusValues.STARTED))
+
+    def test_mime_content(self):
+        content = EmailMessage()
+        content['subject'] = 'Attachment'
+        content.set_content('See attached.')
+        content.add_attachment(bytes(range(256)) * 10, maintype='application', subtype='octet-stream',
+                               filename='data.bin')
+        signal = Message(make_meta_data(), content)
+        decoded = decode_signal(encode_signal(signal))
+        self.assertEqual(decoded.meta_data, signal.meta_data)
+        self.assertEqual(decoded.content.as_bytes(), content.as_bytes())
+        attachment = next(decoded.content.iter_attachments())
+        self.assertEqual(attachment.get_content(), bytes(range(256)) * 10)
+
+    def test_batch(self):
+        signals = [Message(make_meta_data(index), 'Message #%d' % index) for index in range(1000)]
+        encoded = encode_signals(signals)
+        self.assertEqual(decode_signals(encoded), signals)
+
+        view = SignalBatchView(memoryview(encoded))
+        self.assertEqual(len(view), 1000)
+        self.assertEqual(view[500], signals[500])
+        self.assertEqual(view[-1], signals[-1])
+        self.assertEqual(view[10:13], signals[10:13])
+
+        # Individual records can be re-assembled into a new batch without decoding them.
+        self.assertIsInstance(view.record(0), memoryview)
+        self.assertEqual(decode_signals(join_records(view.record(index) for index in (3, 1))),
+                         [signals[3], signals[1]])
+
+    def test_unsupported_signal_type(self):
+        class CustomSignal(Signal):
+            pass
+
+        with self.assertRaises(SignalTypeNotSupported):
+            encode_signal(CustomSignal(SignalMetaData()))
+
+    def test_invalid_buffers(self):
+        encoded = encode_signal(Message(make_meta_data(), 'Hello'))
+        with self.assertRaises(ValueError):
+            decode_signal(b'JUNK' + encoded[4:])
+        with self.assertRaises(ValueError):
+            decode_signal(encoded[:4] + bytes([255]) + encoded[5:])
+        with self.assertRaises(ValueError):
+            decode_signal(encoded[:-10])
+
+    def test_truncated_records(self):
+        # Records whose length prefix has been rewritten to match, so only the record decoder can notice.
+        record = encode_record(Message(make_meta_data(), 'Hello'))
+        for length in range(len(record)):
+            with self.assertRaises(ValueError):
+                decode_signal(join_records([record[:length]]))
+
+    def test_non_string_handles(self):
+        with self.assertRaises(TypeError):
+            encode_signal(Message(SignalMetaData(origin=42), 'Hello'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import pickle
+import unittest
+
+from chatty.signals.message import Message
+from chatty.signals.metadata import SignalMetaData
+from chatty.signals.status_change import StatusChange
+from chatty.types import Handle, StatusTypes, TypingStatusValues
+
+
+class SignalMetaDataTestCase(unittest.TestCase):
+
+    def test_structural_equality(self):
+        first = SignalMetaData(origin=Handle('alice'), visible_to=[Handle('alice'), Handle('bob')], room='general')
+        second = SignalMetaData(origin=Handle('alice'), visible_to=(Handle('alice'), Handle('bob')), room='general')
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertNotEqual(first, SignalMetaData(origin=Handle('bob')))
+        self.assertEqual(Message(first, 'hi'), Message(second, 'hi'))
+        self.assertEqual(len({Message(first, 'hi'), Message(second, 'hi')}), 1)
+
+    def test_handles_are_shared(self):
+        members = ['user%d' % index for index in range(100)]
+        first = SignalMetaData(origin=''.join(['al', 'ice']), visible_to=members)
+        second = SignalMetaData(origin=''.join(['ali', 'ce']), visible_to=[''.join(member) for member in members])
+        self.assertIs(first.origin, second.origin)
+        self.assertIs(first.visible_to, second.visible_to)
+
+    def test_immutable(self):
+        meta_data = SignalMetaData(origin=Handle('alice'))
+        with self.assertRaises(AttributeError):
+            meta_data._origin = Handle('bob')
+        with self.assertRaises(AttributeError):
+            Message(meta_data, 'hi').extra = None
+        message = Message(meta_data, 'hi')
+        with self.assertRaises(AttributeError):
+            message._content = 'bye'
+        with self.assertRaises(AttributeError):
+            del message._meta_data
+        status_change = StatusChange(meta_data, StatusTypes.TYPING, TypingStatusValues.STARTED)
+        with self.assertRaises(AttributeError):
+            status_change._value = TypingStatusValues.STOPPED
+        self.assertEqual(message.content, 'hi')
+
+    def test_pickle(self):
+        signal = StatusChange(SignalMetaData(origin=Handle('alice'), addressees=[Handle('bob')]), StatusTypes.TYPING,
+                              TypingStatusValues.STARTED)
+        self.assertEqual(pickle.loads(pickle.dumps(signal)), signal)
+
+    def test_status_change_equality(self):
+        meta_data = SignalMetaData(origin=Handle('alice'))
+        started = StatusChange(meta_data, StatusTypes.TYPING, TypingStatusValues.STARTED)
+        stopped = StatusChange(meta_data, StatusTypes.TYPING, TypingStatusValues.STOPPED)
+        self.assertNotEqual(started, stopped)
+
+
+if __name__ == '__main__':
+    unittest.main()